@@ -1,16 +1,13 @@
 
 #import os
 import traceback
-import re
-from pprint import pformat
 from django.conf import settings
-from django.core.cache import cache
 
 from graphite.logger import log
 from graphite.node import BranchNode, LeafNode
 from graphite.util import find_escaped_pattern_fields
 
-from graphite.finders.metricType import MetricType
+from metricType import MetricType, get_metric_type_options
 
 from cassandra.cluster import Cluster
 from cassandra.query import dict_factory
@@ -30,9 +27,81 @@ from graphite.intervals import Interval, IntervalSet
 from graphite.readers import FetchInProgress
 from graphite import settings 
 
+from kairosdbBatch import KairosdbBatchFetcher, split_time_range, wait_all
+from kairosdbResampler import resample_values, resample_fixed_step, as_series_points, SeriesPoints
+from kairosdbSeries import CompactSeries, SERIES_MEMORY
+from kairosdbCache import KairosdbDatapointCache
+from kairosdbExtents import KairosdbExtentIndex
+from kairosdbJson import decode_query_response, QueryResponseDecoder, JsonBodyDecoder
+from kairosdbDownsample import KairosdbDownsampler, KairosdbRollupRouter
+from kairosdbHttp import get_http_client
+from kairosdbEndpoints import get_endpoint_pool, parse_urls
+from kairosdbMetrics import KairosdbRequestMetrics, ByteCounter, CountingDecoder, count_points, endpoint_of
+from kairosdbFind import FindWindow, get_find_stats, reset_find_stats
+from kairosdbNameService import KairosdbNameClient, NameServiceError
+import kairosdbAsync
+
 KAIROSDB_MAX_REQUESTS = 10
 KAIROSDB_REQUEST_POOL = ThreadPool(KAIROSDB_MAX_REQUESTS)
-KAIROSDB_URL = settings.KAIROSDB_URL
+# one or more kairosdb nodes, readers use the comma separated list as uri.
+KAIROSDB_URL = ','.join(parse_urls(settings.KAIROSDB_URL))
+KAIROSDB_FETCH_ENGINE = getattr(settings, 'KAIROSDB_FETCH_ENGINE', 'threads')
+KAIROSDB_BATCH_MAX_METRICS = getattr(settings, 'KAIROSDB_BATCH_MAX_METRICS', 50)
+KAIROSDB_SPLIT_SECONDS = getattr(settings, 'KAIROSDB_SPLIT_SECONDS', 0)
+KAIROSDB_HTTP_CLIENT = get_http_client(
+    pool_size       = KAIROSDB_MAX_REQUESTS,
+    connect_timeout = getattr(settings, 'KAIROSDB_CONNECT_TIMEOUT', 5.0),
+    read_timeout    = getattr(settings, 'KAIROSDB_READ_TIMEOUT', 15.0),
+    gzip_requests   = getattr(settings, 'KAIROSDB_GZIP_REQUESTS', False),
+    )
+KAIROSDB_ENDPOINTS = get_endpoint_pool(KAIROSDB_URL,
+    client           = KAIROSDB_HTTP_CLIENT,
+    hedge_percentile = getattr(settings, 'KAIROSDB_HEDGE_PERCENTILE', 0),
+    )
+KAIROSDB_REQUEST_METRICS = KairosdbRequestMetrics(
+    slow_seconds = getattr(settings, 'KAIROSDB_SLOW_QUERY_SECONDS', 5.0),
+    slow_sample  = getattr(settings, 'KAIROSDB_SLOW_QUERY_SAMPLE', 1.0),
+    logger       = log,
+    )
+KAIROSDB_LOG_REQUESTS = getattr(settings, 'KAIROSDB_LOG_REQUESTS', False)
+KAIROSDB_FIND_MAX_RESULTS = getattr(settings, 'KAIROSDB_FIND_MAX_RESULTS', 0)
+# 'local': every worker finds in process, 'sidecar': finds go to the name
+# service on KAIROSDB_NAME_SOCKET (see kairosdbNameService).
+KAIROSDB_NAME_CLIENT = None
+if getattr(settings, 'KAIROSDB_NAME_SERVICE', 'local') == 'sidecar':
+    KAIROSDB_NAME_CLIENT = KairosdbNameClient(settings.KAIROSDB_NAME_SOCKET)
+KAIROSDB_DECODE_CHUNK_SIZE = 64 * 1024
+KAIROSDB_RESPONSE_DECODER = None
+KAIROSDB_ASYNC_DECODER = JsonBodyDecoder
+if getattr(settings, 'KAIROSDB_STREAMING_DECODE', True):
+    KAIROSDB_RESPONSE_DECODER = decode_query_response
+    KAIROSDB_ASYNC_DECODER = QueryResponseDecoder
+KAIROSDB_DATAPOINT_CACHE = None
+if getattr(settings, 'KAIROSDB_CACHE_MAX_POINTS', 0):
+    KAIROSDB_DATAPOINT_CACHE = KairosdbDatapointCache(
+        block_seconds      = getattr(settings, 'KAIROSDB_CACHE_BLOCK_SECONDS', 3600),
+        recent_ttl         = getattr(settings, 'KAIROSDB_CACHE_RECENT_TTL', 0),
+        late_write_seconds = getattr(settings, 'KAIROSDB_CACHE_LATE_WRITE_SECONDS', 300),
+        max_points         = settings.KAIROSDB_CACHE_MAX_POINTS,
+        )
+KAIROSDB_ASYNC_ENGINE = None
+if KAIROSDB_FETCH_ENGINE == 'asyncio':
+    if kairosdbAsync.is_available():
+        KAIROSDB_ASYNC_ENGINE = kairosdbAsync.get_async_engine(
+            limit          = getattr(settings, 'KAIROSDB_ASYNC_LIMIT', 500),
+            limit_per_host = getattr(settings, 'KAIROSDB_ASYNC_LIMIT_PER_HOST', 100),
+            timeout        = getattr(settings, 'KAIROSDB_READ_TIMEOUT', 15.0),
+            logger         = log,
+            )
+    else:
+        log.info("kairosDBFinder: KAIROSDB_FETCH_ENGINE is 'asyncio' but asyncio/aiohttp are not importable, using threads.")
+KAIROSDB_DOWNSAMPLER = KairosdbDownsampler(
+    target_points      = getattr(settings, 'KAIROSDB_TARGET_POINTS', 0),
+    rules              = getattr(settings, 'KAIROSDB_AGGREGATOR_RULES', ()),
+    default_aggregator = getattr(settings, 'KAIROSDB_DEFAULT_AGGREGATOR', 'avg'),
+    min_interval       = getattr(settings, 'KAIROSDB_MIN_SAMPLING_SECONDS', 10),
+    )
+KAIROSDB_ROLLUP_ROUTER = KairosdbRollupRouter(getattr(settings, 'KAIROSDB_ROLLUPS', ()))
 
 ###############################################################################
 
@@ -70,48 +139,182 @@ class KairosdbUtils(object):
     def graphite_time_to_kairosdb_time(self, timeval):
         return timeval * 1000
 
+    def get_endpoints(self, kairosdb_uri):
+        ''' the node pool for kairosdb_uri, one or more comma separated urls. '''
+        return get_endpoint_pool(kairosdb_uri, client=KAIROSDB_HTTP_CLIENT)
+
     def get_kairosdb_url(self, kairosdb_uri, url):
-        full_url = "%s/%s" % (kairosdb_uri, url)
-        log.info("kairosdb.KairosdbUtils.get_kairosdb_url(): url: %s" % (url))
         tstart = time.time()
-        result = requests.get(full_url, timeout=5)
-        delay = time.time() - tstart
-        log.info("kairosdb.KairosdbUtils.get_kairosdb_url(): full url: %s, delay: %5.8f, result: %s" % (full_url, delay, result))
-        return result.json()
-
-    def post_kairosdb_url(self, kairosdb_uri, url, data):
-        full_url = "%s/%s" % (kairosdb_uri, url)
-        log.info("kairosdb.KairosdbUtils.post_kairosdb_url(): url: %s, data: %s" % (url, pformat(data)))
-        #return requests.post(full_url, data, timeout=0.5).json()
-        #resp = requests.post(full_url, data, timeout=0.5).json()
+        result = None
+        try:
+            result = self.get_endpoints(kairosdb_uri).get(url)
+            tdecode = time.time()
+            ret = result.json()
+        except Exception as e:
+            self.record_request(kairosdb_uri, url, tstart, result, error=e)
+            raise
+        self.record_request(kairosdb_uri, url, tstart, result, bytes_in=len(result.content), decode_seconds=time.time() - tdecode)
+        return ret
+
+    def post_kairosdb_url(self, kairosdb_uri, url, data, decode=None):
+        ''' decode, when given, reads the response as a stream of byte chunks instead of ret.json(). '''
         tstart = time.time()
         ret = None
         try:
-            #ret = call_with_timeout(requests.post, args=(full_url,data), kwargs={'timeout': 2}, timeout=5)
-            ret = requests.post(full_url, data, timeout=15.0)
+            ret = self.get_endpoints(kairosdb_uri).post(url, data, stream=(decode is not None))
+            tdecode = time.time()
+            if decode is not None:
+                body = ByteCounter(ret.iter_content(KAIROSDB_DECODE_CHUNK_SIZE))
+                try:
+                    response = decode(body)
+                finally:
+                    ret.close()
+                bytes_in = body.count
+            else:
+                response = ret.json()
+                bytes_in = len(ret.content)
         except Exception as e:
-            tb = traceback.format_exc()
-            log.info("kairosdb.KairosdbUtils.post_kairosdb_url(): EXCEPTION: %s, tb: %s, url: %s, data: %s" % (e, tb, full_url, pformat(data)))
+            log.info("kairosdb.KairosdbUtils.post_kairosdb_url(): EXCEPTION: %s, tb: %s, url: %s/%s, #bytes: %d" % (e, traceback.format_exc(), kairosdb_uri, url, len(data)))
+            self.record_request(kairosdb_uri, url, tstart, ret, data=data, error=e)
+            raise
+        self.record_request(kairosdb_uri, url, tstart, ret, data=data, bytes_in=bytes_in,
+            points=count_points(response), decode_seconds=time.time() - tdecode)
+        return response
+
+    def record_request(self, kairosdb_uri, url, tstart, response, data=None, bytes_in=0, points=0, decode_seconds=0.0, error=None):
+        ''' per node instrumentation, see KAIROSDB_REQUEST_METRICS. '''
         delay = time.time() - tstart
-        name = "NameNotFoundStringIsOdd: %s" % (str(data))
-        try:
-            # data is already a json-string, search string for name.
-            match = re.search(".*name(.*)tags.*", data) 
-            name = match and match.group() and match.group(1) or "NoMatch"
-        except Exception as e:
-            pass
-        log.info("KairosDBcallDelay: %5.8f, name: %s" % (delay, name))
-        return ret.json()
+        endpoint = kairosdb_uri
+        if response is not None:
+            endpoint = endpoint_of(response.url)
+        KAIROSDB_REQUEST_METRICS.record(endpoint, url, delay, bytes_out=len(data or ''), bytes_in=bytes_in,
+            points=points, decode_seconds=decode_seconds, error=error, data=data)
+        if KAIROSDB_LOG_REQUESTS:
+            log.info("KairosDBcallDelay: %5.8f, endpoint: %s, url: %s, #bytes: %d, #points: %d" % (delay, endpoint, url, bytes_in, points))
+
+    def get_query_data(self, start_absolute, end_absolute, metrics):
+        post_data_obj = {
+            'start_absolute' : start_absolute,
+            'end_absolute'   : end_absolute,
+            'metrics'        : metrics,
+            }
+        return json.dumps(post_data_obj)
+
+    def post_kairosdb_query(self, key, metrics):
+        ''' batch fetcher callback, key is (kairosdb_uri, start_absolute, end_absolute). '''
+        (kairosdb_uri, start_absolute, end_absolute) = key
+        post_data = self.get_query_data(start_absolute, end_absolute, metrics)
+        return self.post_kairosdb_url(kairosdb_uri, 'datapoints/query', data=post_data, decode=KAIROSDB_RESPONSE_DECODER)
+
+    def post_kairosdb_query_async(self, key, metrics):
+        ''' same as post_kairosdb_query() on the asyncio engine, returns a future. '''
+        (kairosdb_uri, start_absolute, end_absolute) = key
+        post_data = self.get_query_data(start_absolute, end_absolute, metrics)
+        tstart = time.time()
+        decoders = []
+
+        def decoder():
+            # runs on the engine's loop thread, counts what record() reports.
+            decoders.append(CountingDecoder(KAIROSDB_ASYNC_DECODER()))
+            return decoders[-1]
+
+        def record(url, future):
+            error = future.exception()
+            if error is not None:
+                log.info("kairosdb.KairosdbUtils.post_kairosdb_query_async(): EXCEPTION: %s, url: %s, #bytes: %d" % (error, url, len(post_data)))
+                self.record_request(endpoint_of(url), 'datapoints/query', tstart, None, data=post_data, error=error)
+                return
+            self.record_request(endpoint_of(url), 'datapoints/query', tstart, None, data=post_data, bytes_in=decoders[0].count,
+                points=count_points(future.result()), decode_seconds=decoders[0].seconds)
+
+        return self.get_endpoints(kairosdb_uri).post_json_async(KAIROSDB_ASYNC_ENGINE, 'datapoints/query', post_data,
+            decoder=decoder, on_done=record)
+
+    def values_to_datapoints(self, values, startTime, endTime):
+        ''' convert kairosdb [timestamp, value] pairs into graphite (time_info, datapoints). '''
+        if values is None:
+            time_info = startTime, endTime, 1
+            return (time_info, CompactSeries.from_list([]))
+        return resample_values(values, startTime, endTime)
+
+###############################################################################
+
+KAIROSDB_BATCH_FETCHER = KairosdbBatchFetcher(KairosdbUtils().post_kairosdb_query, KAIROSDB_REQUEST_POOL, max_metrics=KAIROSDB_BATCH_MAX_METRICS, logger=log,
+    post_query_async=KAIROSDB_ASYNC_ENGINE and KairosdbUtils().post_kairosdb_query_async)
+KAIROSDB_EXTENT_INDEX = None
+if getattr(settings, 'KAIROSDB_EXTENT_TTL', 0):
+    KAIROSDB_EXTENT_INDEX = KairosdbExtentIndex(KairosdbUtils().post_kairosdb_query,
+        ttl          = settings.KAIROSDB_EXTENT_TTL,
+        live_seconds = getattr(settings, 'KAIROSDB_EXTENT_LIVE_SECONDS', 3600),
+        max_age      = getattr(settings, 'KAIROSDB_EXTENT_MAX_AGE', 0),
+        max_metrics  = KAIROSDB_BATCH_MAX_METRICS,
+        logger       = log,
+        )
+
+def fetch_multi(readers, startTime, endTime):
+    ''' fetch many leaves at once, returns [(time_info, datapoints), ...] in reader order. '''
+    jobs = [reader.fetch(startTime, endTime) for reader in readers]
+    KAIROSDB_BATCH_FETCHER.flush()
+    return [job.waitForResults() for job in jobs]
+
+def get_kairosdb_stats():
+    ''' everything the fetch path counts, for dumping from a shell or a view. '''
+    ret = {
+        'requests'     : KAIROSDB_REQUEST_METRICS.dump(),
+        'http'         : KAIROSDB_HTTP_CLIENT.get_stats(),
+        'endpoints'    : KAIROSDB_ENDPOINTS.get_stats(),
+        'batch'        : KAIROSDB_BATCH_FETCHER.get_stats(),
+        'seriesMemory' : SERIES_MEMORY.get_stats(),
+        'find'         : get_find_stats(),
+        }
+    if KAIROSDB_NAME_CLIENT is not None:
+        ret['nameService'] = KAIROSDB_NAME_CLIENT.get_stats()
+    if KAIROSDB_DATAPOINT_CACHE is not None:
+        ret['cache'] = KAIROSDB_DATAPOINT_CACHE.get_stats()
+    if KAIROSDB_EXTENT_INDEX is not None:
+        ret['extents'] = KAIROSDB_EXTENT_INDEX.get_stats()
+    if KAIROSDB_ASYNC_ENGINE is not None:
+        ret['async'] = KAIROSDB_ASYNC_ENGINE.get_stats()
+    return ret
+
+def reset_kairosdb_stats():
+    KAIROSDB_REQUEST_METRICS.reset()
+    KAIROSDB_HTTP_CLIENT.reset_stats()
+    KAIROSDB_ENDPOINTS.reset_stats()
+    KAIROSDB_BATCH_FETCHER.reset_stats()
+    SERIES_MEMORY.reset_stats()
+    reset_find_stats()
 
 ###############################################################################
 
 
 class KairosDBFinder(object):
     def __init__(self):
-        self.mt = MetricType()
-        self.mt.openConnection()
+        self.mt = None
+        if KAIROSDB_NAME_CLIENT is None:
+            self.get_metric_type()
         #self.mt = GLOBAL_METRIC_TYPE
 
+    # With the name service the local MetricType is only opened if the
+    # service cannot be reached.
+    def get_metric_type(self):
+        if self.mt is None:
+            mt = MetricType(**get_metric_type_options(settings))
+            mt.openConnection()
+            self.mt = mt
+        return self.mt
+
+    def find_on_service(self, pattern, window):
+        try:
+            (tupes, truncated) = KAIROSDB_NAME_CLIENT.find_nodes(pattern, window.offset, window.max_results)
+        except NameServiceError:
+            raise
+        except Exception as e:
+            log.info("KairosDBFinder.find_on_service(%s): name service unavailable, finding locally: %s" % (pattern, e))
+            return window.apply(self.get_metric_type().iter_nodes(pattern))
+        window.record(len(tupes), truncated)
+        return tupes
+
     def getLeafNode(self, mname, reader, avoidIntervals=False):
         ln = LeafNode(mname, reader)  #, avoidIntervals=avoidIntervals)
         return ln
@@ -120,18 +323,32 @@ class KairosDBFinder(object):
         bn = BranchNode(mname)
         return bn
 
+    # KAIROSDB_FIND_MAX_RESULTS caps finds, query.offset / query.max_results
+    # page through them: matches are streamed in sorted order and the walk
+    # stops once the page is full, query.truncated tells whether it did.
     def find_nodes(self, query):
         timeStart = time.time()
+        window = FindWindow.for_query(query, KAIROSDB_FIND_MAX_RESULTS)
         
-        cacheKey = "find_node_qpList:%s" % query.pattern
-        tupes = cache.get(cacheKey)
-        if not tupes:
+        tupes = None
+        if KAIROSDB_NAME_CLIENT is not None:
+            # the name service caches patterns itself.
+            matches = self.find_on_service(query.pattern, window)
+        elif window.is_limited():
+            # a cached full result is paged, partial results are not cached.
+            tupes = self.mt.getQpFromCache(query.pattern)
+            if tupes is None:
+                matches = window.apply(self.mt.iter_nodes(query.pattern))
+            else:
+                matches = window.apply(tupes)
+        else:
+            # MetricType's pattern cache is the only find cache.
             tupes = self.mt.find_nodes(query.pattern)
-            cache.set(cacheKey, tupes, 30*60)
+            matches = window.apply(tupes)
          
         nodes = []
         try:
-            for mname, nodeType in tupes:
+            for mname, nodeType in matches:
                 if nodeType == 'L':
                     reader  = KairosdbReader(KAIROSDB_URL, mname)
                     nodes.append(self.getLeafNode(mname, reader, avoidIntervals=True))
@@ -142,12 +359,9 @@ class KairosDBFinder(object):
         except Exception as e:
             tb = traceback.format_exc()
             log.info("finders.KairosDBFinder.find_nodes(%s) EXCEPTION: e: %s, %s, tupes: %s." % (query, e, tb, tupes))
-        if 0:
-            log.info("finders.KairosDBFinder.find_nodes(%s) saving data! %d nodes." % (query.pattern, len(nodes)))
-            if 0:
-                log.info("finders.KairosDBFinder.find_nodes(%s) nodes to save: %s" % (query.pattern, nodes))
+        window.report(query)
         delay = time.time() - timeStart
-        log.info("KairosDBFinder.find_nodes(): kdbFindNodesDelay: %05.08f #tupes: %s query: %s" % (delay, len(tupes), query))
+        log.info("KairosDBFinder.find_nodes(): kdbFindNodesDelay: %05.08f #nodes: %s truncated: %s query: %s" % (delay, len(nodes), window.truncated, query))
         return nodes
 
 ###############################################################################
@@ -162,96 +376,124 @@ class KairosdbReader(object):
         #log.info("KairosdbReader.__init__(): uri: %s, metricname: %s" % (kairosdb_uri, metric_name))
 
     def get_intervals(self):
+        if KAIROSDB_EXTENT_INDEX is not None:
+            intervals = KAIROSDB_EXTENT_INDEX.get_intervals((self.kairosdb_uri, self.metric_name))
+            if intervals is not None:
+                return IntervalSet([Interval(start, end) for (start, end) in intervals])
         return IntervalSet([Interval(0, time.time())])
 
-    def fetch(self, startTime, endTime):
+    def get_metric_query(self, plan=None):
+        aggregators = []
+        if plan:
+            aggregators.append(plan.get_aggregator_query())
+        return {
+            'tags'          : {},
+            'name'          : self.metric_name,
+            'aggregators'   : aggregators,
+            }
+
+    def get_cache_plan(self, plan, start_absolute, end_absolute):
+        cache = KAIROSDB_DATAPOINT_CACHE
+        if cache is None:
+            return None
+        align_ms = 60 * 1000
+        if plan:
+            # sampled buckets must not straddle cache blocks.
+            align_ms = plan.interval * 1000
+            if cache.block_ms % align_ms:
+                return None
+        series_key = (self.kairosdb_uri, self.metric_name, plan and (plan.aggregator, plan.interval))
+        return cache.plan_fetch(series_key, start_absolute, end_absolute, align_ms=align_ms)
+
+    def get_query_parts(self, plan, route, start_absolute, end_absolute):
+        ''' [(start, end, metric query), ...]: the rollup before route.boundary, raw data after. '''
+        raw = self.get_metric_query(plan)
+        if route is None:
+            return [(start_absolute, end_absolute, raw)]
+        boundary = route.boundary * 1000
+        parts = []
+        if start_absolute < boundary:
+            parts.append((start_absolute, min(boundary - 1, end_absolute), route.get_metric_query(plan)))
+        if end_absolute >= boundary:
+            parts.append((max(start_absolute, boundary), end_absolute, raw))
+        return parts
+
+    def split_fetch(self, plan, start_absolute, end_absolute):
+        ''' long windows are fetched as parallel queries along kairosdb rows. '''
+        if not KAIROSDB_SPLIT_SECONDS:
+            return [(start_absolute, end_absolute)]
+        align_ms = 1
+        if plan:
+            # kairosdb samples from the query start, keep chunks on the grid.
+            align_ms = plan.interval * 1000
+        return split_time_range(start_absolute, end_absolute, KAIROSDB_SPLIT_SECONDS * 1000, align_ms)
+
+    def join_chunks(self, chunks):
+        ''' stitch per chunk 'values' back into one SeriesPoints, None on error. '''
+        if len(chunks) == 1:
+            return chunks[0]
+        if any(values is None for values in chunks):
+            return None
+        return SeriesPoints.join([as_series_points(values) for values in chunks])
+
+    def fetch(self, startTime, endTime, now=None, requestContext=None):
+        # Queries are not sent right away: every leaf of a render request
+        # registers here first, the first waitForResults() sends them as
+        # batched multi-metric queries.
+        requestContext = requestContext or {}
+        plan = KAIROSDB_DOWNSAMPLER.plan(self.metric_name, startTime, endTime,
+            maxDataPoints=requestContext.get('maxDataPoints'))
+        utils = KairosdbUtils()
+        if plan:
+            # sampled buckets start exactly at the aligned start.
+            start_absolute = utils.graphite_time_to_kairosdb_time(plan.startTime)
+        else:
+            start_absolute = utils.graphite_time_to_kairosdb_time(startTime) - 1000
+        end_absolute = utils.graphite_time_to_kairosdb_time(endTime)
+        if plan:
+            # round the end up to the sampling step, panels asking for the
+            # same series a few seconds apart then share one query.
+            interval_ms = plan.interval * 1000
+            end_absolute += -end_absolute % interval_ms
+        if (KAIROSDB_EXTENT_INDEX is not None) and \
+           (not KAIROSDB_EXTENT_INDEX.has_data((self.kairosdb_uri, self.metric_name), startTime, endTime)):
+            # nothing was ever written in this window, no need to ask.
+            cache_plan = None
+            fetch_start = None
+        else:
+            cache_plan = self.get_cache_plan(plan, start_absolute, end_absolute)
+            fetch_start = start_absolute
+            if cache_plan is not None:
+                fetch_start = cache_plan.fetch_start
+        queries = []
+        if fetch_start is not None:
+            route = KAIROSDB_ROLLUP_ROUTER.route(self.metric_name, plan)
+            for (part_start, part_end, metric) in self.get_query_parts(plan, route, fetch_start, end_absolute):
+                for (chunk_start, chunk_end) in self.split_fetch(plan, part_start, part_end):
+                    key = (self.kairosdb_uri, chunk_start, chunk_end)
+                    queries.append(KAIROSDB_BATCH_FETCHER.submit(key, metric))
 
         def get_data():
-            utils = KairosdbUtils()
-            post_data_obj = {
-                'start_absolute' : utils.graphite_time_to_kairosdb_time(startTime) - 1000,
-                'end_absolute'   : utils.graphite_time_to_kairosdb_time(endTime),
-                'metrics': [{
-                    'tags'          : {},
-                    'name'          : self.metric_name,
-                    'aggregators'   : [ 
-                        #{
-                        #'name'              : 'avg',
-                        #'align_sampling'    : 'true',
-                        #'sampling'          : {
-                        #    'value' : '1',
-                        #    'unit'  : 'minutes'
-                        #    }
-                        #}
-                        ]
-                    }]
-                }
-            post_data = json.dumps(post_data_obj)
-            #log.info("KairosDBReader.fetch(): post data: %s" % (post_data))
-            post_response = utils.post_kairosdb_url(self.kairosdb_uri, 'datapoints/query', data=post_data)
-            if 'errors' in post_response.keys():
-                log.info("KairosDBReader.fetc(): errors found: %s" % (str(post_response)))
-                time_info = startTime, endTime, 1
-                return (time_info, [])
-            values = post_response['queries'][0]['results'][0]['values']
-            values_length = len(values)
-            if values_length == 0:
-                time_info = (startTime, endTime, 1)
-                datapoints = []
-                return (time_info, datapoints)
+            values = None
+            if queries:
+                values = self.join_chunks(wait_all(queries))
+                if KAIROSDB_EXTENT_INDEX is not None:
+                    KAIROSDB_EXTENT_INDEX.observe((self.kairosdb_uri, self.metric_name), values)
+            elif fetch_start is None and cache_plan is None:
+                values = SeriesPoints()
+            if cache_plan is not None and (not queries or values is not None):
+                fetched = None
+                if queries:
+                    fetched = as_series_points(values)
+                    KAIROSDB_DATAPOINT_CACHE.store(cache_plan, fetched)
+                values = cache_plan.assemble(fetched)
+            if plan and values is not None:
+                (time_info, datapoints) = resample_fixed_step(values, plan.startTime, plan.endTime, plan.interval)
             else:
-                if values_length == 1:
-                    time_info = (startTime, endTime, 1)
-                    datapoints = [values[0].value]
-                    return (time_info, datapoints)
-                else:
-                    # 1. Calculate step (in seconds)
-                    #    Step will be lowest time delta between values or 1 (in case if delta is smaller)
-                    step = 1
-                    minDelta = None
-                    for i in range(0, values_length - 2):
-                        (timeI, valueI) = values[i]
-                        (timeIplus1, valueIplus1) = values[i + 1]
-                        timeI = utils.kairosdb_time_to_graphite_time(timeI)
-                        timeIplus1 = utils.kairosdb_time_to_graphite_time(timeIplus1)
-                        delta = timeIplus1 - timeI
-                        if (minDelta == None) or (delta < minDelta):
-                            minDelta = delta
-                    if minDelta > step:
-                        step = minDelta
-                    # 2. Fill time info table
-                    time_info = (startTime, endTime, step)
-                    # 3. Create array of output points
-                    number_points = int(math.ceil((endTime - startTime) / step))
-                    datapoints = [None for i in range(number_points)]
-                    # 4. Fill array of output points
-                    cur_index = 0
-                    cur_value = None
-                    cur_time_stamp = None
-                    cur_value_used = None
-                    for i in range(0, number_points - 1):
-                        data_point_time_stamp = startTime + i * step
-                        (cur_time_stamp, cur_value) = values[cur_index]
-                        cur_time_stamp = utils.kairosdb_time_to_graphite_time(cur_time_stamp)
-                        while cur_index + 1 < values_length:
-                            (next_time_stamp, next_value) = values[cur_index + 1]
-                            next_time_stamp = utils.kairosdb_time_to_graphite_time(next_time_stamp)
-                            if next_time_stamp > data_point_time_stamp:
-                                break
-                            (cur_value, cur_time_stamp, cur_value_used) = (next_value, next_time_stamp, False)
-                            cur_index = cur_index + 1
-                        data_point_value = None
-                        if (not cur_value_used) and (cur_time_stamp <= data_point_time_stamp):
-                            cur_value_used = True
-                            data_point_value = cur_value
-                        datapoints[i] =  data_point_value
-
-                    return (time_info, datapoints)
-
-        # above was all just one def-inside-a-def.  Dont' blame me, this is code-as-found-in-someone-else's-project.
-
-        job = KAIROSDB_REQUEST_POOL.apply_async(get_data)
-        return FetchInProgress(job.get)
+                (time_info, datapoints) = utils.values_to_datapoints(values, startTime, endTime)
+            return (time_info, SERIES_MEMORY.add(datapoints))
+
+        return FetchInProgress(get_data)
 
 
 ###############################################################################
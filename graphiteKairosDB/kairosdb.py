@@ -1,6 +1,5 @@
 import sys, os
 	
-import re
 import requests
 import time
 import math
@@ -14,46 +13,47 @@ from graphite.node import LeafNode, BranchNode
 from graphite.readers import FetchInProgress
 
 import json
+import logging
+from operator import itemgetter
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+from kairosdbBatch import KairosdbBatchFetcher
+from kairosdbResampler import resample_values
+from kairosdbSeries import CompactSeries, SERIES_MEMORY
+from kairosdbHttp import get_http_client
+from kairosdbEndpoints import get_endpoint_pool, parse_urls
+from kairosdbNameTree import KairosNode, KairosTree, KairosRegularNode, build_tree, get_name_tree
+from kairosdbNameIndex import get_name_index
+from kairosdbGlob import compile_glob
+from kairosdbFind import FindWindow
+import kairosdbAsync
+from kairosdbJson import decode_query_response, QueryResponseDecoder, DEFAULT_CHUNK_SIZE
 
 KAIROSDB_MAX_REQUESTS = 10
 KAIROSDB_REQUEST_POOL = ThreadPool(KAIROSDB_MAX_REQUESTS)
+KAIROSDB_BATCH_MAX_METRICS = getattr(settings, 'KAIROSDB_BATCH_MAX_METRICS', 50)
+KAIROSDB_HTTP_CLIENT = get_http_client(
+        pool_size=KAIROSDB_MAX_REQUESTS,
+        connect_timeout=getattr(settings, 'KAIROSDB_CONNECT_TIMEOUT', 5.0),
+        read_timeout=getattr(settings, 'KAIROSDB_READ_TIMEOUT', 15.0),
+        gzip_requests=getattr(settings, 'KAIROSDB_GZIP_REQUESTS', False))
+
+KAIROSDB_ASYNC_ENGINE = None
+if getattr(settings, 'KAIROSDB_FETCH_ENGINE', 'threads') == 'asyncio' and kairosdbAsync.is_available():
+    KAIROSDB_ASYNC_ENGINE = kairosdbAsync.get_async_engine(
+            limit=getattr(settings, 'KAIROSDB_ASYNC_LIMIT', 500),
+            limit_per_host=getattr(settings, 'KAIROSDB_ASYNC_LIMIT_PER_HOST', 100),
+            timeout=getattr(settings, 'KAIROSDB_READ_TIMEOUT', 15.0),
+            logger=logging.getLogger('kairosdb'))
+KAIROSDB_RESPONSE_DECODER = None
+KAIROSDB_ASYNC_DECODER = None
+if getattr(settings, 'KAIROSDB_STREAMING_DECODE', True):
+    KAIROSDB_RESPONSE_DECODER = decode_query_response
+    KAIROSDB_ASYNC_DECODER = QueryResponseDecoder
 
-class KairosNode(object):
-    def __init__(self):
-        self.child_nodes = []
-    
-    #Node is leaf, if it has no child nodes.
-    def isLeaf(self):
-        return len(self.child_nodes) == 0
-    
-    #Add child node to node.
-    def addChildNode(self, node):
-        self.child_nodes.append(node)
-    
-    #Get child node with specified name
-    def getChild(self, name):
-        for node in self.child_nodes:
-            if node.name == name:
-                return node
-        return None
-    
-    def getChildren(self):
-        return self.child_nodes
-
-    
-class KairosTree(KairosNode):
-    pass
-            
-
-class KairosRegularNode(KairosNode):
-    def __init__(self, name):
-        KairosNode.__init__(self)
-        self.name = name
-    
-    def getName(self):
-        return self.name
- 
-                
 class Utils(object):
     def kairosdb_time_to_graphite_time(self, time):
         return time / 1000;
@@ -61,15 +61,54 @@ class Utils(object):
     def graphite_time_to_kairosdb_time(self, time):
         return time * 1000;
     
+    # kairosdb_uri may list several comma separated nodes, see kairosdbEndpoints.
+    def get_endpoints(self, kairosdb_uri):
+        return get_endpoint_pool(kairosdb_uri, client=KAIROSDB_HTTP_CLIENT,
+                hedge_percentile=getattr(settings, 'KAIROSDB_HEDGE_PERCENTILE', 0))
+
     def get_kairosdb_url(self, kairosdb_uri, url):
-        full_url = "%s/%s" % (kairosdb_uri, url)
-        return requests.get(full_url).json()
+        return self.get_endpoints(kairosdb_uri).get(url).json()
 
 
     def post_kairosdb_url(self, kairosdb_uri, url, data):
-        full_url = "%s/%s" % (kairosdb_uri, url)
-        return requests.post(full_url, data).json()
-    
+        return self.get_endpoints(kairosdb_uri).post(url, data).json()
+    
+    def get_query_data(self, key, metrics):
+        (kairosdb_uri, start_absolute, end_absolute) = key
+        post_data_obj = {
+                'start_absolute': start_absolute,
+                'end_absolute': end_absolute,
+                'metrics': metrics
+                }
+        return json.dumps(post_data_obj)
+    
+    # Batch fetcher callback, key is (kairosdb_uri, start_absolute, end_absolute).
+    # The response is decoded as a stream straight into compact arrays, unless
+    # KAIROSDB_STREAMING_DECODE is False.
+    def post_kairosdb_query(self, key, metrics):
+        if KAIROSDB_RESPONSE_DECODER is None:
+            return self.post_kairosdb_url(key[0], 'datapoints/query', self.get_query_data(key, metrics))
+        response = self.get_endpoints(key[0]).post('datapoints/query', self.get_query_data(key, metrics), stream=True)
+        try:
+            return KAIROSDB_RESPONSE_DECODER(response.iter_content(DEFAULT_CHUNK_SIZE))
+        finally:
+            response.close()
+    
+    # Same on the asyncio engine, returns a future of the response.
+    def post_kairosdb_query_async(self, key, metrics):
+        return self.get_endpoints(key[0]).post_json_async(KAIROSDB_ASYNC_ENGINE, 'datapoints/query',
+                self.get_query_data(key, metrics), decoder=KAIROSDB_ASYNC_DECODER)
+    
+
+KAIROSDB_BATCH_FETCHER = KairosdbBatchFetcher(Utils().post_kairosdb_query, KAIROSDB_REQUEST_POOL, max_metrics=KAIROSDB_BATCH_MAX_METRICS, logger=logging.getLogger('kairosdb'),
+        post_query_async=KAIROSDB_ASYNC_ENGINE and Utils().post_kairosdb_query_async)
+
+# Fetch many leaves at once, returns [(time_info, datapoints), ...] in reader order.
+def fetch_multi(readers, startTime, endTime):
+    jobs = [reader.fetch(startTime, endTime) for reader in readers]
+    KAIROSDB_BATCH_FETCHER.flush()
+    return [job.waitForResults() for job in jobs]
+
 
 class KairosdbReader(object):
     __slots__ = ('kairosdb_uri', 'metric_name')
@@ -83,203 +122,116 @@ class KairosdbReader(object):
         return IntervalSet([Interval(0, time.time())])
 
     def fetch(self, startTime, endTime):
+        utils = Utils()
+        
+        # Leaves of one render request are sent together as batched
+        # multi-metric queries on the first waitForResults().
+        key = (
+                self.kairosdb_uri,
+                utils.graphite_time_to_kairosdb_time(startTime) - 1000,
+                utils.graphite_time_to_kairosdb_time(endTime)
+                )
+        query = KAIROSDB_BATCH_FETCHER.submit(key, {
+                     'tags':{}, 
+                     'name': self.metric_name
+                    })
+        
         def get_data():
             
-            utils = Utils()
-            
-            post_data_obj = {
-                    'start_absolute': utils.graphite_time_to_kairosdb_time(startTime) - 1000,
-                    'end_absolute': utils.graphite_time_to_kairosdb_time(endTime),
-                    'metrics': [{
-                                 'tags':{}, 
-                                 'name': self.metric_name
-                                }]
-                    }
-            
-            post_data = json.dumps(post_data_obj)
-            
-            post_response = utils.post_kairosdb_url(self.kairosdb_uri, 'datapoints/query', data=post_data)
+            values = query.wait()
 
-            if 'errors' in post_response.keys():
+            if values is None:
                 time_info = startTime, endTime, 1
-                return (time_info, [])
+                return (time_info, CompactSeries.from_list([]))
             
-            values = post_response['queries'][0]['results'][0]['values']
-            values_length = len(values)
-            
-            if values_length == 0:
-                time_info = (startTime, endTime, 1)
-                datapoints = []
-                return (time_info, datapoints)
-            else:
-                if values_length == 1:
-                    time_info = (startTime, endTime, 1)
-                    datapoints = [values[0].value]
-                    return (time_info, datapoints)
-                else:
-                    
-                    # 1. Calculate step (in seconds)
-                    #    Step will be lowest time delta between values or 1 (in case if delta is smaller)
-                    step = 1
-                    
-                    minDelta = None
-                    
-                    for i in range(0, values_length - 2):
-                        
-                        (timeI, valueI) = values[i]
-                        (timeIplus1, valueIplus1) = values[i + 1]
-                        
-                        timeI = utils.kairosdb_time_to_graphite_time(timeI)
-                        timeIplus1 = utils.kairosdb_time_to_graphite_time(timeIplus1)
-                        
-                        delta = timeIplus1 - timeI
-                        
-                        if (minDelta == None or delta < minDelta):
-                            minDelta = delta
-                    
-                    if minDelta > step:
-                        step = minDelta
-                            
-                    # 2. Fill time info table    
-                    time_info = (startTime, endTime, step)
-                    
-                    # 3. Create array of output points
-                    number_points = int(math.ceil((endTime - startTime) / step))
-                    datapoints = [None for i in range(number_points)]
-                    
-                    # 4. Fill array of output points
-                    cur_index = 0
-                    cur_value = None
-                    cur_time_stamp = None
-                    cur_value_used = None
-                    
-                    for i in range(0, number_points - 1):
-                        
-                        data_point_time_stamp = startTime + i * step
-                        
-                        (cur_time_stamp, cur_value) = values[cur_index]
-                        cur_time_stamp = utils.kairosdb_time_to_graphite_time(cur_time_stamp)
-                        
-                        while (cur_index + 1 < values_length):
-                            (next_time_stamp, next_value) = values[cur_index + 1]
-                            next_time_stamp = utils.kairosdb_time_to_graphite_time(next_time_stamp)
-                            if next_time_stamp > data_point_time_stamp:
-                                break;
-                            (cur_value, cur_time_stamp, cur_value_used) = (next_value, next_time_stamp, False)
-                            cur_index = cur_index + 1
-                            
-                        data_point_value = None
-                        if(not cur_value_used and cur_time_stamp <= data_point_time_stamp):
-                            cur_value_used = True
-                            data_point_value = cur_value
-                        
-                        datapoints[i] =  data_point_value
-        
-                    return (time_info, datapoints)
+            (time_info, datapoints) = resample_values(values, startTime, endTime)
+            return (time_info, SERIES_MEMORY.add(datapoints))
 
-        job = KAIROSDB_REQUEST_POOL.apply_async(get_data)
-
-        return FetchInProgress(job.get)
+        return FetchInProgress(get_data)
     
     
 class KairosdbFinder(object):
     def __init__(self, kairosdb_uri=None):
-        self.kairosdb_uri = settings.KAIROSDB_URL.rstrip('/')
+        self.kairosdb_uri = ','.join(parse_urls(settings.KAIROSDB_URL))
         
     # Fills tree of metrics out from flat list
     # of metrics names, separated by dot value
     def _fill_kairo_tree(self, metric_names):
-        tree = KairosTree()
-        
-        for metric_name in metric_names:
-            name_parts = metric_name.split('.')
-            
-            cur_parent_node = tree
-            cur_node = None
-            
-            for name_part in name_parts:
-                cur_node = cur_parent_node.getChild(name_part)
-                if cur_node == None:
-                    cur_node = KairosRegularNode(name_part)
-                    cur_parent_node.addChildNode(cur_node)
-                cur_parent_node = cur_node
-        
-        return tree
-    
-    
-    def _find_nodes_from_pattern(self, kairosdb_uri, pattern):
-        query_parts = []
-        for part in pattern.split('.'):
-            part = part.replace('*', '.*')
-            part = re.sub(
-                r'{([^{]*)}',
-                lambda x: "(%s)" % x.groups()[0].replace(',', '|'),
-                part,
-            )
-            query_parts.append(part)
-        
-        utils = Utils()
-        
-        #Request for metrics
-        get_metric_names_response = utils.get_kairosdb_url(kairosdb_uri, "metricnames")
-        metric_names = get_metric_names_response["results"]
+        return build_tree(metric_names)
+    
+    # Shared tree of all metric names of kairosdb_uri, refreshed in the background.
+    def _get_name_tree(self, kairosdb_uri):
+        def fetch_names():
+            return Utils().get_kairosdb_url(kairosdb_uri, "metricnames")["results"]
+        return get_name_tree(kairosdb_uri, fetch_names,
+                refresh_seconds=getattr(settings, 'KAIROSDB_NAMES_REFRESH_SECONDS', 300),
+                max_stale_seconds=getattr(settings, 'KAIROSDB_NAMES_MAX_STALE_SECONDS', 3600),
+                prefix_ttl=getattr(settings, 'KAIROSDB_NAMES_PREFIX_TTL', 60),
+                logger=logging.getLogger('kairosdb'))
+    
+    # Memory mapped name index file shared by the workers, when configured.
+    def _get_name_index(self, kairosdb_uri, path):
+        def fetch_names():
+            return Utils().get_kairosdb_url(kairosdb_uri, "metricnames")["results"]
+        return get_name_index(path, fetch_names,
+                refresh_seconds=getattr(settings, 'KAIROSDB_NAMES_REFRESH_SECONDS', 300),
+                logger=logging.getLogger('kairosdb'))
+    
+    # Tree holding the names glob can match: patterns starting with literal
+    # segments only fetch the names under them (metricnames?prefix=).
+    def _get_tree_for(self, kairosdb_uri, glob):
+        index_path = getattr(settings, 'KAIROSDB_NAME_INDEX_PATH', None)
+        if index_path:
+            return self._get_name_index(kairosdb_uri, index_path).get_root()
+        name_tree = self._get_name_tree(kairosdb_uri)
+        literal_prefix = glob.literal_prefix()
+        if not literal_prefix or not name_tree.prefix_ttl:
+            return name_tree.get_tree()
+        prefix = '.'.join(literal_prefix)
+        if len(literal_prefix) < len(glob):
+            prefix += '.'
+        def fetch_prefix(prefix):
+            return Utils().get_kairosdb_url(kairosdb_uri, "metricnames?" + urlencode({'prefix': prefix.encode('utf-8')}))["results"]
+        return name_tree.get_prefix_tree(prefix, fetch_prefix)
+    
+    def _find_nodes_from_pattern(self, kairosdb_uri, pattern, window=None):
+        glob = compile_glob(pattern)
+        metrics_tree = self._get_tree_for(kairosdb_uri, glob)
         
-        #Form tree out of them
-        metrics_tree = self._fill_kairo_tree(metric_names)    
-        
-        for node in self._find_kairosdb_nodes(kairosdb_uri, query_parts, metrics_tree):
-            yield node
-    
-    def _find_kairosdb_nodes(self, kairosdb_uri, query_parts, current_branch, path=''):
-        query_regex = re.compile(query_parts[0])
-        for node, node_data, node_name, node_path in self._get_branch_nodes(kairosdb_uri, current_branch, path):
-            dot_count = node_name.count('.')
-    
-            if dot_count:
-                node_query_regex = re.compile(r'\.'.join(query_parts[:dot_count+1]))
-            else:
-                node_query_regex = query_regex
-    
-            if node_query_regex.match(node_name):
-                if len(query_parts) == 1:
-                    yield node
-                elif not node.is_leaf:
-                    for inner_node in self._find_kairosdb_nodes(
-                        kairosdb_uri,
-                        query_parts[dot_count+1:],
-                        node_data,
-                        node_path,
-                    ):
-                        yield inner_node
-    
-    
-    def _get_branch_nodes(self, kairosdb_uri, input_branch, path):
-        results = input_branch.getChildren()
-        if results:
-            if path:
-                path += '.'
-                
-            branches = [];
-            leaves = [];
-            
-            for item in results:
-                if item.isLeaf():
-                    leaves.append(item)
-                else:
-                    branches.append(item)
-            
-            if (len(branches) != 0):
-                for branch in branches:
-                    node_name = branch.getName()
-                    node_path = path + node_name
-                    yield BranchNode(node_path), branch, node_name, node_path
-            if (len(leaves) != 0):
-                for leaf in leaves:
-                    node_name = leaf.getName()
-                    node_path = path + node_name
-                    reader = KairosdbReader(kairosdb_uri, node_path)
-                    yield LeafNode(node_path, reader), leaf, node_name, node_path
-
+        matches = self._find_kairosdb_nodes(glob.segments, metrics_tree)
+        if window is not None:
+            matches = window.apply(matches)
+        for node_path, is_leaf in matches:
+            yield self._get_graphite_node(kairosdb_uri, node_path, is_leaf)
+    
+    # Walks the tree one pattern segment per level, literal and {a,b}
+    # segments by child lookup, the others by matching the children.
+    # Yields (path, is_leaf) lazily, in sorted order.
+    def _find_kairosdb_nodes(self, segments, current_branch, path=''):
+        if current_branch.children is None:
+            return
+        if path:
+            path += '.'
+        matches = sorted(segments[0].select(current_branch.children), key=itemgetter(0))
+        for node_name, item in matches:
+            node_path = path + node_name
+            if len(segments) == 1:
+                yield node_path, item.isLeaf()
+            elif not item.isLeaf():
+                for inner_node in self._find_kairosdb_nodes(segments[1:], item, node_path):
+                    yield inner_node
+    
+    def _get_graphite_node(self, kairosdb_uri, node_path, is_leaf):
+        if is_leaf:
+            return LeafNode(node_path, KairosdbReader(kairosdb_uri, node_path))
+        return BranchNode(node_path)
+
+    # KAIROSDB_FIND_MAX_RESULTS caps finds, query.offset / query.max_results
+    # page through them; query.truncated tells whether more matches are left.
     def find_nodes(self, query):
-        for node in self._find_nodes_from_pattern(self.kairosdb_uri, query.pattern):
+        window = FindWindow.for_query(query, getattr(settings, 'KAIROSDB_FIND_MAX_RESULTS', 0))
+        for node in self._find_nodes_from_pattern(self.kairosdb_uri, query.pattern, window):
             yield node
+        window.report(query)
+        if window.truncated:
+            logging.getLogger('kairosdb').info("KairosdbFinder.find_nodes(): %s truncated after %d results" % (query.pattern, window.results))
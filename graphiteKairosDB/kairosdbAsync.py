@@ -0,0 +1,209 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Optional asyncio fetch engine.  One event loop runs on a dedicated thread
+# and drives hundreds of concurrent datapoints/query POSTs through aiohttp,
+# callers get a concurrent.futures.Future back and may block on it from any
+# thread.  Written with callbacks rather than async/await so this module
+# still imports (and reports itself unavailable) under python 2.
+
+import json
+import threading
+
+try:
+    import asyncio
+    import concurrent.futures
+    import aiohttp
+except ImportError:
+    asyncio = None
+    aiohttp = None
+
+from mockLogger import MockLogger
+
+################################################################################
+
+DEFAULT_LIMIT          = 500
+DEFAULT_LIMIT_PER_HOST = 100
+DEFAULT_TIMEOUT        = 15.0
+DEFAULT_CHUNK_SIZE     = 64 * 1024
+
+_ENGINE      = None
+_ENGINE_LOCK = threading.Lock()
+
+################################################################################
+
+
+class FetchTimeoutError(Exception):
+    pass
+
+
+def is_available():
+    return (asyncio is not None) and (aiohttp is not None)
+
+
+class KairosdbAsyncEngine(object):
+    '''
+    limit:          requests in flight for the whole process.
+    limit_per_host: requests in flight per kairosdb host.
+    timeout:        seconds before a request is cancelled.
+    chunk_size:     bytes per chunk fed to a response decoder.
+    '''
+    def __init__(self, limit=DEFAULT_LIMIT, limit_per_host=DEFAULT_LIMIT_PER_HOST, timeout=DEFAULT_TIMEOUT,
+                 chunk_size=DEFAULT_CHUNK_SIZE, logger=None):
+        assert is_available(), "KairosdbAsyncEngine needs python 3 with asyncio and aiohttp."
+        self.log            = logger or MockLogger()
+        self.limit          = int(limit)
+        self.limit_per_host = int(limit_per_host)
+        self.timeout        = timeout
+        self.chunk_size     = int(chunk_size)
+        self.in_flight      = 0
+        self.session        = None
+        self.loop           = asyncio.new_event_loop()
+        self.thread         = threading.Thread(target=self._run_loop, name='kairosdb-async-engine')
+        self.thread.daemon  = True
+        started = threading.Event()
+        self.loop.call_soon(self._create_session, started)
+        self.thread.start()
+        started.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def _create_session(self, started):
+        connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+        self.session = aiohttp.ClientSession(connector=connector, headers={'Accept-Encoding': 'gzip'})
+        started.set()
+
+    def post_json(self, url, data, timeout=None, decoder=None):
+        '''
+        POST data to url, returns a concurrent.futures.Future resolving to the
+        decoded json response.  The request is cancelled after timeout.
+        decoder, when given, is called for an object with feed(chunk) and
+        result() (see kairosdbJson.QueryResponseDecoder), which is fed the
+        body chunk by chunk as it arrives instead of json.loads() at the end.
+        '''
+        result = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(self._start_post, url, data, timeout or self.timeout, decoder, result)
+        return result
+
+    def _start_post(self, url, data, timeout, decoder, result):
+        # runs on the loop thread.
+        if not result.set_running_or_notify_cancel():
+            return
+        self.in_flight += 1
+        state = {'step': None, 'response': None, 'timer': None, 'done': False, 'decoder': None, 'chunks': None}
+
+        def finish(value=None, exc=None):
+            if state['done']:
+                return
+            state['done'] = True
+            if state['timer'] is not None:
+                state['timer'].cancel()
+            if state['response'] is not None:
+                state['response'].release()
+            self.in_flight -= 1
+            if exc is not None:
+                result.set_exception(exc)
+            else:
+                result.set_result(value)
+
+        def on_timeout():
+            state['step'].cancel()
+            finish(exc=FetchTimeoutError("kairosdb request timed out after %ss: %s" % (timeout, url)))
+
+        def on_body(step):
+            if step.cancelled():
+                return
+            if step.exception() is not None:
+                return finish(exc=step.exception())
+            try:
+                finish(value=json.loads(step.result().decode('utf-8')))
+            except Exception as e:
+                finish(exc=e)
+
+        def next_chunk():
+            state['step'] = asyncio.ensure_future(state['chunks'].__anext__(), loop=self.loop)
+            state['step'].add_done_callback(on_chunk)
+
+        def on_chunk(step):
+            if step.cancelled():
+                return
+            exc = step.exception()
+            try:
+                if isinstance(exc, StopAsyncIteration):
+                    return finish(value=state['decoder'].result())
+                if exc is not None:
+                    return finish(exc=exc)
+                state['decoder'].feed(step.result())
+            except Exception as e:
+                return finish(exc=e)
+            next_chunk()
+
+        def on_response(step):
+            if step.cancelled():
+                return
+            if step.exception() is not None:
+                return finish(exc=step.exception())
+            state['response'] = step.result()
+            if decoder is None:
+                state['step'] = asyncio.ensure_future(state['response'].read(), loop=self.loop)
+                state['step'].add_done_callback(on_body)
+                return
+            try:
+                state['decoder'] = decoder()
+            except Exception as e:
+                return finish(exc=e)
+            state['chunks'] = state['response'].content.iter_chunked(self.chunk_size)
+            next_chunk()
+
+        state['step'] = asyncio.ensure_future(
+            self.session.post(url, data=data, headers={'Content-Type': 'application/json'}), loop=self.loop)
+        state['step'].add_done_callback(on_response)
+        state['timer'] = self.loop.call_later(timeout, on_timeout)
+
+    def get_stats(self):
+        return {'inFlight': self.in_flight, 'limit': self.limit, 'limitPerHost': self.limit_per_host}
+
+    def close(self):
+        def shutdown():
+            closing = asyncio.ensure_future(self.session.close(), loop=self.loop)
+            closing.add_done_callback(lambda f: self.loop.stop())
+        self.loop.call_soon_threadsafe(shutdown)
+        self.thread.join()
+
+
+def get_async_engine(**options):
+    ''' the process-wide engine, created on first use. '''
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = KairosdbAsyncEngine(**options)
+    return _ENGINE
+
+
+class AsyncChunkJob(object):
+    '''
+    ThreadPool AsyncResult look-alike for one batched query running on the
+    async engine, get() returns the per-metric values lists.
+    '''
+    def __init__(self, batcher, future, metrics):
+        self.batcher = batcher
+        self.future  = future
+        self.metrics = metrics
+        self._values = None
+        self._lock   = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._values is None:
+                try:
+                    response = self.future.result()
+                except Exception as e:
+                    self.batcher.log.info("AsyncChunkJob.get(): EXCEPTION: %s, #metrics: %d" % (e, len(self.metrics)))
+                    response = None
+                self._values = self.batcher.split_response(response, self.metrics)
+        return self._values
+
+################################################################################
+################################################################################
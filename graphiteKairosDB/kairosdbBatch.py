@@ -0,0 +1,210 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Batching of datapoints/query requests.  Readers submit one metric each, the
+# first reader that waits for its result flushes every pending metric with the
+# same key (kairosdb url and time window) as a few multi-metric queries.
+#
+# Identical submits (same key and same metric entry) are coalesced: while a
+# query for it is pending or in flight, later submits get the same handle and
+# share its result instead of adding another metric to kairosdb's work.
+
+import json
+import threading
+import traceback
+
+from counterStats import CounterStats
+from mockLogger import MockLogger
+from kairosdbAsync import AsyncChunkJob
+
+################################################################################
+
+DEFAULT_MAX_METRICS_PER_QUERY = 50
+
+################################################################################
+
+
+def split_time_range(start_ms, end_ms, chunk_ms, align_ms=1):
+    '''
+    Split [start_ms, end_ms] (both inclusive) at multiples of chunk_ms,
+    rounded down to a multiple of align_ms.  Returns [(start, end), ...].
+    A window no longer than chunk_ms is left whole, even when it crosses a
+    multiple of it.
+    '''
+    chunk_ms -= chunk_ms % align_ms
+    if (chunk_ms <= 0) or (end_ms - start_ms < chunk_ms):
+        return [(start_ms, end_ms)]
+    ret = []
+    while start_ms <= end_ms:
+        boundary = (start_ms // chunk_ms + 1) * chunk_ms
+        ret.append((start_ms, min(boundary - 1, end_ms)))
+        start_ms = boundary
+    return ret
+
+
+def wait_all(queries):
+    ''' send every query that is not sent yet, then collect the results. '''
+    keys = set(q.key for q in queries if q.job is None)
+    for key in keys:
+        queries[0].batcher.flush(key)
+    return [q.wait() for q in queries]
+
+
+class PendingQuery(object):
+    '''
+    Handle for one metric submitted to a KairosdbBatchFetcher.
+    wait() returns the raw 'values' list of that metric or None on error.
+    Coalesced submits share one handle, the result must not be modified.
+    '''
+    __slots__ = ('batcher', 'key', 'metric', 'flight', 'job', 'index')
+
+    def __init__(self, batcher, key, metric, flight=None):
+        self.batcher = batcher
+        self.key     = key
+        self.metric  = metric
+        self.flight  = flight
+        self.job     = None
+        self.index   = None
+
+    def wait(self):
+        if self.job is None:
+            self.batcher.flush(self.key)
+        return self.job.get()[self.index]
+
+
+class PoolChunkJob(object):
+    '''
+    One batched query running on the fetcher's ThreadPool, get() returns the
+    per-metric values lists.  Coalesced readers all wait on the same job,
+    python 2's AsyncResult only wakes one of several waiting threads.
+    '''
+    def __init__(self, batcher, key, metrics, chunk):
+        self._values = None
+        self._done   = threading.Event()
+        batcher.pool.apply_async(self._run, (batcher, key, metrics, chunk))
+
+    def _run(self, batcher, key, metrics, chunk):
+        try:
+            self._values = batcher._run_chunk(key, metrics)
+        finally:
+            batcher._land(chunk)
+            self._done.set()
+
+    def get(self):
+        self._done.wait()
+        return self._values
+
+
+class KairosdbBatchFetcher(object):
+    '''
+    Groups metric entries by key and sends them in chunks of at most
+    max_metrics entries.  The key is opaque to the fetcher, readers use
+    (kairosdb_uri, start_absolute, end_absolute).
+
+    post_query(key, metrics) must return the decoded datapoints/query
+    response for the given list of metric entries, it runs on pool.
+    post_query_async(key, metrics), when given, is used instead and must
+    return a future of that response (see kairosdbAsync).
+    '''
+    def __init__(self, post_query, pool, max_metrics=DEFAULT_MAX_METRICS_PER_QUERY, logger=None, post_query_async=None):
+        self.log         = logger or MockLogger()
+        self.post_query  = post_query
+        self.pool        = pool
+        self.post_query_async = post_query_async
+        self.max_metrics = max(1, int(max_metrics))
+        self._pending    = {}   # key -> [PendingQuery, ...]
+        self._flights    = {}   # (key, metric json) -> PendingQuery not finished yet
+        self._lock       = threading.RLock()   # a done future runs _land() right away
+        self.stats       = CounterStats(names=['submitted', 'coalesced', 'queries'])
+        self.stats.setAllNonRate()
+
+    def submit(self, key, metric):
+        flight = (key, json.dumps(metric, sort_keys=True))
+        with self._lock:
+            self.stats.submitted += 1
+            query = self._flights.get(flight)
+            if query is not None:
+                self.stats.coalesced += 1
+                return query
+            query = PendingQuery(self, key, metric, flight)
+            self._flights[flight] = query
+            pending = self._pending.setdefault(key, [])
+            pending.append(query)
+            if len(pending) >= self.max_metrics:
+                # full batch, no reason to wait for more readers.
+                self._dispatch(key)
+        return query
+
+    def flush(self, key=None):
+        with self._lock:
+            keys = [key] if key is not None else list(self._pending.keys())
+            for k in keys:
+                self._dispatch(k)
+
+    def fetch_many(self, key, metrics):
+        queries = [self.submit(key, m) for m in metrics]
+        self.flush(key)
+        return [q.wait() for q in queries]
+
+    def _dispatch(self, key):
+        # caller holds self._lock
+        pending = self._pending.pop(key, None)
+        if not pending:
+            return
+        for offset in range(0, len(pending), self.max_metrics):
+            chunk = pending[offset:offset + self.max_metrics]
+            metrics = [q.metric for q in chunk]
+            job = self._start_chunk(key, metrics, chunk)
+            for (index, query) in enumerate(chunk):
+                query.job   = job
+                query.index = index
+
+    def _start_chunk(self, key, metrics, chunk):
+        self.stats.queries += 1
+        if self.post_query_async is not None:
+            future = self.post_query_async(key, metrics)
+            future.add_done_callback(lambda f: self._land(chunk))
+            return AsyncChunkJob(self, future, metrics)
+        return PoolChunkJob(self, key, metrics, chunk)
+
+    def _land(self, chunk):
+        ''' the chunk's result is available, later submits start a new query. '''
+        with self._lock:
+            for query in chunk:
+                if self._flights.get(query.flight) is query:
+                    del self._flights[query.flight]
+
+    def _run_chunk(self, key, metrics):
+        try:
+            response = self.post_query(key, metrics)
+        except Exception as e:
+            self.log.info("KairosdbBatchFetcher._run_chunk(): EXCEPTION: %s, tb: %s, #metrics: %d" % (e, traceback.format_exc(), len(metrics)))
+            return [None] * len(metrics)
+        return self.split_response(response, metrics)
+
+    def split_response(self, response, metrics):
+        ''' returns one 'values' list per requested metric, in request order. '''
+        if (not response) or ('errors' in response):
+            self.log.info("KairosdbBatchFetcher.split_response(): errors found: %s" % (str(response)))
+            return [None] * len(metrics)
+        queries = response.get('queries', [])
+        ret = []
+        for index in range(len(metrics)):
+            values = None
+            try:
+                values = queries[index]['results'][0]['values']
+            except (IndexError, KeyError, TypeError):
+                self.log.info("KairosdbBatchFetcher.split_response(): no result for metric: %s" % (metrics[index].get('name')))
+            ret.append(values)
+        return ret
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret['inFlight'] = len(self._flights)
+        return ret
+
+    def reset_stats(self):
+        self.stats.resetNonRate()
+
+################################################################################
+################################################################################
@@ -0,0 +1,199 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Datapoint cache in front of KairosdbReader.fetch().  Raw points are kept per
+# series in aligned time blocks.  A repeated request is answered from the
+# blocks and only the tail that may still change is fetched again from
+# kairosdb, then merged back in.
+#
+# A block is "settled" once all of its data was older than late_write_seconds
+# when it was fetched; settled blocks never expire, they only get evicted.
+# Other blocks are served as-is for recent_ttl seconds, after that the part
+# newer than (fetch time - late_write_seconds) is fetched again.
+
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+from counterStats import CounterStats
+from kairosdbResampler import SeriesPoints, TIMESTAMP_TYPECODE
+
+################################################################################
+
+DEFAULT_BLOCK_SECONDS      = 3600
+DEFAULT_RECENT_TTL         = 0
+DEFAULT_LATE_WRITE_SECONDS = 300
+DEFAULT_MAX_POINTS         = 2 * 1000 * 1000
+
+################################################################################
+
+
+class CacheBlock(object):
+    __slots__ = ('timestamps', 'values', 'filled_from', 'filled_until', 'fetched_at')
+
+    def __init__(self, timestamps, values, filled_from, filled_until, fetched_at):
+        self.timestamps   = timestamps     # ms, sorted
+        self.values       = values
+        self.filled_from  = filled_from    # ms, data complete in [filled_from, filled_until[
+        self.filled_until = filled_until
+        self.fetched_at   = fetched_at     # ms
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+class CachePlan(object):
+    '''
+    Result of KairosdbDatapointCache.plan_fetch().  fetch_start is None on a
+    full hit, else points from fetch_start to end_ms must be fetched and
+    passed to assemble() / KairosdbDatapointCache.store().
+    '''
+    __slots__ = ('series_key', 'start_ms', 'end_ms', 'fetch_start', 'blocks')
+
+    def __init__(self, series_key, start_ms, end_ms, fetch_start, blocks):
+        self.series_key  = series_key
+        self.start_ms    = start_ms
+        self.end_ms      = end_ms
+        self.fetch_start = fetch_start
+        self.blocks      = blocks       # snapshot of cached blocks before fetch_start
+
+    def assemble(self, fetched=None):
+        ''' cached points before fetch_start + fetched points, as SeriesPoints. '''
+        cut = self.fetch_start if self.fetch_start is not None else self.end_ms + 1
+        timestamps = array(TIMESTAMP_TYPECODE)
+        values = array('d')
+        for block in self.blocks:
+            lo = bisect_left(block.timestamps, self.start_ms)
+            hi = bisect_left(block.timestamps, min(cut, self.end_ms + 1))
+            timestamps.extend(block.timestamps[lo:hi])
+            values.extend(block.values[lo:hi])
+        if fetched is not None:
+            lo = bisect_left(fetched.timestamps, max(cut, self.start_ms))
+            timestamps.extend(fetched.timestamps[lo:])
+            values.extend(fetched.values[lo:])
+        return SeriesPoints(timestamps, values)
+
+
+class KairosdbDatapointCache(object):
+    '''
+    block_seconds:      size of the aligned time blocks.
+    recent_ttl:         seconds an unsettled block is served without refetch.
+    late_write_seconds: how late points may still arrive in kairosdb.
+    max_points:         bound on points held, least recently used blocks go first.
+    '''
+    def __init__(self, block_seconds=DEFAULT_BLOCK_SECONDS, recent_ttl=DEFAULT_RECENT_TTL,
+                 late_write_seconds=DEFAULT_LATE_WRITE_SECONDS, max_points=DEFAULT_MAX_POINTS):
+        self.block_ms   = int(block_seconds) * 1000
+        self.recent_ms  = int(recent_ttl * 1000)
+        self.late_ms    = int(late_write_seconds) * 1000
+        self.max_points = int(max_points)
+        self.num_points = 0
+        self._blocks    = OrderedDict()     # (series_key, block index) -> CacheBlock
+        self._lock      = threading.Lock()
+        self.stats      = CounterStats(names=['hits', 'partialHits', 'misses', 'evictions', 'pointsFetched'])
+        self.stats.setAllNonRate()
+
+    def nowMs(self):
+        return int(time.time() * 1000)
+
+    def is_settled(self, block):
+        return block.filled_until <= block.fetched_at - self.late_ms
+
+    def plan_fetch(self, series_key, start_ms, end_ms, align_ms=60000):
+        '''
+        Decide what has to come from kairosdb for [start_ms, end_ms].  Fetch
+        starts are aligned down to align_ms so that series refreshed together
+        end up in the same batched query.
+        '''
+        now = self.nowMs()
+        snapshot = []
+        fetch_start = None
+        with self._lock:
+            for index in range(start_ms // self.block_ms, end_ms // self.block_ms + 1):
+                block_start = index * self.block_ms
+                want_from = max(start_ms, block_start)
+                want_until = min(end_ms + 1, block_start + self.block_ms)
+                block = self._blocks.get((series_key, index))
+                if (block is None) or (block.filled_from > want_from):
+                    fetch_start = want_from
+                    break
+                self._blocks[(series_key, index)] = self._blocks.pop((series_key, index))   # LRU touch
+                snapshot.append(block)
+                if block.filled_until < want_until:
+                    fetch_start = max(want_from, min(block.filled_until, block.fetched_at - self.late_ms))
+                    break
+                if self.is_settled(block) or (now - block.fetched_at < self.recent_ms):
+                    continue
+                fetch_start = max(want_from, block.fetched_at - self.late_ms)
+                break
+        if fetch_start is None:
+            self.stats.hits += 1
+        elif fetch_start <= start_ms:
+            self.stats.misses += 1
+            fetch_start = start_ms
+            snapshot = []
+        else:
+            self.stats.partialHits += 1
+            fetch_start = max(fetch_start - fetch_start % align_ms, start_ms)
+        return CachePlan(series_key, start_ms, end_ms, fetch_start, snapshot)
+
+    def store(self, plan, fetched):
+        ''' merge points fetched for plan into the blocks they fall in. '''
+        if plan.fetch_start is None:
+            return
+        now = self.nowMs()
+        self.stats.pointsFetched += len(fetched)
+        fetch_start = plan.fetch_start
+        with self._lock:
+            for index in range(fetch_start // self.block_ms, plan.end_ms // self.block_ms + 1):
+                block_start = index * self.block_ms
+                block_end = block_start + self.block_ms
+                lo = bisect_left(fetched.timestamps, max(block_start, fetch_start))
+                hi = bisect_left(fetched.timestamps, block_end)
+                timestamps = fetched.timestamps[lo:hi]
+                values = fetched.values[lo:hi]
+                filled_from = max(block_start, fetch_start)
+                filled_until = min(block_end, plan.end_ms + 1)
+                fetched_at = now
+                old = self._blocks.pop((plan.series_key, index), None)
+                if old is not None:
+                    self.num_points -= len(old)
+                    if old.filled_from <= filled_from <= old.filled_until:
+                        keep = bisect_left(old.timestamps, fetch_start)
+                        timestamps = old.timestamps[:keep] + timestamps
+                        values = old.values[:keep] + values
+                        filled_from = old.filled_from
+                    if filled_from <= old.filled_from <= filled_until < old.filled_until:
+                        # a shorter request, keep the points cached past it.  The
+                        # block is only as fresh as that older tail.
+                        keep = bisect_left(old.timestamps, filled_until)
+                        timestamps = timestamps + old.timestamps[keep:]
+                        values = values + old.values[keep:]
+                        filled_until = old.filled_until
+                        fetched_at = min(now, old.fetched_at)
+                block = CacheBlock(timestamps, values, filled_from, filled_until, fetched_at)
+                self._blocks[(plan.series_key, index)] = block
+                self.num_points += len(block)
+            self._evict()
+
+    def _evict(self):
+        # caller holds self._lock
+        while self.num_points > self.max_points and self._blocks:
+            (key, block) = self._blocks.popitem(last=False)
+            self.num_points -= len(block)
+            self.stats.evictions += 1
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret.update({'blocks': len(self._blocks), 'points': self.num_points})
+        return ret
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.num_points = 0
+
+################################################################################
+################################################################################
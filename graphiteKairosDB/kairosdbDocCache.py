@@ -0,0 +1,140 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Document cache behind MetricType: least recently used entries are evicted
+# once either the entry count or the approximate bytes held go over their
+# bound.  Names known not to exist are kept as negative entries for a short
+# while, so repeated lookups of missing names do not each go to cassandra.
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from counterStats import CounterStats
+
+################################################################################
+
+DEFAULT_MAX_ENTRIES  = 10 * 1000 * 1000
+DEFAULT_MAX_BYTES    = 2 * 1024 * 1024 * 1024
+DEFAULT_NEGATIVE_TTL = 60
+
+# bytes charged for an entry on top of its document: key and table slot.
+ENTRY_OVERHEAD = 100
+
+################################################################################
+
+
+class Missing(object):
+    ''' get() result for a name known not to exist. '''
+    def __nonzero__(self):
+        return False
+    __bool__ = __nonzero__
+
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = Missing()
+
+
+def doc_nbytes(doc):
+    ''' approximate memory of a metrictype document and its child list. '''
+    ret = sys.getsizeof(doc)
+    if isinstance(doc, dict):
+        for value in doc.values():
+            ret += sys.getsizeof(value)
+            if isinstance(value, (list, tuple, set, frozenset)):
+                for item in value:
+                    ret += sys.getsizeof(item)
+    return ret
+
+
+class DocCache(object):
+    '''
+    max_entries:  entries kept at most, 0 for no bound.
+    max_bytes:    approximate bytes kept at most, 0 for no bound.
+    negative_ttl: seconds a missing name is remembered, 0 to not.
+    '''
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.max_entries  = max_entries
+        self.max_bytes    = max_bytes
+        self.negative_ttl = negative_ttl
+        self.nbytes       = 0
+        self._entries     = OrderedDict()   # name -> (doc, nbytes, expiry), expiry only for MISSING
+        self._lock        = threading.Lock()
+        self.stats        = CounterStats(names=['hits', 'negativeHits', 'misses', 'puts', 'negativePuts',
+            'evictions', 'expired'])
+        self.stats.setAllNonRate()
+
+    def get(self, name, default=None):
+        ''' the document, MISSING for a name known not to exist, else default. '''
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is None:
+                self.stats.misses += 1
+                return default
+            (doc, nbytes, expiry) = entry
+            if (expiry is not None) and (expiry < time.time()):
+                self.nbytes -= nbytes
+                self.stats.expired += 1
+                self.stats.misses += 1
+                return default
+            self._entries[name] = entry
+            if doc is MISSING:
+                self.stats.negativeHits += 1
+            else:
+                self.stats.hits += 1
+            return doc
+
+    def put(self, name, doc):
+        if doc is None:
+            self.invalidate(name)
+            return
+        self.stats.puts += 1
+        self._store(name, (doc, doc_nbytes(doc) + ENTRY_OVERHEAD, None))
+
+    def put_missing(self, name):
+        if not self.negative_ttl:
+            return
+        self.stats.negativePuts += 1
+        self._store(name, (MISSING, ENTRY_OVERHEAD, time.time() + self.negative_ttl))
+
+    def _store(self, name, entry):
+        with self._lock:
+            old = self._entries.pop(name, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._entries[name] = entry
+            self.nbytes += entry[1]
+            while self._entries and ((self.max_entries and len(self._entries) > self.max_entries) or
+                                     (self.max_bytes and self.nbytes > self.max_bytes)):
+                (evicted, old) = self._entries.popitem(last=False)
+                self.nbytes -= old[1]
+                self.stats.evictions += 1
+
+    def invalidate(self, name):
+        with self._lock:
+            old = self._entries.pop(name, None)
+            if old is not None:
+                self.nbytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret.update({'entries': len(self._entries), 'bytes': self.nbytes})
+        return ret
+
+    def reset_stats(self):
+        self.stats.resetNonRate()
+
+################################################################################
+################################################################################
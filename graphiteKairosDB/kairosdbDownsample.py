@@ -0,0 +1,178 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Chooses a kairosdb sampling aggregator so that a fetch returns roughly as
+# many points as graphite is going to draw, instead of every raw point.
+# KairosdbRollupRouter sends the older part of such a fetch to pre-aggregated
+# rollup series when they exist.
+
+import fnmatch
+import re
+import time
+
+################################################################################
+
+# Sampling intervals are rounded up to one of these, in seconds, so that
+# buckets land on stable boundaries across refreshes.
+NICE_INTERVALS = (
+    1, 2, 5, 10, 15, 30,
+    60, 2*60, 5*60, 10*60, 15*60, 30*60,
+    3600, 2*3600, 3*3600, 6*3600, 12*3600,
+    86400, 7*86400,
+)
+
+# aggregator to apply on a rollup written with the plan's aggregator.
+ROLLUP_REAGGREGATORS = {
+    'count'     : 'sum',
+}
+
+SAMPLING_UNITS = (
+    ('weeks',   7*86400),
+    ('days',    86400),
+    ('hours',   3600),
+    ('minutes', 60),
+    ('seconds', 1),
+)
+
+################################################################################
+
+
+class DownsamplePlan(object):
+    __slots__ = ('aggregator', 'interval', 'startTime', 'endTime')
+
+    def __init__(self, aggregator, interval, startTime, endTime):
+        self.aggregator = aggregator
+        self.interval   = interval
+        self.startTime  = startTime   # aligned down to a multiple of interval
+        self.endTime    = endTime
+
+    def get_aggregator_query(self):
+        (value, unit) = sampling_value_and_unit(self.interval)
+        return {
+            'name'      : self.aggregator,
+            'sampling'  : {
+                'value' : value,
+                'unit'  : unit,
+                }
+            }
+
+    def __repr__(self):
+        return "<DownsamplePlan %s %ss %s-%s>" % (self.aggregator, self.interval, self.startTime, self.endTime)
+
+
+def sampling_value_and_unit(interval):
+    for (unit, seconds) in SAMPLING_UNITS:
+        if interval % seconds == 0:
+            return (interval // seconds, unit)
+    return (interval, 'seconds')
+
+
+def nice_interval(seconds):
+    for interval in NICE_INTERVALS:
+        if interval >= seconds:
+            return interval
+    # beyond a week, whole days.
+    return int(-(-seconds // 86400)) * 86400
+
+
+class KairosdbDownsampler(object):
+    '''
+    target_points:      points wanted per series, 0 disables downsampling
+                        unless the request carries maxDataPoints.
+    rules:              [(metric glob, aggregator), ...], first match wins.
+    default_aggregator: used when no rule matches.
+    min_interval:       below this sampling interval raw points are fetched.
+    '''
+    def __init__(self, target_points=0, rules=(), default_aggregator='avg', min_interval=10):
+        self.target_points      = int(target_points or 0)
+        self.default_aggregator = default_aggregator
+        self.min_interval       = int(min_interval)
+        self.rules              = [(re.compile(fnmatch.translate(glob)), aggregator) for (glob, aggregator) in rules]
+
+    def choose_aggregator(self, metric_name):
+        for (regex, aggregator) in self.rules:
+            if regex.match(metric_name):
+                return aggregator
+        return self.default_aggregator
+
+    def choose_interval(self, startTime, endTime, target_points):
+        if (not target_points) or (endTime <= startTime):
+            return None
+        wanted = -(-(endTime - startTime) // int(target_points))
+        interval = nice_interval(wanted)
+        if interval < self.min_interval:
+            return None
+        return interval
+
+    def plan(self, metric_name, startTime, endTime, maxDataPoints=None):
+        ''' returns a DownsamplePlan or None to fetch raw data. '''
+        target_points = maxDataPoints or self.target_points
+        interval = self.choose_interval(startTime, endTime, target_points)
+        if not interval:
+            return None
+        aligned_start = startTime - (startTime % interval)
+        return DownsamplePlan(self.choose_aggregator(metric_name), interval, aligned_start, endTime)
+
+################################################################################
+
+
+class RollupRoute(object):
+    '''
+    Fetch [plan start, boundary[ from the rollup series metric_name (with
+    tags), the rest raw.  boundary is in seconds, on the plan's grid.
+    '''
+    __slots__ = ('metric_name', 'tags', 'interval', 'boundary')
+
+    def __init__(self, metric_name, tags, interval, boundary):
+        self.metric_name = metric_name
+        self.tags        = tags
+        self.interval    = interval
+        self.boundary    = boundary
+
+    def get_metric_query(self, plan):
+        aggregator = ROLLUP_REAGGREGATORS.get(plan.aggregator, plan.aggregator)
+        query = DownsamplePlan(aggregator, plan.interval, plan.startTime, plan.endTime).get_aggregator_query()
+        return {
+            'tags'          : dict(self.tags),
+            'name'          : self.metric_name,
+            'aggregators'   : [query],
+            }
+
+    def __repr__(self):
+        return "<RollupRoute %s %ss until %s>" % (self.metric_name, self.interval, self.boundary)
+
+
+class KairosdbRollupRouter(object):
+    '''
+    rollups: [(interval, lag, name format[, tags]), ...]
+        interval:    seconds per rollup point.
+        lag:         seconds before data is rolled up, newer data is read raw.
+        name format: rollup series name, % formatted with a dict holding
+                     'metric' and 'aggregator', e.g. '%(metric)s.1m.%(aggregator)s'.
+        tags:        optional tags selecting the rollup, e.g. {'rollup': ['1m']}.
+    '''
+    def __init__(self, rollups=()):
+        self.rollups = sorted([tuple(r) + ({},) * (4 - len(r)) for r in rollups], reverse=True, key=lambda r: r[0])
+
+    def route(self, metric_name, plan, now=None):
+        '''
+        coarsest rollup the plan's interval is a multiple of and that holds
+        some of the window, or None.
+        '''
+        if not plan:
+            return None
+        if now is None:
+            now = time.time()
+        for (interval, lag, name_format, tags) in self.rollups:
+            if plan.interval % interval:
+                continue
+            boundary = int(now - lag)
+            boundary -= boundary % plan.interval
+            if boundary <= plan.startTime:
+                continue        # the whole window is too recent for it, a finer one may lag less.
+            name = name_format % {'metric': metric_name, 'aggregator': plan.aggregator}
+            return RollupRoute(name, tags, interval, boundary)
+        return None
+
+################################################################################
+################################################################################
@@ -0,0 +1,279 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Several kairosdb nodes behind one logical KAIROSDB_URL.  Requests go to the
+# healthy node with the fewest requests outstanding; a node that fails or
+# answers 5xx is taken out for a growing back-off and the request is retried
+# on the next node.  Optionally a request that is slower than a percentile of
+# recent latencies is hedged: the same request goes to a second node and the
+# first response wins.  Only useful for idempotent requests, which all
+# kairosdb reads are.
+
+import random
+import threading
+import time
+from collections import deque
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from counterStats import CounterStats
+from kairosdbHttp import get_http_client
+
+################################################################################
+
+DEFAULT_BACKOFF         = 1.0
+DEFAULT_MAX_BACKOFF     = 60.0
+DEFAULT_HEDGE_MIN_DELAY = 0.05
+LATENCY_WINDOW          = 1000
+HEDGE_MIN_SAMPLES       = 50
+
+_POOLS      = {}
+_POOLS_LOCK = threading.Lock()
+
+################################################################################
+
+
+class EndpointError(Exception):
+    ''' the node answered, but with a server error. '''
+    def __init__(self, response):
+        Exception.__init__(self, "kairosdb answered %s: %s" % (response.status_code, response.url))
+        self.response = response
+
+
+class KairosdbEndpoint(object):
+    __slots__ = ('url', 'outstanding', 'failures', 'down_until', 'requests', 'errors')
+
+    def __init__(self, url):
+        self.url         = url.rstrip('/')
+        self.outstanding = 0
+        self.failures    = 0        # consecutive
+        self.down_until  = 0.0
+        self.requests    = 0
+        self.errors      = 0
+
+    def is_up(self, now):
+        return self.down_until <= now
+
+    def get_stats(self):
+        return {'outstanding': self.outstanding, 'failures': self.failures, 'up': self.is_up(time.time()),
+                'requests': self.requests, 'errors': self.errors}
+
+
+class KairosdbEndpointPool(object):
+    '''
+    urls:             kairosdb base urls serving the same data.
+    client:           KairosdbHttpClient the requests go through.
+    backoff:          seconds a failed node is left out, doubling per
+                      consecutive failure up to max_backoff.
+    hedge_percentile: e.g. 95, hedge requests slower than this percentile of
+                      recent latencies (at least hedge_min_delay).  None or 0
+                      disables hedging.
+    '''
+    def __init__(self, urls, client=None, backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 hedge_percentile=None, hedge_min_delay=DEFAULT_HEDGE_MIN_DELAY):
+        assert urls, "KairosdbEndpointPool needs at least one url."
+        self.endpoints        = [KairosdbEndpoint(url) for url in urls]
+        self.client           = client or get_http_client()
+        self.backoff          = backoff
+        self.max_backoff      = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay  = hedge_min_delay
+        self.latencies        = deque(maxlen=LATENCY_WINDOW)
+        self._hedge_delay     = None
+        self._lock            = threading.Lock()
+        self.stats            = CounterStats(names=['requests', 'failovers', 'errors', 'hedges', 'hedgeWins'])
+        self.stats.setAllNonRate()
+
+    def choose(self, exclude=()):
+        ''' healthy endpoint with the fewest outstanding requests, marked busy. '''
+        now = time.time()
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            up = [e for e in candidates if e.is_up(now)]
+            if up:
+                fewest = min(e.outstanding for e in up)
+                endpoint = random.choice([e for e in up if e.outstanding == fewest])
+            else:
+                # everything is down, try the one that comes back first.
+                endpoint = min(candidates, key=lambda e: e.down_until)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        return endpoint
+
+    def release(self, endpoint, latency=None, failed=False):
+        with self._lock:
+            endpoint.outstanding -= 1
+            if failed:
+                endpoint.errors += 1
+                endpoint.failures += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (endpoint.failures - 1))
+                endpoint.down_until = time.time() + delay
+            else:
+                endpoint.failures = 0
+                endpoint.down_until = 0.0
+                if latency is not None:
+                    self.latencies.append(latency)
+                    self._hedge_delay = None
+
+    def hedge_delay(self):
+        ''' seconds before a request is hedged, None while hedging is off. '''
+        if not self.hedge_percentile or len(self.endpoints) < 2:
+            return None
+        with self._lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            if self._hedge_delay is None:
+                ordered = sorted(self.latencies)
+                index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100.0))
+                self._hedge_delay = max(self.hedge_min_delay, ordered[index])
+            return self._hedge_delay
+
+    def _attempt(self, endpoint, method, path, kwargs):
+        ''' one request on endpoint, returns the response or raises. '''
+        tstart = time.time()
+        try:
+            response = self.client.request(method, "%s/%s" % (endpoint.url, path.lstrip('/')), **kwargs)
+        except Exception:
+            self.release(endpoint, failed=True)
+            raise
+        if response.status_code >= 500:
+            self.release(endpoint, failed=True)
+            response.close()
+            raise EndpointError(response)
+        self.release(endpoint, latency=time.time() - tstart)
+        return response
+
+    def request(self, method, path, **kwargs):
+        '''
+        Send method path to the pool, kwargs as for KairosdbHttpClient.request().
+        Fails over to the other nodes, raises the last error when all failed.
+        '''
+        self.stats.requests += 1
+        tried = []
+        error = None
+        while True:
+            endpoint = self.choose(exclude=tried)
+            if endpoint is None:
+                self.stats.errors += 1
+                raise error
+            if tried:
+                self.stats.failovers += 1
+            tried.append(endpoint)
+            try:
+                delay = self.hedge_delay()
+                if delay is None:
+                    return self._attempt(endpoint, method, path, kwargs)
+                return self._hedged(endpoint, delay, method, path, kwargs, tried)
+            except Exception as e:
+                error = e
+
+    def _hedged(self, endpoint, delay, method, path, kwargs, tried):
+        results = Queue()
+
+        def run(endpoint, hedge):
+            try:
+                results.put((True, self._attempt(endpoint, method, path, kwargs), hedge))
+            except Exception as e:
+                results.put((False, e, hedge))
+
+        self._start(run, endpoint, False)
+        running = 1
+        try:
+            outcome = results.get(timeout=delay)
+        except Empty:
+            outcome = None
+            second = self.choose(exclude=tried)
+            if second is not None:
+                tried.append(second)
+                self.stats.hedges += 1
+                self._start(run, second, True)
+                running += 1
+        while True:
+            if outcome is None:
+                outcome = results.get()
+            running -= 1
+            (ok, value, hedge) = outcome
+            if ok:
+                if hedge:
+                    self.stats.hedgeWins += 1
+                if running:
+                    self._start(self._discard, results)
+                return value
+            if not running:
+                raise value
+            outcome = None
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _discard(self, results):
+        ''' close the response of the request that lost the race. '''
+        (ok, value, hedge) = results.get()
+        if ok:
+            value.close()
+
+    def post_json_async(self, engine, path, data, decoder=None, on_done=None):
+        '''
+        POST through a kairosdbAsync engine on the least busy node, returns
+        its future.  No failover or hedging on this path.  on_done(url,
+        future), when given, is called with the node's url once it is done.
+        '''
+        self.stats.requests += 1
+        endpoint = self.choose()
+        tstart = time.time()
+        future = engine.post_json("%s/%s" % (endpoint.url, path.lstrip('/')), data, decoder=decoder)
+
+        def done(future):
+            self.release(endpoint, latency=time.time() - tstart, failed=(future.exception() is not None))
+            if on_done is not None:
+                on_done(endpoint.url, future)
+
+        future.add_done_callback(done)
+        return future
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, data, **kwargs):
+        return self.request('POST', path, data=data, **kwargs)
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret['hedgeDelay'] = self.hedge_delay()
+        ret['endpoints'] = dict((e.url, e.get_stats()) for e in self.endpoints)
+        return ret
+
+    def reset_stats(self):
+        self.stats.resetNonRate()
+
+################################################################################
+
+
+def parse_urls(urls):
+    ''' KAIROSDB_URL as a list of urls, from a list or a comma separated string. '''
+    if isinstance(urls, (list, tuple)):
+        return [u.strip().rstrip('/') for u in urls]
+    return [u.strip().rstrip('/') for u in urls.split(',') if u.strip()]
+
+
+def get_endpoint_pool(kairosdb_uri, **options):
+    '''
+    The pool for a logical kairosdb uri: one or more comma separated urls.
+    Created on first use, options only apply then.
+    '''
+    with _POOLS_LOCK:
+        pool = _POOLS.get(kairosdb_uri)
+        if pool is None:
+            pool = KairosdbEndpointPool(parse_urls(kairosdb_uri), **options)
+            _POOLS[kairosdb_uri] = pool
+    return pool
+
+################################################################################
+################################################################################
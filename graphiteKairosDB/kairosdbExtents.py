@@ -0,0 +1,246 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Per-metric data extents (first and last datapoint) behind
+# KairosdbReader.get_intervals().  Extents are looked up without blocking:
+# unknown or expired metrics are queued and a refresher thread asks kairosdb
+# for their oldest and newest point (order asc/desc, limit 1), many metrics
+# per datapoints/query.  Fetch results move the last point forward in between.
+#
+# kairosdb reads every row (three weeks of one series) in the query window,
+# even with a limit, so the window is what a lookup costs.  The oldest point
+# is only looked for once per metric, back to max_age (default: the epoch);
+# expired extents only ask for the newest point since the previous lookup.
+
+import threading
+import time
+from collections import OrderedDict
+
+from counterStats import CounterStats
+from mockLogger import MockLogger
+from kairosdbResampler import as_series_points
+
+################################################################################
+
+DEFAULT_TTL          = 3600
+DEFAULT_LIVE_SECONDS = 3600
+DEFAULT_MAX_AGE      = 0
+DEFAULT_MAX_METRICS  = 50
+DEFAULT_MAX_ENTRIES  = 1000 * 1000
+
+################################################################################
+
+
+class MetricExtent(object):
+    '''
+    first, last: seconds of the oldest and newest datapoint, None when the
+    metric had no data at all.  checked_at: seconds, when kairosdb was asked.
+    '''
+    __slots__ = ('first', 'last', 'checked_at')
+
+    def __init__(self, first, last, checked_at):
+        self.first      = first
+        self.last       = last
+        self.checked_at = checked_at
+
+    def __repr__(self):
+        return "<MetricExtent %s-%s checked %s>" % (self.first, self.last, self.checked_at)
+
+
+class KairosdbExtentIndex(object):
+    '''
+    post_query(key, metrics): same callback as the batch fetcher, key is
+                  (kairosdb_uri, start_absolute, end_absolute).
+    ttl:          seconds before an extent is asked for again.
+    live_seconds: a metric with a point this recent is taken to be still
+                  written to, its interval runs until now.
+    max_age:      seconds back the oldest point is looked for, 0 for all time.
+    '''
+    def __init__(self, post_query, ttl=DEFAULT_TTL, live_seconds=DEFAULT_LIVE_SECONDS, max_age=DEFAULT_MAX_AGE,
+                 max_metrics=DEFAULT_MAX_METRICS, max_entries=DEFAULT_MAX_ENTRIES, logger=None):
+        self.log          = logger or MockLogger()
+        self.post_query   = post_query
+        self.ttl          = ttl
+        self.live_seconds = live_seconds
+        self.max_age      = max_age
+        self.max_metrics  = max(1, int(max_metrics))
+        self.max_entries  = int(max_entries)
+        self._extents     = OrderedDict()   # (kairosdb_uri, metric_name) -> MetricExtent
+        self._wanted      = OrderedDict()   # keys queued for the refresher
+        self._lock        = threading.Lock()
+        self._wakeup      = threading.Event()
+        self._thread      = None
+        self.stats        = CounterStats(names=['hits', 'misses', 'refreshed', 'queries', 'errors', 'skippedFetches'])
+        self.stats.setAllNonRate()
+
+    def get(self, key, now=None):
+        ''' the known extent or None, queues a refresh when missing or expired. '''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            extent = self._extents.get(key)
+            if extent is not None:
+                self._extents[key] = self._extents.pop(key)   # LRU touch
+            if (extent is None) or (now - extent.checked_at >= self.ttl):
+                self._wanted[key] = True
+                self._start_refresher()
+        if extent is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return extent
+
+    def get_intervals(self, key, now=None):
+        ''' [(start, end)] in seconds, [] for no data, None when unknown. '''
+        if now is None:
+            now = time.time()
+        extent = self.get(key, now)
+        if extent is None:
+            return None
+        if extent.first is None:
+            return []
+        if extent.last >= extent.checked_at - self.live_seconds:
+            return [(extent.first, max(now, extent.last + 1))]
+        return [(extent.first, extent.last + 1)]
+
+    def has_data(self, key, startTime, endTime, now=None):
+        '''
+        False when the extent says there is nothing in the window.  A metric
+        that was not live when last checked is taken to stay that way until
+        the next refresh, at most ttl seconds later.
+        '''
+        extent = self.get(key, now)
+        if extent is None:
+            return True
+        if extent.first is None:
+            ret = False
+        elif extent.last >= extent.checked_at - self.live_seconds:
+            ret = endTime >= extent.first
+        else:
+            ret = (endTime >= extent.first) and (startTime <= extent.last)
+        if not ret:
+            self.stats.skippedFetches += 1
+        return ret
+
+    def observe(self, key, values):
+        ''' move first/last with the points of a fetch result. '''
+        if not values:
+            return
+        values = as_series_points(values)
+        first = values.timestamps[0] // 1000
+        last = values.timestamps[-1] // 1000
+        with self._lock:
+            extent = self._extents.get(key)
+            if extent is None:
+                return
+            if extent.first is None:
+                extent.first, extent.last = first, last
+            else:
+                extent.first = min(extent.first, first)
+                extent.last = max(extent.last, last)
+
+    def _start_refresher(self):
+        # caller holds self._lock
+        self._wakeup.set()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='kairosdb-extent-refresher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                with self._lock:
+                    keys = list(self._wanted.keys())[:self.max_metrics]
+                    for key in keys:
+                        del self._wanted[key]
+                if not keys:
+                    break
+                try:
+                    self.refresh(keys)
+                except Exception as e:
+                    self.stats.errors += 1
+                    self.log.info("KairosdbExtentIndex._run(): EXCEPTION: %s, #metrics: %d" % (e, len(keys)))
+
+    def refresh(self, keys, now=None):
+        ''' ask kairosdb for the extents of keys, per kairosdb uri. '''
+        if now is None:
+            now = time.time()
+        oldest_start = 0
+        if self.max_age:
+            oldest_start = max(0, int(now - self.max_age))
+        unknown = {}    # kairosdb_uri -> [(metric_name, None), ...]
+        known = {}      # kairosdb_uri -> [(metric_name, extent), ...]
+        with self._lock:
+            for (kairosdb_uri, metric_name) in keys:
+                extent = self._extents.get((kairosdb_uri, metric_name))
+                if (extent is None) or (extent.first is None):
+                    unknown.setdefault(kairosdb_uri, []).append((metric_name, None))
+                else:
+                    known.setdefault(kairosdb_uri, []).append((metric_name, extent))
+        for (kairosdb_uri, entries) in unknown.items():
+            self._probe(kairosdb_uri, entries, oldest_start, now)
+        for (kairosdb_uri, entries) in known.items():
+            # points written a little late still land in the window.
+            start = min(extent.checked_at for (name, extent) in entries) - self.live_seconds
+            self._probe(kairosdb_uri, entries, max(oldest_start, int(start)), now)
+
+    def _probe(self, kairosdb_uri, entries, start, now):
+        '''
+        One datapoints/query from start to now: the newest point of every
+        metric, the oldest one too where the extent is None.
+        '''
+        metrics = []
+        for (name, extent) in entries:
+            if extent is None:
+                metrics.append({'tags': {}, 'name': name, 'order': 'asc', 'limit': 1})
+            metrics.append({'tags': {}, 'name': name, 'order': 'desc', 'limit': 1})
+        self.stats.queries += 1
+        response = self.post_query((kairosdb_uri, start * 1000, int(now) * 1000), metrics)
+        if (not response) or ('errors' in response):
+            self.stats.errors += 1
+            self.log.info("KairosdbExtentIndex.refresh(): errors found: %s" % (str(response)))
+            return
+        queries = response.get('queries', [])
+        index = 0
+        for (name, extent) in entries:
+            oldest_index = None
+            if extent is None:
+                oldest_index = index
+                index += 1
+            newest_index = index
+            index += 1
+            try:
+                newest = as_series_points(queries[newest_index]['results'][0]['values'])
+                if oldest_index is not None:
+                    oldest = as_series_points(queries[oldest_index]['results'][0]['values'])
+            except (IndexError, KeyError, TypeError):
+                continue
+            if extent is not None:
+                last = extent.last
+                if len(newest):
+                    last = max(last, newest.timestamps[-1] // 1000)
+                extent = MetricExtent(extent.first, last, now)
+            elif len(oldest) and len(newest):
+                extent = MetricExtent(oldest.timestamps[0] // 1000, newest.timestamps[-1] // 1000, now)
+            else:
+                extent = MetricExtent(None, None, now)
+            self._store((kairosdb_uri, name), extent)
+
+    def _store(self, key, extent):
+        with self._lock:
+            self._extents.pop(key, None)
+            self._extents[key] = extent
+            while len(self._extents) > self.max_entries:
+                self._extents.popitem(last=False)
+        self.stats.refreshed += 1
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret.update({'metrics': len(self._extents), 'queued': len(self._wanted)})
+        return ret
+
+################################################################################
+################################################################################
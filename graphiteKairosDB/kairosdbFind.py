@@ -0,0 +1,87 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Capped, paginated finds.  The finders produce their matches lazily in
+# sorted order and FindWindow takes a page of them: offset matches are
+# skipped, at most max_results are passed on, and the traversal is not
+# pulled any further once the page is full and one more match showed that
+# the result is truncated.  Graphite nodes are only built for the page.
+
+from counterStats import CounterStats
+
+################################################################################
+
+FIND_STATS = CounterStats(names=['finds', 'truncated', 'skipped', 'results'])
+FIND_STATS.setAllNonRate()
+
+################################################################################
+
+
+class FindWindow(object):
+    '''
+    offset:      matches skipped before the first result.
+    max_results: results passed on at most, None or 0 for all of them.
+    After apply() is exhausted, truncated tells whether matches were left.
+    '''
+    __slots__ = ('offset', 'max_results', 'truncated', 'results')
+
+    def __init__(self, offset=0, max_results=None):
+        self.offset      = max(0, int(offset or 0))
+        self.max_results = max_results and int(max_results)
+        self.truncated   = False
+        self.results     = 0
+
+    @classmethod
+    def for_query(cls, query, max_results=None):
+        '''
+        The window of a graphite FindQuery: query.offset and
+        query.max_results when the caller set them, else the finder default.
+        '''
+        return cls(getattr(query, 'offset', 0), getattr(query, 'max_results', None) or max_results)
+
+    def is_limited(self):
+        return bool(self.offset or self.max_results)
+
+    def apply(self, matches):
+        ''' the matches of this page, stops iterating matches when it is full. '''
+        FIND_STATS.finds += 1
+        skip = self.offset
+        for match in matches:
+            if skip:
+                skip -= 1
+                FIND_STATS.skipped += 1
+                continue
+            if self.max_results and self.results >= self.max_results:
+                self.truncated = True
+                FIND_STATS.truncated += 1
+                break
+            self.results += 1
+            FIND_STATS.results += 1
+            yield match
+
+    def record(self, results, truncated):
+        ''' a page that was cut elsewhere, e.g. by the name service. '''
+        FIND_STATS.finds += 1
+        FIND_STATS.results += results
+        FIND_STATS.truncated += bool(truncated)
+        self.results = results
+        self.truncated = truncated
+
+    def report(self, query):
+        '''
+        Tells the caller of find_nodes() about the page: sets
+        query.truncated and query.next_offset (None at the end).
+        '''
+        query.truncated = self.truncated
+        query.next_offset = self.truncated and self.offset + self.results or None
+
+
+def get_find_stats():
+    return dict(FIND_STATS)
+
+
+def reset_find_stats():
+    FIND_STATS.resetNonRate()
+
+################################################################################
+################################################################################
@@ -0,0 +1,303 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Graphite glob patterns compiled once into per-level matchers.  Each dot
+# separated segment is classified so the tree walk only falls back to a
+# regex over all children when it has to:
+#   literal   cpu             dict lookup
+#   set       {cpu,mem}       dict lookups (braces of literals only)
+#   prefix    cpu*            str.startswith, '*' alone matches everything
+#   suffix    *.count part    str.endswith
+#   general   c?u[0-9]*       compiled regex
+# Compiled patterns are kept in a small LRU cache, find patterns repeat a
+# lot (dashboards, autocomplete).
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from counterStats import CounterStats
+
+################################################################################
+
+GLOB_CHARS = '*?[]{}'
+
+DEFAULT_CACHE_SIZE = 1024
+
+################################################################################
+
+
+def has_wildcards(text):
+    for c in GLOB_CHARS:
+        if c in text:
+            return True
+    return False
+
+
+def split_pattern(pattern):
+    ''' split on dots outside of {..} and [..]. '''
+    parts = []
+    depth = 0
+    start = 0
+    for (index, c) in enumerate(pattern):
+        if c in '{[':
+            depth += 1
+        elif c in '}]' and depth:
+            depth -= 1
+        elif c == '.' and not depth:
+            parts.append(pattern[start:index])
+            start = index + 1
+    parts.append(pattern[start:])
+    return parts
+
+
+def matching_brace(segment, start):
+    ''' index of the '}' closing the '{' at start, -1 when unbalanced. '''
+    depth = 0
+    for index in range(start, len(segment)):
+        if segment[index] == '{':
+            depth += 1
+        elif segment[index] == '}':
+            depth -= 1
+            if not depth:
+                return index
+    return -1
+
+
+def expand_braces(segment):
+    ''' 'a{b,c}d' -> ['abd', 'acd'], nested braces included. '''
+    start = segment.find('{')
+    if start < 0:
+        return [segment]
+    index = matching_brace(segment, start)
+    if index < 0:
+        return [segment]    # unbalanced, taken literally by the regex
+    inner = segment[start + 1:index]
+    options = []
+    depth = 0
+    begin = 0
+    for (i, c) in enumerate(inner):
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+        elif c == ',' and not depth:
+            options.append(inner[begin:i])
+            begin = i + 1
+    options.append(inner[begin:])
+    ret = []
+    for option in options:
+        ret.extend(expand_braces(segment[:start] + option + segment[index + 1:]))
+    return ret
+
+
+def glob_to_regex(segment):
+    ''' regex source matching a whole name for one glob segment. '''
+    out = []
+    index = 0
+    while index < len(segment):
+        c = segment[index]
+        index += 1
+        if c == '*':
+            out.append('.*')
+        elif c == '?':
+            out.append('.')
+        elif c == '[':
+            end = segment.find(']', index + 1 if segment[index:index + 1] in ('!', '^') else index)
+            if end < 0:
+                out.append(re.escape(c))
+                continue
+            body = segment[index:end]
+            index = end + 1
+            if body[:1] in ('!', '^'):
+                body = '^' + body[1:]
+            out.append('[%s]' % body.replace('\\', '\\\\'))
+        elif c == '{':
+            end = matching_brace(segment, index - 1)
+            if end < 0:
+                out.append(re.escape(c))
+                continue
+            options = expand_braces(segment[index - 1:end + 1])
+            out.append('(?:%s)' % '|'.join(glob_to_regex(o) for o in options))
+            index = end + 1
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
+
+
+class GlobSegment(object):
+    __slots__ = ('pattern', 'kind', 'literals', 'affix', 'regex')
+
+    def __init__(self, pattern):
+        self.pattern  = pattern
+        self.literals = None
+        self.affix    = None
+        self.regex    = None
+        options = expand_braces(pattern) if '{' in pattern else [pattern]
+        if not any(has_wildcards(o) for o in options):
+            self.kind = 'literal' if len(options) == 1 else 'set'
+            self.literals = list(OrderedDict.fromkeys(options))
+        elif len(options) == 1 and pattern.count('*') == 1 and not has_wildcards(pattern.replace('*', '')):
+            if pattern.endswith('*'):
+                self.kind  = 'prefix'
+                self.affix = pattern[:-1]
+            elif pattern.startswith('*'):
+                self.kind  = 'suffix'
+                self.affix = pattern[1:]
+            else:
+                self.kind  = 'general'
+        else:
+            self.kind = 'general'
+        if self.kind == 'general':
+            self.regex = re.compile('(?:%s)\\Z' % '|'.join(glob_to_regex(o) for o in options), re.DOTALL)
+
+    def match(self, name):
+        kind = self.kind
+        if kind == 'prefix':
+            return name.startswith(self.affix)
+        if kind == 'suffix':
+            return name.endswith(self.affix)
+        if kind == 'general':
+            return self.regex.match(name) is not None
+        return name in self.literals
+
+    def select(self, children):
+        '''
+        (name, child) pairs of children (a dict name -> child) matching this
+        segment, by lookup for literal and set segments.
+        '''
+        if self.literals is not None:
+            return [(name, children[name]) for name in self.literals if name in children]
+        affix = self.affix
+        if self.kind == 'prefix':
+            if not affix:
+                return list(children.items())
+            return [(name, child) for (name, child) in children.items() if name.startswith(affix)]
+        if self.kind == 'suffix':
+            return [(name, child) for (name, child) in children.items() if name.endswith(affix)]
+        match = self.regex.match
+        return [(name, child) for (name, child) in children.items() if match(name) is not None]
+
+    def filter(self, names):
+        ''' the names matching this segment, in order. '''
+        if self.kind == 'prefix' and not self.affix:
+            return list(names)
+        match = self.match
+        return [name for name in names if match(name)]
+
+    def __repr__(self):
+        return "<GlobSegment %s %r>" % (self.kind, self.pattern)
+
+
+class GlobPattern(object):
+    __slots__ = ('pattern', 'segments')
+
+    def __init__(self, pattern):
+        self.pattern  = pattern
+        self.segments = [GlobSegment(part) for part in split_pattern(pattern)]
+
+    def literal_prefix(self):
+        ''' the leading literal segments, as a list of names. '''
+        ret = []
+        for segment in self.segments:
+            if segment.kind != 'literal':
+                break
+            ret.append(segment.literals[0])
+        return ret
+
+    def match(self, name):
+        parts = name.split('.')
+        if len(parts) != len(self.segments):
+            return False
+        for (segment, part) in zip(self.segments, parts):
+            if not segment.match(part):
+                return False
+        return True
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __repr__(self):
+        return "<GlobPattern %r %s>" % (self.pattern, [s.kind for s in self.segments])
+
+################################################################################
+
+
+class GlobCache(object):
+    ''' LRU cache of compiled GlobPattern / GlobSegment objects. '''
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock    = threading.Lock()
+        self.stats    = CounterStats(names=['hits', 'misses'])
+        self.stats.setAllNonRate()
+
+    def get(self, key, factory):
+        with self._lock:
+            ret = self._entries.pop(key, None)
+            if ret is not None:
+                self._entries[key] = ret
+                self.stats.hits += 1
+                return ret
+        self.stats.misses += 1
+        ret = factory(key[1])
+        with self._lock:
+            self._entries[key] = ret
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return ret
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret['size'] = len(self._entries)
+        return ret
+
+
+GLOB_CACHE = GlobCache()
+
+
+def compile_glob(pattern):
+    ''' the compiled GlobPattern of a dotted graphite pattern, cached. '''
+    return GLOB_CACHE.get(('pattern', pattern), GlobPattern)
+
+
+def compile_segment(segment):
+    ''' the compiled GlobSegment of one level of a pattern, cached. '''
+    return GLOB_CACHE.get(('segment', segment), GlobSegment)
+
+################################################################################
+
+
+def benchmark(names=100000, repeat=5):
+    '''
+    Matched names per second of each segment kind against the regex the
+    finder compiled per level before, over a flat level of names children.
+    '''
+    kinds = ['cpu', 'mem', 'disk', 'net', 'load']
+    children = dict(('%s%d' % (kinds[i % len(kinds)], i), None) for i in range(names))
+    ret = {}
+    for pattern in ['cpu15', '{cpu15,mem16,net18}', 'cpu1*', '*7', 'c?u[0-4]*', '*']:
+        segment = compile_segment(pattern)
+        regex = re.compile(pattern.replace('*', '.*').replace('?', '.') + '\\Z')
+        tstart = time.time()
+        for i in range(repeat):
+            found = len(segment.select(children))
+        compiled = time.time() - tstart
+        tstart = time.time()
+        for i in range(repeat):
+            [name for name in children if regex.match(name)]
+        regexed = time.time() - tstart
+        ret[pattern] = {'kind': segment.kind, 'found': found,
+                        'namesPerSecond': names * repeat / max(compiled, 1e-9),
+                        'regexNamesPerSecond': names * repeat / max(regexed, 1e-9)}
+    return ret
+
+
+if __name__ == '__main__':
+    for (pattern, result) in sorted(benchmark().items()):
+        print("%-20s %-8s found %6d  %12.0f names/s  regex %12.0f names/s" % (
+            pattern, result['kind'], result['found'], result['namesPerSecond'], result['regexNamesPerSecond']))
+
+################################################################################
+################################################################################
@@ -0,0 +1,171 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Process-wide HTTP client for the kairosdb REST API.  One requests.Session
+# with keep-alive connection pools per host instead of a new TCP connection
+# for every requests.get()/requests.post().
+
+import gzip
+import io
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from counterStats import CounterStats
+
+################################################################################
+
+DEFAULT_POOL_SIZE       = 10
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT    = 15.0
+DEFAULT_GZIP_MIN_BYTES  = 1024
+
+_CLIENTS      = {}
+_CLIENTS_LOCK = threading.Lock()
+
+################################################################################
+
+
+class KairosdbHttpClient(object):
+    '''
+    pool_size:       connections kept per kairosdb host, also the number of
+                     requests allowed in flight per host.  Should match the
+                     fetch concurrency.
+    gzip_requests:   gzip request bodies of at least gzip_min_bytes.
+                     Responses are always requested gzipped.
+    '''
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, gzip_requests=False, gzip_min_bytes=DEFAULT_GZIP_MIN_BYTES):
+        self.pool_size      = int(pool_size)
+        self.timeout        = (connect_timeout, read_timeout)
+        self.gzip_requests  = gzip_requests
+        self.gzip_min_bytes = gzip_min_bytes
+        self.session        = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip'})
+        self.adapter        = HTTPAdapter(pool_connections=DEFAULT_POOL_SIZE, pool_maxsize=self.pool_size, pool_block=True)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self._host_slots    = {}
+        self._lock          = threading.Lock()
+        self.stats          = CounterStats(names=['requests', 'errors', 'waits', 'waitSeconds', 'bytesSent', 'gzippedRequests'])
+        self.stats.setAllNonRate()
+
+    def _get_slots(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            slots = self._host_slots.get(host)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.pool_size)
+                self._host_slots[host] = slots
+        return slots
+
+    def request(self, method, url, data=None, headers=None, stream=False, timeout=None):
+        '''
+        With stream=True the connection stays busy until the body is read, so
+        the host slot is held until the response is closed: callers must
+        close() streamed responses.
+        '''
+        headers = dict(headers or {})
+        if data is not None:
+            headers.setdefault('Content-Type', 'application/json')
+            if self.gzip_requests and len(data) >= self.gzip_min_bytes:
+                data = gzip_bytes(data)
+                headers['Content-Encoding'] = 'gzip'
+                self.stats.gzippedRequests += 1
+            self.stats.bytesSent += len(data)
+        slots = self._get_slots(url)
+        if not slots.acquire(False):
+            # every pooled connection to this host is busy.
+            self.stats.waits += 1
+            tstart = time.time()
+            slots.acquire()
+            self.stats.waitSeconds += time.time() - tstart
+        try:
+            self.stats.requests += 1
+            response = self.session.request(method, url, data=data, headers=headers, stream=stream, timeout=timeout or self.timeout)
+        except Exception:
+            self.stats.errors += 1
+            slots.release()
+            raise
+        if stream:
+            release_on_close(response, slots)
+        else:
+            slots.release()
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def get_pool_stats(self):
+        ''' connections opened vs requests served, from the urllib3 pools. '''
+        connections = 0
+        pooled_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections     += pool.num_connections
+            pooled_requests += pool.num_requests
+        reuse_ratio = 0.0
+        if pooled_requests:
+            reuse_ratio = 1.0 - float(connections) / pooled_requests
+        return {'connections': connections, 'pooledRequests': pooled_requests, 'reuseRatio': reuse_ratio}
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret.update(self.get_pool_stats())
+        return ret
+
+    def reset_stats(self):
+        self.stats.resetNonRate()
+
+################################################################################
+
+
+def release_on_close(response, slots):
+    ''' release slots the first time response is closed. '''
+    close = response.close
+    once = threading.Lock()
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            if once.acquire(False):
+                slots.release()
+
+    response.close = close_and_release
+
+
+def gzip_bytes(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+        gz.write(data)
+    return buf.getvalue()
+
+
+def get_http_client(**options):
+    ''' one shared client per distinct set of options, per process. '''
+    key = tuple(sorted(options.items()))
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = KairosdbHttpClient(**options)
+            _CLIENTS[key] = client
+    return client
+
+################################################################################
+################################################################################
@@ -0,0 +1,159 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Streaming decoder for datapoints/query responses.  Only the parts the
+# readers use are extracted: queries[i].results[0].values, written straight
+# into SeriesPoints arrays chunk by chunk.  Peak memory is the output arrays
+# plus one chunk, not the json text plus a python list per point.
+#
+# The result has the shape of the json response so the existing response
+# handling keeps working:
+#   {'queries': [{'results': [{'values': SeriesPoints}]}, ...]}
+# Error responses ({"errors": [...]}) are small and decoded with json.
+
+import json
+import re
+from array import array
+
+from kairosdbResampler import SeriesPoints, TIMESTAMP_TYPECODE, NAN
+
+################################################################################
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+QUERIES_RE    = re.compile(br'"queries"\s*:\s*\[')
+KEY_RE        = re.compile(br'"(results|values|tags)"\s*:\s*[\[{]')
+TAGS_TOKEN_RE = re.compile(br'"(?:[^"\\]|\\.)*"|"|\}')
+PAIR_RE       = re.compile(br'\[\s*(-?\d+)\s*,\s*([^\]\s]+)\s*\]')
+VALUES_END_RE = re.compile(br'\]\s*\]')
+
+# keys may be split across chunks, keep this much of an unmatched buffer.
+KEEP_TAIL = 32
+
+################################################################################
+
+
+def to_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return NAN   # null, or a non numeric kairosdb type.
+
+
+class QueryResponseDecoder(object):
+    '''
+    Incremental decoder, feed() bytes as they arrive then call result().
+    '''
+    def __init__(self):
+        self.buf      = b''
+        self.state    = 'head'
+        self.queries  = []
+        self.current  = None        # SeriesPoints being filled
+        self.skipping = False       # values of results[1:], not used
+
+    def feed(self, chunk):
+        self.buf += chunk
+        while self._step():
+            pass
+
+    def _step(self):
+        ''' returns True while progress can be made on the buffer. '''
+        buf = self.buf
+        if self.state == 'head':
+            m = QUERIES_RE.search(buf)
+            if not m:
+                return False
+            self.state = 'scan'
+            self.buf = buf[m.end():]
+            return True
+        if self.state == 'scan':
+            m = KEY_RE.search(buf)
+            if not m:
+                self.buf = buf[-KEEP_TAIL:]
+                return False
+            self.buf = buf[m.end():]
+            if m.group(1) == b'results':
+                self.queries.append({'results': []})
+                return True
+            if m.group(1) == b'tags':
+                # tag names are free text, a tag called "values" must not
+                # be taken for the datapoints.
+                self.state = 'tags'
+                return True
+            results = self.queries[-1]['results'] if self.queries else []
+            self.skipping = bool(results)
+            self.current = SeriesPoints()
+            if not self.skipping:
+                results.append({'values': self.current})
+            self.state = 'values'
+            return True
+        if self.state == 'tags':
+            for token in TAGS_TOKEN_RE.finditer(buf):
+                if token.group() == b'"':
+                    return False    # string not complete yet.
+                if token.group() == b'}':
+                    self.buf = buf[token.end():]
+                    self.state = 'scan'
+                    return True
+            return False
+        # self.state == 'values'
+        stripped = buf.lstrip()
+        if not stripped:
+            self.buf = stripped
+            return False
+        if stripped[:1] == b']':
+            # empty values array.
+            self.buf = stripped[1:]
+            self.state = 'scan'
+            return True
+        m = VALUES_END_RE.search(buf)
+        if m:
+            self._add_pairs(buf[:m.start() + 1])
+            self.buf = buf[m.end():]
+            self.state = 'scan'
+            return True
+        last = buf.rfind(b']')
+        if last >= 0:
+            self._add_pairs(buf[:last + 1])
+            self.buf = buf[last + 1:]
+        return False
+
+    def _add_pairs(self, text):
+        if self.skipping:
+            return
+        pairs = PAIR_RE.findall(text)
+        self.current.timestamps.extend(array(TIMESTAMP_TYPECODE, [int(t) for (t, v) in pairs]))
+        self.current.values.extend(array('d', [to_float(v) for (t, v) in pairs]))
+
+    def result(self):
+        if self.state == 'head':
+            # no "queries" key, most likely {"errors": [...]}.
+            return json.loads(self.buf.decode('utf-8'))
+        return {'queries': self.queries}
+
+
+class JsonBodyDecoder(object):
+    '''
+    QueryResponseDecoder's feed()/result() around json.loads() of the whole
+    body, for when KAIROSDB_STREAMING_DECODE is off.
+    '''
+    def __init__(self):
+        self.chunks = []
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+
+    def result(self):
+        return json.loads(b''.join(self.chunks).decode('utf-8'))
+
+
+def decode_query_response(chunks):
+    ''' decode an iterable of response byte chunks. '''
+    decoder = QueryResponseDecoder()
+    for chunk in chunks:
+        if chunk:
+            decoder.feed(chunk)
+    return decoder.result()
+
+################################################################################
+################################################################################
@@ -0,0 +1,207 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# In-memory instrumentation of kairosdb requests: per node latency histograms,
+# bytes in/out, datapoints and decode time, plus a sampled log of slow
+# queries.  Replaces logging every request; dump() / reset() expose it.
+
+import json
+import random
+import threading
+import time
+from collections import deque
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from counterStats import CounterStats
+from mockLogger import MockLogger
+
+################################################################################
+
+# upper bounds of the latency buckets, in milliseconds.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+DEFAULT_SLOW_SECONDS = 5.0
+DEFAULT_SLOW_SAMPLE  = 1.0
+DEFAULT_SLOW_KEEP    = 100
+
+################################################################################
+
+
+class LatencyHistogram(object):
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count  = 0
+        self.total  = 0.0
+        self.max    = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000.0
+        index = 0
+        while index < len(LATENCY_BUCKETS_MS) and ms > LATENCY_BUCKETS_MS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        ''' upper bound in seconds of the bucket holding percentile p. '''
+        if not self.count:
+            return None
+        wanted = self.count * p / 100.0
+        seen = 0
+        for (index, count) in enumerate(self.counts):
+            seen += count
+            if seen >= wanted and count:
+                if index < len(LATENCY_BUCKETS_MS):
+                    return min(LATENCY_BUCKETS_MS[index] / 1000.0, self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        buckets = {}
+        for (index, count) in enumerate(self.counts):
+            if count:
+                bound = LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else 'inf'
+                buckets['le%s' % bound] = count
+        return {
+            'count'   : self.count,
+            'avg'     : self.count and self.total / self.count,
+            'max'     : self.max,
+            'p50'     : self.percentile(50),
+            'p95'     : self.percentile(95),
+            'p99'     : self.percentile(99),
+            'buckets' : buckets,
+            }
+
+
+class EndpointMetrics(object):
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.stats   = CounterStats(names=['requests', 'errors', 'bytesOut', 'bytesIn', 'points', 'decodeSeconds'])
+        self.stats.setAllNonRate()
+
+    def to_dict(self):
+        ret = dict(self.stats)
+        ret['latency'] = self.latency.to_dict()
+        return ret
+
+
+def describe_query(data):
+    ''' metric names and window of a datapoints/query body, for the slow log. '''
+    try:
+        query = json.loads(data)
+        names = [m.get('name') for m in query.get('metrics', [])]
+        return {'start_absolute': query.get('start_absolute'), 'end_absolute': query.get('end_absolute'),
+                'metrics': len(names), 'names': names[:10]}
+    except Exception:
+        return {'body': (data or '')[:200]}
+
+
+class KairosdbRequestMetrics(object):
+    '''
+    slow_seconds: requests at least this slow go to the slow query log.
+    slow_sample:  fraction of slow requests logged, 0 to 1.
+    slow_keep:    recent slow queries kept for dump().
+    '''
+    def __init__(self, slow_seconds=DEFAULT_SLOW_SECONDS, slow_sample=DEFAULT_SLOW_SAMPLE,
+                 slow_keep=DEFAULT_SLOW_KEEP, logger=None):
+        self.log          = logger or MockLogger()
+        self.slow_seconds = slow_seconds
+        self.slow_sample  = slow_sample
+        self.slow_queries = deque(maxlen=slow_keep)
+        self._endpoints   = {}
+        self._lock        = threading.Lock()
+
+    def record(self, endpoint, path, seconds, bytes_out=0, bytes_in=0, points=0, decode_seconds=0.0, error=None, data=None):
+        with self._lock:
+            metrics = self._endpoints.get(endpoint)
+            if metrics is None:
+                metrics = self._endpoints[endpoint] = EndpointMetrics()
+            metrics.stats.requests += 1
+            if error is not None:
+                metrics.stats.errors += 1
+            metrics.stats.bytesOut += bytes_out
+            metrics.stats.bytesIn += bytes_in
+            metrics.stats.points += points
+            metrics.stats.decodeSeconds += decode_seconds
+            metrics.latency.observe(seconds)
+        if (seconds >= self.slow_seconds) and (random.random() < self.slow_sample):
+            entry = {'time': time.time(), 'endpoint': endpoint, 'path': path, 'seconds': seconds,
+                     'bytesIn': bytes_in, 'points': points, 'error': error and str(error)}
+            if data is not None:
+                entry['query'] = describe_query(data)
+            self.slow_queries.append(entry)
+            self.log.info("KairosdbRequestMetrics: slow query: %s" % (json.dumps(entry)))
+
+    def dump(self):
+        with self._lock:
+            endpoints = dict((endpoint, m.to_dict()) for (endpoint, m) in self._endpoints.items())
+        return {'endpoints': endpoints, 'slowQueries': list(self.slow_queries)}
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self.slow_queries.clear()
+
+################################################################################
+
+
+def endpoint_of(url):
+    ''' scheme://host:port of a request url, the node that served it. '''
+    parts = urlparse(url)
+    return "%s://%s" % (parts.scheme, parts.netloc)
+
+
+def count_points(response):
+    ''' datapoints in a decoded datapoints/query response. '''
+    points = 0
+    try:
+        for query in response.get('queries', []):
+            for result in query.get('results', []):
+                points += len(result.get('values') or ())
+    except AttributeError:
+        pass
+    return points
+
+
+class ByteCounter(object):
+    ''' passes byte chunks through, counting them. '''
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.count  = 0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.count += len(chunk)
+            yield chunk
+
+
+class CountingDecoder(object):
+    ''' wraps a feed()/result() response decoder, counting bytes and seconds spent decoding. '''
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.count   = 0
+        self.seconds = 0.0
+
+    def feed(self, chunk):
+        tstart = time.time()
+        self.count += len(chunk)
+        self.decoder.feed(chunk)
+        self.seconds += time.time() - tstart
+
+    def result(self):
+        tstart = time.time()
+        try:
+            return self.decoder.result()
+        finally:
+            self.seconds += time.time() - tstart
+
+################################################################################
+################################################################################
@@ -0,0 +1,367 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Metric name tree persisted to one file that every worker process maps into
+# memory instead of building its own tree.  A restarted worker opens it in
+# milliseconds and all workers share its pages through the page cache.
+#
+# Layout, little endian:
+#   header       magic, version, node count, level count
+#   level table  index of the first node of each level, plus the node count
+#   nodes        (name offset, name length, first child, child count) each,
+#                level by level; the children of a node are contiguous and
+#                sorted by their utf-8 name, lookups are binary searches
+#   names        utf-8 name segments, each distinct segment once
+#
+# A refresher thread rebuilds the file from kairosdb's metricnames once it is
+# older than the refresh interval: written to a temporary file and renamed
+# over the old one, under a lock file so that only one worker does it.
+# Workers notice the new file by its inode and map it, finds still walking
+# the old mapping keep it until they are done.
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from counterStats import CounterStats
+from mockLogger import MockLogger
+from kairosdbNameTree import build_tree
+
+################################################################################
+
+MAGIC   = b'KDNI'
+VERSION = 1
+
+HEADER = struct.Struct('<4sIII')
+RECORD = struct.Struct('<IIII')
+OFFSET = struct.Struct('<I')
+
+DEFAULT_REFRESH_SECONDS = 300
+DEFAULT_CHECK_SECONDS   = 5
+
+_INDEXES      = {}
+_INDEXES_LOCK = threading.Lock()
+
+################################################################################
+
+
+class IndexFormatError(ValueError):
+    pass
+
+
+def _sorted_children(node):
+    if node.children is None:
+        return []
+    return sorted((name.encode('utf-8'), child) for (name, child) in node.children.items())
+
+
+def write_index(path, metric_names):
+    ''' writes the index of metric_names to path, replacing it atomically. '''
+    tree = build_tree(metric_names)
+    records = []
+    level_starts = [0]
+    strings = []
+    string_offsets = {}
+    strings_size = 0
+    level = _sorted_children(tree)
+    while level:
+        next_level = []
+        first_of_next = level_starts[-1] + len(level)
+        for (name, node) in level:
+            offset = string_offsets.get(name)
+            if offset is None:
+                offset = string_offsets[name] = strings_size
+                strings.append(name)
+                strings_size += len(name)
+            children = _sorted_children(node)
+            records.append(RECORD.pack(offset, len(name), first_of_next + len(next_level), len(children)))
+            next_level.extend(children)
+        level_starts.append(first_of_next)
+        level = next_level
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records), len(level_starts) - 1))
+        f.write(b''.join(OFFSET.pack(start) for start in level_starts))
+        f.write(b''.join(records))
+        f.write(b''.join(strings))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    return len(records)
+
+
+class IndexChildren(object):
+    ''' read-only name -> IndexNode mapping over a sorted run of nodes. '''
+    __slots__ = ('index', 'first', 'count')
+
+    def __init__(self, index, first, count):
+        self.index = index
+        self.first = first
+        self.count = count
+
+    def _find(self, name):
+        key = name.encode('utf-8') if not isinstance(name, bytes) else name
+        name_bytes = self.index.name_bytes
+        (low, high) = (self.first, self.first + self.count)
+        while low < high:
+            middle = (low + high) // 2
+            if name_bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.first + self.count and name_bytes(low) == key:
+            return low
+        return None
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def __getitem__(self, name):
+        position = self._find(name)
+        if position is None:
+            raise KeyError(name)
+        return IndexNode(self.index, position)
+
+    def get(self, name, default=None):
+        position = self._find(name)
+        if position is None:
+            return default
+        return IndexNode(self.index, position)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [self.index.name(p) for p in range(self.first, self.first + self.count)]
+
+    def values(self):
+        return [IndexNode(self.index, p) for p in range(self.first, self.first + self.count)]
+
+    def items(self):
+        return [(self.index.name(p), IndexNode(self.index, p)) for p in range(self.first, self.first + self.count)]
+
+
+class IndexNode(object):
+    ''' a node of a NameIndex, same interface as kairosdbNameTree.KairosNode. '''
+    __slots__ = ('index', 'position')
+
+    def __init__(self, index, position):
+        self.index    = index
+        self.position = position
+
+    @property
+    def name(self):
+        if self.position < 0:
+            return None
+        return self.index.name(self.position)
+
+    @property
+    def children(self):
+        (first, count) = self.index.children_of(self.position)
+        if not count:
+            return None
+        return IndexChildren(self.index, first, count)
+
+    def isLeaf(self):
+        return not self.index.children_of(self.position)[1]
+
+    def getChild(self, name):
+        children = self.children
+        if children is None:
+            return None
+        return children.get(name)
+
+    def getChildren(self):
+        children = self.children
+        if children is None:
+            return []
+        return children.values()
+
+    def getName(self):
+        return self.name
+
+
+class NameIndex(object):
+    ''' a mapped index file, root is the tree root. '''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.size < HEADER.size:
+            raise IndexFormatError("%s: not a name index" % (path))
+        (magic, version, self.node_count, self.level_count) = HEADER.unpack_from(self.data, 0)
+        if (magic != MAGIC) or (version != VERSION):
+            raise IndexFormatError("%s: not a version %d name index" % (path, VERSION))
+        self.levels = struct.unpack_from('<%dI' % (self.level_count + 1), self.data, HEADER.size)
+        self.records_offset = HEADER.size + OFFSET.size * (self.level_count + 1)
+        self.strings_offset = self.records_offset + RECORD.size * self.node_count
+        self.root = IndexNode(self, -1)
+
+    def record(self, position):
+        return RECORD.unpack_from(self.data, self.records_offset + RECORD.size * position)
+
+    def name_bytes(self, position):
+        (offset, length, first, count) = self.record(position)
+        start = self.strings_offset + offset
+        return self.data[start:start + length]
+
+    def name(self, position):
+        return self.name_bytes(position).decode('utf-8')
+
+    def children_of(self, position):
+        ''' (first child, child count) of the node at position, -1 is the root. '''
+        if position < 0:
+            return (0, self.level_count and self.levels[1])
+        return self.record(position)[2:]
+
+    def get_stats(self):
+        return {'nodes': self.node_count, 'bytes': self.size,
+                'levels': [self.levels[i + 1] - self.levels[i] for i in range(self.level_count)]}
+
+################################################################################
+
+
+class FileLock(object):
+    ''' exclusive lock on a file across processes, no-op without fcntl. '''
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.file = open(self.path, 'a')
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.file is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+
+class KairosdbNameIndex(object):
+    '''
+    path:            the index file, shared by all workers of the host.
+    fetch_names():   returns the list of all metric names.
+    refresh_seconds: the file is rebuilt once it is older than this.
+    check_seconds:   how often a worker looks for a replaced file.
+    '''
+    def __init__(self, path, fetch_names, refresh_seconds=DEFAULT_REFRESH_SECONDS,
+                 check_seconds=DEFAULT_CHECK_SECONDS, logger=None):
+        self.log             = logger or MockLogger()
+        self.path            = path
+        self.fetch_names     = fetch_names
+        self.refresh_seconds = refresh_seconds
+        self.check_seconds   = check_seconds
+        self.index           = None
+        self.index_key       = None
+        self.checked_at      = 0.0
+        self._open_lock      = threading.Lock()
+        self._rebuild_lock   = threading.Lock()
+        self._thread         = None
+        self.stats           = CounterStats(names=['opens', 'rebuilds', 'rebuildErrors', 'blockingRebuilds',
+            'lastRebuildSeconds'])
+        self.stats.setAllNonRate()
+
+    def get_root(self):
+        index = self._current()
+        if index is None:
+            self.stats.blockingRebuilds += 1
+            self.rebuild(max_age=self.refresh_seconds)
+            index = self._current(force=True)
+        self._start_refresher()
+        return index.root
+
+    def _current(self, force=False):
+        ''' the mapped index, remapped when the file was replaced. '''
+        now = time.time()
+        if (not force) and (self.index is not None) and (now - self.checked_at < self.check_seconds):
+            return self.index
+        self.checked_at = now
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return self.index
+        key = (st.st_ino, st.st_mtime, st.st_size)
+        if key != self.index_key:
+            with self._open_lock:
+                if key != self.index_key:
+                    try:
+                        self.index = NameIndex(self.path)
+                        self.index_key = key
+                        self.stats.opens += 1
+                    except (IOError, OSError, ValueError, struct.error) as e:
+                        self.log.info("KairosdbNameIndex._current(): EXCEPTION: %s" % (e))
+        return self.index
+
+    def age(self):
+        try:
+            return time.time() - os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def rebuild(self, max_age=None):
+        '''
+        Fetch the names and replace the file.  With max_age, nothing is done
+        when the file is younger, e.g. another worker just rebuilt it.
+        '''
+        with self._rebuild_lock:
+            with FileLock(self.path + '.lock'):
+                age = self.age()
+                if (max_age is not None) and (age is not None) and (age <= max_age):
+                    return False
+                tstart = time.time()
+                write_index(self.path, self.fetch_names())
+                self.stats.rebuilds += 1
+                self.stats.lastRebuildSeconds = time.time() - tstart
+        return True
+
+    def _start_refresher(self):
+        if self._thread is not None:
+            return
+        with _INDEXES_LOCK:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='kairosdb-name-index-refresher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.rebuild(max_age=self.refresh_seconds)
+            except Exception as e:
+                self.stats.rebuildErrors += 1
+                self.log.info("KairosdbNameIndex._run(): EXCEPTION: %s" % (e))
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret['ageSeconds'] = self.age()
+        if self.index is not None:
+            ret.update(self.index.get_stats())
+        return ret
+
+
+def get_name_index(path, fetch_names, **options):
+    ''' the process-wide index of path, created on first use. '''
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(path)
+        if index is None:
+            index = KairosdbNameIndex(path, fetch_names, **options)
+            _INDEXES[path] = index
+    return index
+
+################################################################################
+################################################################################
@@ -0,0 +1,352 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Metric name index service shared by the graphite-web workers of a host.
+# One sidecar process owns the MetricType name cache and the pattern cache
+# and answers finds over a unix domain socket, the workers only keep a
+# client: the namespace is held and warmed once per host instead of once
+# per worker.
+#
+# Protocol, little endian, one request and one response at a time per
+# connection:
+#   request   op (1 byte, 1 = find), offset (u32), max_results (u32, 0 for
+#             all), pattern length (u32), utf-8 pattern
+#   response  status (1 byte, 0 = ok), truncated (1 byte), count (u32),
+#             then per node: type (1 byte, 'B' or 'L'), name length (u16),
+#             utf-8 name
+#   error     status 1, 0, message length (u32), utf-8 message
+#
+#   python kairosdbNameService.py --socket /var/run/graphite/kairosdb-names.sock
+#   python kairosdbNameService.py --bench
+#
+# The MetricType caches are sized from the same KAIROSDB_* settings as the
+# finder's, read from graphite.settings (--settings to change).  --bench
+# times a MetricType over in-memory metrictype rows, in process and through
+# the service.
+
+import optparse
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from counterStats import CounterStats
+from mockLogger import MockLogger
+from kairosdbFind import FindWindow
+
+################################################################################
+
+OP_FIND = 1
+
+STATUS_OK    = 0
+STATUS_ERROR = 1
+
+REQUEST  = struct.Struct('<BIII')
+RESPONSE = struct.Struct('<BBI')
+NODE     = struct.Struct('<cH')
+
+DEFAULT_TIMEOUT = 10.0
+
+################################################################################
+
+
+class NameServiceError(Exception):
+    ''' the service answered with an error. '''
+    pass
+
+
+def read_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 16))
+        if not chunk:
+            raise EOFError("kairosdb name service closed the connection")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def encode_nodes(nodes, truncated):
+    parts = [RESPONSE.pack(STATUS_OK, bool(truncated), len(nodes))]
+    for (name, node_type) in nodes:
+        name = name.encode('utf-8')
+        parts.append(NODE.pack(node_type.encode('ascii'), len(name)))
+        parts.append(name)
+    return b''.join(parts)
+
+
+def read_nodes(sock):
+    ''' ([(name, 'B' or 'L'), ...], truncated) of a response on sock. '''
+    (status, truncated, count) = RESPONSE.unpack(read_exactly(sock, RESPONSE.size))
+    if status != STATUS_OK:
+        raise NameServiceError(read_exactly(sock, count).decode('utf-8', 'replace'))
+    nodes = []
+    for i in range(count):
+        (node_type, length) = NODE.unpack(read_exactly(sock, NODE.size))
+        nodes.append((read_exactly(sock, length).decode('utf-8'), node_type.decode('ascii')))
+    return (nodes, bool(truncated))
+
+################################################################################
+
+
+class NameRequestHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.server.connections.add(self.request)
+
+    def finish(self):
+        self.server.connections.discard(self.request)
+
+    def handle(self):
+        service = self.server.service
+        while True:
+            try:
+                (op, offset, max_results, length) = REQUEST.unpack(read_exactly(self.request, REQUEST.size))
+                pattern = read_exactly(self.request, length).decode('utf-8')
+            except (EOFError, socket.error):
+                return
+            try:
+                if op != OP_FIND:
+                    raise ValueError("unknown op %d" % (op))
+                (nodes, truncated) = service.find_nodes(pattern, offset, max_results)
+                response = encode_nodes(nodes, truncated)
+            except Exception as e:
+                service.stats.errors += 1
+                service.log.info("KairosdbNameService: find %r: EXCEPTION: %s" % (pattern, e))
+                message = str(e).encode('utf-8')
+                response = RESPONSE.pack(STATUS_ERROR, 0, len(message)) + message
+            try:
+                self.request.sendall(response)
+            except socket.error:
+                return
+
+
+class NameServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, *args):
+        socketserver.UnixStreamServer.__init__(self, *args)
+        self.connections = set()
+
+    def close_connections(self):
+        for sock in list(self.connections):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class KairosdbNameService(object):
+    '''
+    metric_type: object with find_nodes(pattern) -> [(name, 'B' or 'L')]
+                 (cached) and iter_nodes(pattern) (lazy, sorted), e.g. a
+                 connected MetricType.
+    '''
+    def __init__(self, metric_type, socket_path, logger=None):
+        self.log         = logger or MockLogger()
+        self.metric_type = metric_type
+        self.socket_path = socket_path
+        self.server      = None
+        self.stats       = CounterStats(names=['finds', 'errors', 'findSeconds'])
+        self.stats.setAllNonRate()
+
+    def find_nodes(self, pattern, offset=0, max_results=0):
+        tstart = time.time()
+        self.stats.finds += 1
+        window = FindWindow(offset, max_results)
+        if window.is_limited():
+            nodes = list(window.apply(self.metric_type.iter_nodes(pattern)))
+        else:
+            nodes = self.metric_type.find_nodes(pattern)
+        self.stats.findSeconds += time.time() - tstart
+        return (nodes, window.truncated)
+
+    def start(self):
+        ''' binds the socket and serves on a daemon thread. '''
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.server = NameServer(self.socket_path, NameRequestHandler)
+        self.server.service = self
+        os.chmod(self.socket_path, 0o660)
+        thread = threading.Thread(target=self.server.serve_forever, name='kairosdb-name-service')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server.close_connections()
+            self.server = None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def get_stats(self):
+        return dict(self.stats)
+
+
+class KairosdbNameClient(object):
+    ''' one connection per thread, reconnected once when it broke. '''
+    def __init__(self, socket_path, timeout=DEFAULT_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout     = timeout
+        self._local      = threading.local()
+        self.stats       = CounterStats(names=['finds', 'connects', 'errors'])
+        self.stats.setAllNonRate()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.stats.connects += 1
+        self._local.sock = sock
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def find_nodes(self, pattern, offset=0, max_results=0):
+        ''' ([(name, 'B' or 'L'), ...], truncated) of pattern. '''
+        self.stats.finds += 1
+        pattern = pattern.encode('utf-8')
+        request = REQUEST.pack(OP_FIND, offset or 0, max_results or 0, len(pattern)) + pattern
+        for attempt in (0, 1):
+            sock = getattr(self._local, 'sock', None)
+            try:
+                if sock is None:
+                    sock = self._connect()
+                sock.sendall(request)
+                return read_nodes(sock)
+            except NameServiceError:
+                self.stats.errors += 1
+                raise
+            except (EOFError, socket.error):
+                self._close()
+                if attempt or (sock is None):
+                    self.stats.errors += 1
+                    raise
+
+    def get_stats(self):
+        return dict(self.stats)
+
+################################################################################
+
+
+class DoneFuture(object):
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+class MemorySession(object):
+    '''
+    Stand-in for MetricType's cassandra session, answering its metrictype
+    lookups from rows built out of metric names.  For the benchmark.
+    '''
+    def __init__(self, metric_names):
+        self.rows = {}
+        self.by_parent = {}
+        for metric_name in metric_names:
+            parts = metric_name.split('.')
+            parent = 'root'
+            for depth in range(1, len(parts) + 1):
+                name = '.'.join(parts[:depth])
+                if name not in self.rows:
+                    row = {'metricname': name, 'parentname': parent, 'children': [], 'linktometricname': None}
+                    self.rows[name] = row
+                    self.by_parent.setdefault(parent, []).append(row)
+                    if parent != 'root':
+                        self.rows[parent]['children'].append(name)
+                parent = name
+
+    def execute(self, query, parameters=None):
+        if ' IN ' in query:
+            return [dict(self.rows[name]) for name in parameters[0] if name in self.rows]
+        if 'parentname' in query:
+            return [dict(row) for row in self.by_parent.get(parameters[0], [])]
+        if 'metricname' in query:
+            return [dict(self.rows[parameters[0]])] if parameters[0] in self.rows else []
+        raise ValueError("MemorySession: unexpected query: %s" % (query))
+
+    def execute_async(self, query, parameters=None):
+        return DoneFuture(self.execute(query, parameters))
+
+    def shutdown(self):
+        pass
+
+
+def benchmark(socket_path, names=200000, repeat=200):
+    '''
+    Find latency of a MetricType in process and through the service, over
+    the same synthetic metrictype rows held in memory.  The first find of a
+    pattern fills the caches, the repeated ones are served from them.
+    '''
+    from metricType import MetricType
+    metric_names = ['host%d.%s.%s' % (i % 2000, ('cpu', 'mem', 'disk', 'net')[(i // 2000) % 4], 'v%d' % (i // 8000))
+                    for i in range(names)]
+    metric_type = MetricType()
+    metric_type.openConnection(MemorySession(metric_names))
+    service = KairosdbNameService(metric_type, socket_path).start()
+    client = KairosdbNameClient(socket_path)
+    ret = {}
+    try:
+        for pattern in ['host7.cpu.v3', 'host7.*', 'host1?.mem.*', 'host1*.{cpu,net}.v1']:
+            tstart = time.time()
+            nodes = metric_type.find_nodes(pattern)
+            first = time.time() - tstart
+            assert client.find_nodes(pattern)[0] == nodes
+            tstart = time.time()
+            for i in range(repeat):
+                metric_type.find_nodes(pattern)
+            local = (time.time() - tstart) / repeat
+            tstart = time.time()
+            for i in range(repeat):
+                client.find_nodes(pattern)
+            sidecar = (time.time() - tstart) / repeat
+            ret[pattern] = {'nodes': len(nodes), 'firstMs': first * 1000, 'localMs': local * 1000, 'sidecarMs': sidecar * 1000}
+    finally:
+        service.stop()
+    return ret
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog --socket PATH [--settings MODULE] | --bench")
+    parser.add_option('--socket', help="unix socket to serve finds on")
+    parser.add_option('--settings', default='graphite.settings',
+        help="module with the KAIROSDB_* settings, as the finder sees them [%default]")
+    parser.add_option('--bench', action='store_true', help="compare in-process and sidecar find latency")
+    (options, args) = parser.parse_args(argv)
+    if options.bench:
+        socket_path = options.socket or '/tmp/kairosdb-names-bench.%d.sock' % (os.getpid())
+        for (pattern, result) in sorted(benchmark(socket_path).items()):
+            print("%-22s %6d nodes  first %8.3f ms  local %8.3f ms  sidecar %8.3f ms" % (
+                pattern, result['nodes'], result['firstMs'], result['localMs'], result['sidecarMs']))
+        return 0
+    if not options.socket:
+        parser.error("--socket is required")
+    from metricType import MetricType, get_metric_type_options
+    settings = __import__(options.settings, fromlist=['*'])
+    metric_type = MetricType(**get_metric_type_options(settings))
+    metric_type.openConnection()
+    KairosdbNameService(metric_type, options.socket).start()
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+################################################################################
+################################################################################
@@ -0,0 +1,395 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Metric name tree shared by all finds of a process.  The tree is built once
+# from kairosdb's metricnames and refreshed on a background thread: the new
+# name list is diffed against the leaves of the current tree (no second copy
+# of the names is kept) and only the changed paths are copied into a new
+# tree, unchanged subtrees are shared.  The new tree is
+# swapped in with one assignment, finds keep using whichever tree they got
+# and never wait for a refresh unless the tree is older than the staleness
+# bound.
+# Finds whose pattern starts with literal segments do not need the whole
+# namespace: get_prefix_tree() fetches only the names under that prefix,
+# caches them per prefix for a while and merges them into a partial tree.
+# The full tree is only built once a pattern starting with a wildcard comes
+# along, and then serves the prefixed finds as well.
+
+import sys
+import threading
+import time
+
+from counterStats import CounterStats
+from mockLogger import MockLogger
+
+################################################################################
+
+DEFAULT_REFRESH_SECONDS   = 300
+DEFAULT_MAX_STALE_SECONDS = 3600
+
+# above this share of changed names a refresh rebuilds instead of patching.
+REBUILD_RATIO = 0.5
+
+DEFAULT_PREFIX_TTL       = 60
+DEFAULT_MAX_PREFIX_NAMES = 100000
+
+_TREES      = {}
+_TREES_LOCK = threading.Lock()
+
+################################################################################
+
+
+class KairosNode(object):
+    '''
+    Trie node: children by name in a dict, None for leaves.  Builders pass
+    names through a segment table, a namespace repeats the same few
+    segments a lot and each is then held once.
+    '''
+    __slots__ = ('name', 'children')
+
+    def __init__(self, name=None):
+        self.name     = name
+        self.children = None
+
+    #Node is leaf, if it has no child nodes.
+    def isLeaf(self):
+        return not self.children
+
+    #Add child node to node.
+    def addChildNode(self, node):
+        if self.children is None:
+            self.children = {}
+        self.children[node.name] = node
+
+    def removeChildNode(self, node):
+        del self.children[node.name]
+        if not self.children:
+            self.children = None
+
+    #Get child node with specified name
+    def getChild(self, name):
+        if self.children is None:
+            return None
+        return self.children.get(name)
+
+    def getChildren(self):
+        if self.children is None:
+            return []
+        return list(self.children.values())
+
+    def getName(self):
+        return self.name
+
+    def nbytes(self):
+        ''' memory of this node and its child table, not of the children. '''
+        ret = sys.getsizeof(self)
+        if self.children is not None:
+            ret += sys.getsizeof(self.children)
+        return ret
+
+
+class KairosTree(KairosNode):
+    __slots__ = ()
+
+
+class KairosRegularNode(KairosNode):
+    __slots__ = ()
+
+    def __init__(self, name):
+        KairosNode.__init__(self, name)
+
+################################################################################
+
+
+def build_tree(metric_names, segments=None):
+    '''
+    tree of dot separated metric names.  segments: dict used to share equal
+    name segments (intern() does not take unicode on python 2).
+    '''
+    if segments is None:
+        segments = {}
+    tree = KairosTree()
+    for metric_name in metric_names:
+        node = tree
+        for name_part in metric_name.split('.'):
+            child = node.getChild(name_part)
+            if child is None:
+                child = KairosRegularNode(segments.setdefault(name_part, name_part))
+                node.addChildNode(child)
+            node = child
+    return tree
+
+
+def tree_memory(tree):
+    ''' node count and bytes held by nodes and child tables of tree. '''
+    nodes = 0
+    nbytes = 0
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        nodes += 1
+        nbytes += node.nbytes()
+        if node.children is not None:
+            stack.extend(node.children.values())
+    return {'nodes': nodes, 'bytes': nbytes, 'bytesPerNode': nodes and float(nbytes) / nodes}
+
+
+def tree_names(tree):
+    ''' generates the dotted names of the leaves of tree. '''
+    stack = [(tree, None)]
+    while stack:
+        (node, path) = stack.pop()
+        for child in node.getChildren():
+            name = child.name if path is None else path + '.' + child.name
+            if child.children:
+                stack.append((child, name))
+            else:
+                yield name
+
+
+def has_path(tree, metric_name):
+    ''' True when the segments of metric_name lead to a node of tree. '''
+    node = tree
+    for name_part in metric_name.split('.'):
+        node = node.getChild(name_part)
+        if node is None:
+            return False
+    return True
+
+
+def copy_node(node):
+    ret = node.__class__.__new__(node.__class__)
+    ret.name = node.name
+    ret.children = node.children and dict(node.children)
+    return ret
+
+
+class TreeUpdate(object):
+    '''
+    Path copying edit of a tree: nodes on changed paths are copied once,
+    the original tree stays untouched for finds still walking it.
+    '''
+    def __init__(self, root, segments=None):
+        self.root     = copy_node(root)
+        self.copies   = set([id(self.root)])
+        self.segments = segments if segments is not None else {}
+
+    def _own_child(self, parent, name):
+        ''' parent's child called name, copied into the new tree, or None. '''
+        child = parent.getChild(name)
+        if (child is not None) and (id(child) not in self.copies):
+            child = copy_node(child)
+            parent.children[name] = child
+            self.copies.add(id(child))
+        return child
+
+    def add(self, metric_name):
+        node = self.root
+        for name_part in metric_name.split('.'):
+            child = self._own_child(node, name_part)
+            if child is None:
+                child = KairosRegularNode(self.segments.setdefault(name_part, name_part))
+                node.addChildNode(child)
+                self.copies.add(id(child))
+            node = child
+
+    def remove(self, metric_name, metric_names):
+        ''' drop metric_name, and branches left empty that are not names themselves. '''
+        name_parts = metric_name.split('.')
+        path = [self.root]
+        for name_part in name_parts:
+            child = self._own_child(path[-1], name_part)
+            if child is None:
+                return
+            path.append(child)
+        for depth in range(len(name_parts), 0, -1):
+            node = path[depth]
+            if node.children or ('.'.join(name_parts[:depth]) in metric_names):
+                break
+            path[depth - 1].removeChildNode(node)
+
+
+class KairosdbNameTree(object):
+    '''
+    fetch_names():     returns the list of all metric names.
+    refresh_seconds:   interval of the background refresh.
+    max_stale_seconds: a tree older than this (refreshes failing) is
+                       refreshed in the find that notices it.
+    prefix_ttl:        seconds the names fetched for a prefix are reused.
+    max_prefix_names:  the partial tree is dropped above this many names.
+    '''
+    def __init__(self, fetch_names, refresh_seconds=DEFAULT_REFRESH_SECONDS,
+                 max_stale_seconds=DEFAULT_MAX_STALE_SECONDS, prefix_ttl=DEFAULT_PREFIX_TTL,
+                 max_prefix_names=DEFAULT_MAX_PREFIX_NAMES, logger=None):
+        self.log               = logger or MockLogger()
+        self.fetch_names       = fetch_names
+        self.refresh_seconds   = refresh_seconds
+        self.max_stale_seconds = max_stale_seconds
+        self.tree              = None
+        self.name_count        = 0
+        self.segments          = {}
+        self.built_at          = 0.0
+        self.prefix_ttl        = prefix_ttl
+        self.max_prefix_names  = max_prefix_names
+        self.partial           = KairosTree()
+        self.partial_names     = set()
+        self.prefixes          = {}     # prefix -> time fetched
+        self._refresh_lock     = threading.Lock()
+        self._prefix_lock      = threading.Lock()
+        self._thread           = None
+        self.stats             = CounterStats(names=['refreshes', 'rebuilds', 'refreshErrors', 'blockingRefreshes',
+            'added', 'removed', 'lastFetchSeconds', 'lastApplySeconds',
+            'prefixFullTree', 'prefixHits', 'prefixFetches', 'prefixNames', 'partialResets'])
+        self.stats.setAllNonRate()
+
+    def get_tree(self):
+        tree = self.tree
+        if (tree is None) or (time.time() - self.built_at > self.max_stale_seconds):
+            self.stats.blockingRefreshes += 1
+            try:
+                self.refresh(max_age=self.max_stale_seconds)
+            except Exception as e:
+                if self.tree is None:
+                    raise
+                self.stats.refreshErrors += 1
+                self.log.info("KairosdbNameTree.get_tree(): EXCEPTION: %s, serving a stale tree" % (e))
+            tree = self.tree
+        self._start_refresher()
+        return tree
+
+    def refresh(self, max_age=None):
+        '''
+        Fetch the names and swap in the updated tree.  With max_age, nothing
+        is done when another thread refreshed meanwhile.
+        '''
+        with self._refresh_lock:
+            if (max_age is not None) and (self.tree is not None) and (time.time() - self.built_at <= max_age):
+                return
+            tstart = time.time()
+            names = set(self.fetch_names())
+            tfetched = time.time()
+            if self.tree is None:
+                (added, removed) = (names, [])
+            else:
+                # names that are branches as well are kept as branches.
+                added = [name for name in names if not has_path(self.tree, name)]
+                removed = [name for name in tree_names(self.tree) if name not in names]
+            if (self.tree is None) or (len(added) + len(removed) > REBUILD_RATIO * max(1, self.name_count)):
+                self.segments = {}
+                tree = build_tree(names, self.segments)
+                self.stats.rebuilds += 1
+            else:
+                update = TreeUpdate(self.tree, self.segments)
+                for name in removed:
+                    update.remove(name, names)
+                for name in added:
+                    update.add(name)
+                tree = update.root
+            (self.tree, self.name_count, self.built_at) = (tree, len(names), tstart)
+            with self._prefix_lock:
+                # the full tree serves prefixed finds from now on.
+                (self.partial, self.partial_names) = (KairosTree(), set())
+                self.prefixes.clear()
+            self.stats.refreshes += 1
+            self.stats.added += len(added)
+            self.stats.removed += len(removed)
+            self.stats.lastFetchSeconds = tfetched - tstart
+            self.stats.lastApplySeconds = time.time() - tfetched
+
+    def get_prefix_tree(self, prefix, fetch_prefix):
+        '''
+        A tree holding at least the names starting with prefix: the full tree
+        when one is loaded, else the partial tree after fetch_prefix(prefix)
+        when neither prefix nor a shorter dotted prefix of it is cached.
+        '''
+        tree = self.tree
+        if (tree is not None) and (time.time() - self.built_at <= self.max_stale_seconds):
+            self.stats.prefixFullTree += 1
+            return tree
+        now = time.time()
+        for covering in self._covering_prefixes(prefix):
+            fetched_at = self.prefixes.get(covering)
+            if (fetched_at is not None) and (now - fetched_at <= self.prefix_ttl):
+                self.stats.prefixHits += 1
+                return self.partial
+        names = set(fetch_prefix(prefix))
+        self.stats.prefixFetches += 1
+        self.stats.prefixNames += len(names)
+        self._merge_prefix(prefix, names, now)
+        return self.partial
+
+    def _covering_prefixes(self, prefix):
+        ''' prefix and its shorter prefixes ending at a dot. '''
+        ret = [prefix]
+        index = prefix.find('.')
+        while 0 <= index < len(prefix) - 1:
+            ret.append(prefix[:index + 1])
+            index = prefix.find('.', index + 1)
+        return ret
+
+    def _merge_prefix(self, prefix, names, fetched_at):
+        with self._prefix_lock:
+            if len(self.partial_names | names) > self.max_prefix_names:
+                self.stats.partialResets += 1
+                (self.partial, self.partial_names) = (KairosTree(), set())
+                self.prefixes.clear()
+            removed = [n for n in self.partial_names if n.startswith(prefix) and n not in names]
+            added = names - self.partial_names
+            if removed or added:
+                update = TreeUpdate(self.partial, self.segments)
+                self.partial_names.difference_update(removed)
+                self.partial_names.update(added)
+                for name in removed:
+                    update.remove(name, self.partial_names)
+                for name in added:
+                    update.add(name)
+                self.partial = update.root
+            self.prefixes[prefix] = fetched_at
+            for (cached, cached_at) in list(self.prefixes.items()):
+                if fetched_at - cached_at > self.prefix_ttl:
+                    del self.prefixes[cached]
+
+    def _start_refresher(self):
+        if self._thread is not None:
+            return
+        with _TREES_LOCK:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='kairosdb-name-tree-refresher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.refresh()
+            except Exception as e:
+                self.stats.refreshErrors += 1
+                self.log.info("KairosdbNameTree._run(): EXCEPTION: %s" % (e))
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret.update({'names': self.name_count, 'segments': len(self.segments),
+            'prefixes': len(self.prefixes), 'partialNames': len(self.partial_names),
+            'ageSeconds': self.tree is not None and time.time() - self.built_at})
+        return ret
+
+    def get_memory(self):
+        ''' walks the whole tree, not for every request. '''
+        tree = self.tree
+        if tree is None:
+            return {'nodes': 0, 'bytes': 0, 'bytesPerNode': 0}
+        return tree_memory(tree)
+
+
+def get_name_tree(kairosdb_uri, fetch_names, **options):
+    ''' the process-wide tree of kairosdb_uri, created on first use. '''
+    with _TREES_LOCK:
+        tree = _TREES.get(kairosdb_uri)
+        if tree is None:
+            tree = KairosdbNameTree(fetch_names, **options)
+            _TREES[kairosdb_uri] = tree
+    return tree
+
+################################################################################
+################################################################################
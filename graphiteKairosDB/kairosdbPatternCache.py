@@ -0,0 +1,205 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Find results by query pattern, the one cache between finds and cassandra.
+# Bounded to the most recently used patterns, expired entries are swept by a
+# background thread and empty results are cached like any other.  A pattern
+# is computed by one thread at a time: when its entry expired the others
+# keep getting the stale result meanwhile, when there is none they wait for
+# it instead of all asking cassandra.
+
+import threading
+import time
+from collections import OrderedDict
+
+from counterStats import CounterStats
+
+################################################################################
+
+DEFAULT_TTL           = 1800
+DEFAULT_STALE_SECONDS = 300
+DEFAULT_MAX_PATTERNS  = 10000
+DEFAULT_SWEEP_SECONDS = 60
+# patterns with their own counters, least recently used ones are dropped.
+MAX_PATTERN_STATS     = 1000
+
+################################################################################
+
+
+class PatternEntry(object):
+    __slots__ = ('value', 'expires_at', 'stale_until')
+
+    def __init__(self, value, expires_at, stale_until):
+        self.value       = value
+        self.expires_at  = expires_at
+        self.stale_until = stale_until
+
+
+class PatternStats(object):
+    __slots__ = ('hits', 'staleHits', 'misses', 'computes', 'computeSeconds')
+
+    def __init__(self):
+        self.hits           = 0
+        self.staleHits      = 0
+        self.misses         = 0
+        self.computes       = 0
+        self.computeSeconds = 0.0
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class PatternCache(object):
+    '''
+    ttl:           seconds a result is fresh.
+    stale_seconds: seconds after that it is still served while one thread
+                   recomputes it.
+    max_patterns:  patterns kept at most.
+    sweep_seconds: interval of the background expiry sweep.
+    '''
+    def __init__(self, ttl=DEFAULT_TTL, stale_seconds=DEFAULT_STALE_SECONDS, max_patterns=DEFAULT_MAX_PATTERNS,
+                 sweep_seconds=DEFAULT_SWEEP_SECONDS):
+        self.ttl           = ttl
+        self.stale_seconds = stale_seconds
+        self.max_patterns  = max_patterns
+        self.sweep_seconds = sweep_seconds
+        self._entries      = OrderedDict()   # pattern -> PatternEntry
+        self._computing    = {}              # pattern -> Event set when done
+        self._patterns     = OrderedDict()   # pattern -> PatternStats
+        self._lock         = threading.Lock()
+        self._thread       = None
+        self.stats         = CounterStats(names=['hits', 'staleHits', 'misses', 'waits', 'computes',
+            'computeErrors', 'computeSeconds', 'evictions', 'expired'])
+        self.stats.setAllNonRate()
+
+    def _pattern_stats(self, pattern):
+        ''' called with the lock held. '''
+        stats = self._patterns.pop(pattern, None)
+        if stats is None:
+            stats = PatternStats()
+            while len(self._patterns) >= MAX_PATTERN_STATS:
+                self._patterns.popitem(last=False)
+        self._patterns[pattern] = stats
+        return stats
+
+    def get(self, pattern, default=None):
+        ''' the cached result, fresh or stale, without computing it. '''
+        with self._lock:
+            entry = self._entries.get(pattern)
+            if (entry is None) or (entry.stale_until < time.time()):
+                return default
+            return entry.value
+
+    def put(self, pattern, value):
+        now = time.time()
+        with self._lock:
+            self._entries.pop(pattern, None)
+            self._entries[pattern] = PatternEntry(value, now + self.ttl, now + self.ttl + self.stale_seconds)
+            while len(self._entries) > self.max_patterns:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+        self._start_sweeper()
+
+    def invalidate(self, pattern):
+        with self._lock:
+            self._entries.pop(pattern, None)
+
+    def get_or_compute(self, pattern, compute):
+        '''
+        The result of pattern, compute() when it is not cached or expired.
+        Only one thread computes a pattern at a time.
+        '''
+        while True:
+            now = time.time()
+            with self._lock:
+                stats = self._pattern_stats(pattern)
+                entry = self._entries.pop(pattern, None)
+                if (entry is not None) and (entry.stale_until < now):
+                    self.stats.expired += 1
+                    entry = None
+                if entry is not None:
+                    self._entries[pattern] = entry
+                    if entry.expires_at >= now:
+                        self.stats.hits += 1
+                        stats.hits += 1
+                        return entry.value
+                computing = self._computing.get(pattern)
+                if computing is None:
+                    computing = self._computing[pattern] = threading.Event()
+                    break
+                if entry is not None:
+                    # someone is recomputing it, the stale result will do.
+                    self.stats.staleHits += 1
+                    stats.staleHits += 1
+                    return entry.value
+                self.stats.waits += 1
+            computing.wait()
+            # computed meanwhile (or failed), look again.
+
+        self.stats.misses += 1
+        stats.misses += 1
+        tstart = time.time()
+        try:
+            value = compute()
+        except Exception:
+            self.stats.computeErrors += 1
+            raise
+        else:
+            self.put(pattern, value)
+        finally:
+            seconds = time.time() - tstart
+            with self._lock:
+                del self._computing[pattern]
+                self.stats.computes += 1
+                self.stats.computeSeconds += seconds
+                stats.computes += 1
+                stats.computeSeconds += seconds
+            computing.set()
+        return value
+
+    def sweep(self):
+        ''' drops the entries past their stale time. '''
+        now = time.time()
+        with self._lock:
+            expired = [p for (p, e) in self._entries.items() if e.stale_until < now]
+            for pattern in expired:
+                del self._entries[pattern]
+            self.stats.expired += len(expired)
+        return len(expired)
+
+    def _start_sweeper(self):
+        if (self._thread is not None) or not self.sweep_seconds:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='kairosdb-pattern-cache-sweeper')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.sweep_seconds)
+            self.sweep()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        ret = dict(self.stats)
+        ret['patterns'] = len(self._entries)
+        return ret
+
+    def get_pattern_stats(self, top=20):
+        ''' counters of the top patterns by hits. '''
+        with self._lock:
+            patterns = [(p, s.to_dict()) for (p, s) in self._patterns.items()]
+        patterns.sort(key=lambda x: -(x[1]['hits'] + x[1]['staleHits']))
+        return patterns[:top]
+
+    def reset_stats(self):
+        self.stats.resetNonRate()
+        with self._lock:
+            self._patterns.clear()
+
+################################################################################
+################################################################################
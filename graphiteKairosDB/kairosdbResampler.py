@@ -0,0 +1,241 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Conversion of kairosdb [timestamp, value] pairs into graphite datapoints.
+#
+# resample_python() is the original per-point loop, kept as the reference
+# implementation and as fallback when numpy is not installed.  resample_array()
+# produces the same buckets with numpy and returns a float64 array with NaN
+# for gaps.  resample_values() / resample_fixed_step() hand graphite a
+# CompactSeries over that array rather than a list.  Note: no "from __future__ import division" here, time conversion
+# must divide exactly like KairosdbUtils.kairosdb_time_to_graphite_time().
+
+import math
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from kairosdbSeries import CompactSeries
+
+################################################################################
+
+NAN = float('nan')
+
+# array typecode for kairosdb millisecond timestamps, 'q' is python 3 only.
+TIMESTAMP_TYPECODE = 'q' if hasattr(array, 'typecodes') and 'q' in array.typecodes else 'l'
+
+################################################################################
+
+
+class SeriesPoints(object):
+    '''
+    Raw kairosdb points as parallel arrays: timestamps in milliseconds
+    (array of TIMESTAMP_TYPECODE) and values (array('d'), NaN for null).
+    Accepted by resample_values() in place of a list of [ts, value] pairs.
+    '''
+    __slots__ = ('timestamps', 'values')
+
+    def __init__(self, timestamps=None, values=None):
+        self.timestamps = timestamps if timestamps is not None else array(TIMESTAMP_TYPECODE)
+        self.values     = values if values is not None else array('d')
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        timestamps = array(TIMESTAMP_TYPECODE, [int(p[0]) for p in pairs])
+        values = array('d', [NAN if p[1] is None else p[1] for p in pairs])
+        return cls(timestamps, values)
+
+    @classmethod
+    def join(cls, parts):
+        ''' concatenate consecutive, non overlapping SeriesPoints. '''
+        ret = cls()
+        for part in parts:
+            ret.timestamps.extend(part.timestamps)
+            ret.values.extend(part.values)
+        return ret
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def pairs(self):
+        return [[t, None if v != v else v] for (t, v) in zip(self.timestamps, self.values)]
+
+    def arrays(self):
+        ''' numpy views, no copy. '''
+        if not len(self.timestamps):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return (np.frombuffer(self.timestamps, dtype=np.int64 if self.timestamps.itemsize == 8 else np.int32).astype(np.int64),
+                np.frombuffer(self.values, dtype=np.float64))
+
+
+def as_series_points(values):
+    ''' SeriesPoints from either a SeriesPoints or a list of [ts, value] pairs. '''
+    if isinstance(values, SeriesPoints):
+        return values
+    return SeriesPoints.from_pairs(values)
+
+###############################################################################
+
+
+def kairosdb_time_to_graphite_time(timeval):
+    return timeval / 1000
+
+###############################################################################
+
+
+def resample_python(values, startTime, endTime):
+    values_length = len(values)
+    if values_length == 0:
+        time_info = (startTime, endTime, 1)
+        datapoints = []
+        return (time_info, datapoints)
+    if values_length == 1:
+        time_info = (startTime, endTime, 1)
+        datapoints = [values[0][1]]
+        return (time_info, datapoints)
+    # 1. Calculate step (in seconds)
+    #    Step will be lowest time delta between values or 1 (in case if delta is smaller)
+    step = 1
+    minDelta = None
+    for i in range(0, values_length - 2):
+        (timeI, valueI) = values[i]
+        (timeIplus1, valueIplus1) = values[i + 1]
+        timeI = kairosdb_time_to_graphite_time(timeI)
+        timeIplus1 = kairosdb_time_to_graphite_time(timeIplus1)
+        delta = timeIplus1 - timeI
+        if (minDelta == None) or (delta < minDelta):
+            minDelta = delta
+    if (minDelta != None) and (minDelta > step):
+        step = minDelta
+    # 2. Fill time info table
+    time_info = (startTime, endTime, step)
+    # 3. Create array of output points
+    number_points = int(math.ceil((endTime - startTime) / step))
+    datapoints = [None for i in range(number_points)]
+    # 4. Fill array of output points
+    cur_index = 0
+    cur_value = None
+    cur_time_stamp = None
+    cur_value_used = None
+    for i in range(0, number_points - 1):
+        data_point_time_stamp = startTime + i * step
+        (cur_time_stamp, cur_value) = values[cur_index]
+        cur_time_stamp = kairosdb_time_to_graphite_time(cur_time_stamp)
+        while cur_index + 1 < values_length:
+            (next_time_stamp, next_value) = values[cur_index + 1]
+            next_time_stamp = kairosdb_time_to_graphite_time(next_time_stamp)
+            if next_time_stamp > data_point_time_stamp:
+                break
+            (cur_value, cur_time_stamp, cur_value_used) = (next_value, next_time_stamp, False)
+            cur_index = cur_index + 1
+        data_point_value = None
+        if (not cur_value_used) and (cur_time_stamp <= data_point_time_stamp):
+            cur_value_used = True
+            data_point_value = cur_value
+        datapoints[i] =  data_point_value
+    return (time_info, datapoints)
+
+###############################################################################
+
+
+def values_to_arrays(values):
+    ''' split [[ts, value], ...] into int64 timestamp (ms) and float64 value arrays. '''
+    if isinstance(values, SeriesPoints):
+        return values.arrays()
+    pairs = np.array(values, dtype=np.float64).reshape(-1, 2)
+    return pairs[:, 0].astype(np.int64), pairs[:, 1]
+
+
+def resample_array(timestamps, vals, startTime, endTime):
+    '''
+    Vectorized resample_python().  timestamps are kairosdb milliseconds,
+    returns (time_info, float64 array) with NaN where graphite expects None.
+    '''
+    values_length = len(timestamps)
+    if values_length == 0:
+        return ((startTime, endTime, 1), np.empty(0, dtype=np.float64))
+    if values_length == 1:
+        return ((startTime, endTime, 1), np.array(vals[:1], dtype=np.float64))
+    times = kairosdb_time_to_graphite_time(np.asarray(timestamps))
+    if np.any(times[1:] < times[:-1]):
+        # the sequential scan of the original code is only equivalent to a
+        # binary search on sorted input, kairosdb always sorts.  Just in case.
+        pairs = list(zip(timestamps.tolist(), vals.tolist()))
+        (time_info, datapoints) = resample_python(pairs, startTime, endTime)
+        return (time_info, np.array(datapoints, dtype=np.float64))
+    # 1. step: smallest delta among the first values_length - 2 deltas, at least 1.
+    step = 1
+    if values_length > 2:
+        minDelta = np.diff(times[:values_length - 1]).min().item()
+        if minDelta > step:
+            step = minDelta
+    time_info = (startTime, endTime, step)
+    # 2. output buckets, the last one is never filled.
+    number_points = int(math.ceil((endTime - startTime) / step))
+    datapoints = np.empty(max(number_points, 0), dtype=np.float64)
+    datapoints.fill(np.nan)
+    filled = number_points - 1
+    if filled <= 0:
+        return (time_info, datapoints)
+    # 3. each bucket takes the last value at or before its timestamp, but
+    #    a value is only used once: by the first bucket that reaches it.
+    bucket_times = startTime + np.arange(filled) * step
+    index = np.searchsorted(times, bucket_times, side='right') - 1
+    np.maximum(index, 0, out=index)
+    reached = times[index] <= bucket_times
+    first = np.empty(filled, dtype=bool)
+    first[0] = True
+    first[1:] = (index[1:] != index[:-1]) | ~reached[:-1]
+    use = reached & first
+    datapoints[:filled][use] = vals[index[use]]
+    return (time_info, datapoints)
+
+
+def to_datapoints(datapoints):
+    ''' float64 array with NaN gaps -> list with None gaps, no python loop. '''
+    ret = datapoints.astype(object)
+    ret[np.isnan(datapoints)] = None
+    return ret.tolist()
+
+
+def resample_values(values, startTime, endTime):
+    ''' kairosdb 'values' list -> (time_info, CompactSeries) for graphite. '''
+    if np is None or len(values) < 2:
+        if isinstance(values, SeriesPoints):
+            values = values.pairs()
+        (time_info, datapoints) = resample_python(values, startTime, endTime)
+        return (time_info, CompactSeries.from_list(datapoints))
+    (timestamps, vals) = values_to_arrays(values)
+    (time_info, datapoints) = resample_array(timestamps, vals, startTime, endTime)
+    return (time_info, CompactSeries(datapoints))
+
+
+def resample_fixed_step(values, startTime, endTime, step):
+    '''
+    Place already sampled values (kairosdb sampling aggregators) on a grid of
+    known step starting at startTime.  Returns (time_info, CompactSeries).
+    '''
+    number_points = max(0, -(-(endTime - startTime) // step))
+    time_info = (startTime, endTime, step)
+    if np is None or len(values) < 2:
+        if isinstance(values, SeriesPoints):
+            values = values.pairs()
+        datapoints = [None] * number_points
+        for (timestamp, value) in values:
+            index = (timestamp // 1000 - startTime) // step
+            if 0 <= index < number_points:
+                datapoints[index] = value
+        return (time_info, CompactSeries.from_list(datapoints))
+    (timestamps, vals) = values_to_arrays(values)
+    datapoints = np.empty(number_points, dtype=np.float64)
+    datapoints.fill(np.nan)
+    index = (timestamps // 1000 - startTime) // step
+    inside = (index >= 0) & (index < number_points)
+    datapoints[index[inside]] = vals[inside]
+    return (time_info, CompactSeries(datapoints))
+
+################################################################################
+################################################################################
@@ -0,0 +1,127 @@
+#!/usr/bin/env python2.6
+################################################################################
+
+# Compact datapoints for reader output.  A CompactSeries holds one float64
+# per point (numpy array or array('d')) with NaN for gaps, instead of a list
+# of boxed floats and Nones.  It behaves like a read-only list of values with
+# None for gaps, so graphite's TimeSeries(..., values) just iterates it and the
+# list only exists once graphite's function layer builds its series.
+
+import threading
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from counterStats import CounterStats
+
+################################################################################
+
+# boxed float in a list: 8 byte slot + 24 byte float object.
+LIST_BYTES_PER_POINT = 32
+
+################################################################################
+
+
+class CompactSeries(object):
+    __slots__ = ('buffer',)
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    @classmethod
+    def from_list(cls, datapoints):
+        nan = float('nan')
+        return cls(array('d', [nan if v is None else v for v in datapoints]))
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.tolist()[index]
+        v = self.buffer[index]
+        if v != v:
+            return None
+        return float(v)
+
+    def __eq__(self, other):
+        return self.tolist() == list(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "<CompactSeries %d points, %d bytes>" % (len(self), self.nbytes)
+
+    def __reduce__(self):
+        return (CompactSeries, (self.buffer,))
+
+    @property
+    def nbytes(self):
+        return len(self.buffer) * self.buffer.itemsize
+
+    def tolist(self):
+        ''' values with None gaps, the representation graphite works on. '''
+        if np is not None and isinstance(self.buffer, np.ndarray):
+            ret = self.buffer.astype(object)
+            ret[np.isnan(self.buffer)] = None
+            return ret.tolist()
+        return [None if v != v else v for v in self.buffer]
+
+################################################################################
+
+
+class SeriesMemoryAccount(object):
+    '''
+    Bytes held by CompactSeries produced by the readers, process-wide and for
+    the current thread (graphite-web serves a render request on one thread).
+    start_request() resets the thread's figures, request_usage() reads them.
+    '''
+    def __init__(self):
+        self.stats = CounterStats(names=['series', 'points', 'bytes', 'listBytesAvoided'])
+        self.stats.setAllNonRate()
+        self._local = threading.local()
+
+    def add(self, series):
+        nbytes = series.nbytes
+        saved = len(series) * LIST_BYTES_PER_POINT - nbytes
+        self.stats.series += 1
+        self.stats.points += len(series)
+        self.stats.bytes += nbytes
+        self.stats.listBytesAvoided += saved
+        usage = self._thread_usage()
+        usage['series'] += 1
+        usage['points'] += len(series)
+        usage['bytes'] += nbytes
+        return series
+
+    def _thread_usage(self):
+        usage = getattr(self._local, 'usage', None)
+        if usage is None:
+            usage = self.start_request()
+        return usage
+
+    def start_request(self):
+        self._local.usage = {'series': 0, 'points': 0, 'bytes': 0}
+        return self._local.usage
+
+    def request_usage(self):
+        return dict(self._thread_usage())
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    def reset_stats(self):
+        self.stats.resetNonRate()
+
+
+SERIES_MEMORY = SeriesMemoryAccount()
+
+################################################################################
+################################################################################
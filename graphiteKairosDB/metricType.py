@@ -15,6 +15,28 @@ from cassandra.policies import DCAwareRoundRobinPolicy
 from cassandra.query import dict_factory
 
 from mockLogger import MockLogger
+from kairosdbGlob import compile_segment, has_wildcards, split_pattern
+from kairosdbDocCache import DocCache, MISSING, DEFAULT_MAX_BYTES, DEFAULT_NEGATIVE_TTL
+from kairosdbPatternCache import PatternCache, DEFAULT_TTL, DEFAULT_MAX_PATTERNS
+
+###############################################################################
+
+DEFAULT_IN_QUERY_CHUNK_SIZE  = 100   # names per 'IN' query of batched lookups
+DEFAULT_IN_QUERY_CONCURRENCY = 8     # of those queries in flight at once
+
+###############################################################################
+
+
+def get_metric_type_options(settings):
+    ''' MetricType() keyword arguments from the KAIROSDB_* settings, see README.md. '''
+    return {
+        'cache_max_bytes'      : getattr(settings, 'KAIROSDB_DOC_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES),
+        'negative_ttl'         : getattr(settings, 'KAIROSDB_NEGATIVE_TTL', DEFAULT_NEGATIVE_TTL),
+        'qp_cache_ttl'         : getattr(settings, 'KAIROSDB_FIND_CACHE_TTL', DEFAULT_TTL),
+        'qp_cache_max'         : getattr(settings, 'KAIROSDB_FIND_CACHE_MAX_PATTERNS', DEFAULT_MAX_PATTERNS),
+        'in_query_chunk_size'  : getattr(settings, 'KAIROSDB_IN_QUERY_CHUNK_SIZE', DEFAULT_IN_QUERY_CHUNK_SIZE),
+        'in_query_concurrency' : getattr(settings, 'KAIROSDB_IN_QUERY_CONCURRENCY', DEFAULT_IN_QUERY_CONCURRENCY),
+        }
 
 ###############################################################################
 
@@ -22,6 +44,11 @@ from mockLogger import MockLogger
 class BadMetricNameException(Exception):
     pass
 
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
 ###############################################################################
 
 
@@ -29,16 +56,24 @@ class MetricType(object):
     '''
     This is a utility class and does not represent one specific Metric object.
     '''
-    def __init__(self, connectionObject=None, logger=None):
+    def __init__(self, connectionObject=None, logger=None, cache_max_bytes=DEFAULT_MAX_BYTES,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL, qp_cache_ttl=DEFAULT_TTL, qp_cache_max=DEFAULT_MAX_PATTERNS,
+                 in_query_chunk_size=DEFAULT_IN_QUERY_CHUNK_SIZE, in_query_concurrency=DEFAULT_IN_QUERY_CONCURRENCY):
         self.log = logger or MockLogger()
         self.session    = None
         self.cache_max  = 10 * 1000 * 1000
-        self._cache     = {} # Do not access this directly, use addDocToCache()
-        self._qpCache   = {}
-        self._qpCacheExpirySeconds = 60 * 60
+        # LRU, bounded by entries and bytes; names known to be missing are
+        # cached for negative_ttl seconds.  Use addDocToCache().
+        self._cache     = DocCache(self.cache_max, cache_max_bytes, negative_ttl)
+        # find_nodes() results by pattern, see kairosdbPatternCache.
+        self._qpCacheExpirySeconds = qp_cache_ttl
+        self._qpCache   = PatternCache(ttl=qp_cache_ttl, max_patterns=qp_cache_max)
         self.badCharPattern = re.compile(r'[^a-zA-Z\-_0-9.:]')
         self.lastCheckUpdateRetval = 0
         self.checkUpdateRetvalEvery = 1000
+        # batched lookups (getDocsByNames()): names per 'IN' query, queries in flight.
+        self.inQueryChunkSize   = max(1, in_query_chunk_size)
+        self.inQueryConcurrency = max(1, in_query_concurrency)
 
     def __del__(self):
         self.closeConnection()
@@ -72,13 +107,13 @@ class MetricType(object):
         return
 
     def addDocToCache(self, name, val):
-        self._cache[name] = val
-        if self.cache_max:
-            while len(self._cache) > self.cache_max:
-                self._cache.popitem()
+        self._cache.put(name, val)
 
     def invalidateCache(self, name):
-        self._cache[name] = None
+        self._cache.invalidate(name)
+
+    def getCacheStats(self):
+        return self._cache.get_stats()
 
     def getCacheSize(self):
         return len(self._cache)  # dict method has len(), faster than len(self._cache.keys()) since no iteration.
@@ -131,12 +166,20 @@ class MetricType(object):
         if doc:
             self.log.debug("getByName: %s found name in cache, returning %s." % (metricname, self.strMtDoc(doc)))
             return doc
-        self.log.debug("metricType.getByName(): Missed cache, querying, metricname=%s" % (metricname))
-        doc = self.getMetricTypeRec(metricname)
-        self.log.debug("metricType.getByName(): Query found doc: %s" % (self.strMtDoc(doc)))
-        if doc:
-            self.addDocToCache(metricname, doc)
-            return doc
+        if doc is MISSING:
+            # known not to exist, only worth asking again to create it.
+            doc = None
+            if not saveNew:
+                return None
+        else:
+            self.log.debug("metricType.getByName(): Missed cache, querying, metricname=%s" % (metricname))
+            doc = self.getMetricTypeRec(metricname)
+            self.log.debug("metricType.getByName(): Query found doc: %s" % (self.strMtDoc(doc)))
+            if doc:
+                self.addDocToCache(metricname, doc)
+                return doc
+            if not saveNew:
+                self._cache.put_missing(metricname)
         ##Link2MetricName:  might be a link intervening.  find sublists of a.b.c.d --> [a, a.b, a.b.c, a.b.c.d]
         ##Link2MetricName:  possLinks = set()
         ##Link2MetricName: for c in range(0, metricname.count('.')+1): 
@@ -163,34 +206,59 @@ class MetricType(object):
         rows = self.session.execute(query, parameters=[ValueSequence(metricnames)])
         return rows
 
+    def _getByNamesListAsync(self, metricnames):
+        query = 'SELECT * FROM metrictype WHERE metricname IN %s'
+        return self.session.execute_async(query, parameters=[ValueSequence(metricnames)])
+
+    def getDocsByNames(self, names):
+        '''
+        {name: doc} of the names that exist.  Only the names missing from the
+        cache are queried, in 'IN' queries of inQueryChunkSize names, up to
+        inQueryConcurrency of them running at once.
+        '''
+        ret = {}
+        misses = []
+        for name in names:
+            if name in ret:
+                continue
+            doc = self._cache.get(name)
+            if doc:
+                ret[name] = doc
+            elif doc is not MISSING:
+                ret[name] = None
+                misses.append(name)
+        chunks = list(chunked(misses, self.inQueryChunkSize))
+        for wave in chunked(chunks, self.inQueryConcurrency):
+            if len(wave) == 1:
+                results = [self._getByNamesList(wave[0])]
+            else:
+                results = [f.result() for f in [self._getByNamesListAsync(chunk) for chunk in wave]]
+            for rows in results:
+                for rec in rows:
+                    mname = rec.get('metricname', None)
+                    if not mname:  # had this happen once, test for it now.
+                        self.log.warning("Found Metrictype record with no metricname: %s" % (rec))
+                        continue
+                    ret[mname] = rec
+                    self.addDocToCache(mname, rec)
+        for name in misses:
+            if ret.get(name) is None:
+                del ret[name]
+                self._cache.put_missing(name)
+        return ret
+
     def getByNames(self, queryList):
-        gotAll = True
+        ''' docs of the names in queryList that exist, in queryList order, each once.'''
+        docs = self.getDocsByNames(queryList)
         retList = []
         for metricName in queryList:
-            rec  = self._cache.get(metricName)
+            rec = docs.pop(metricName, None)
             if rec:
-                # self.log.debug("getByName: %s found name in cache, returning %s." % (metricname, self.strMtDoc(doc)))
                 retList.append(rec)
-            else:
-                gotAll = False
-        if gotAll:
-            #self.log.info("getByNames: queryList: (%s) all found in cache, returning." % (queryList))
-            return retList
-        cur = self._getByNamesList(queryList)
-        for rec in cur:
-            mname = rec.get('metricname', None)
-            if not mname:  # had this happen once, test for it now.
-                self.log.warning("Found Metrictype record with no metricname: %s" % (rec))
-                continue
-            retList.append(rec)
-            self._cache[mname] = rec  # populate cache 
         return retList
 
     def invalidateCacheForName(self, metricname):
-        try:
-            del self._cache[metricname]
-        except:
-            pass
+        self._cache.invalidate(metricname)
 
     ###Obs: def getByName(self, metricname, saveNew=True):
     ###Obs:     # Will occassionally suffer from race condition for brand-new records.
@@ -330,7 +398,7 @@ class MetricType(object):
         return doclist
 
     def isMetricNameCached(self, mname):
-        return self._cache.get(mname)
+        return self._cache.get(mname) or None
 
     def getRootDocs(self):
         res = self.getByParentName(None)
@@ -340,10 +408,7 @@ class MetricType(object):
         return res
 
     def regexOrGlobCharsInString(self, instr):
-        for c in ' * [ ] ? '.split():
-            if c in instr:
-                return True
-        return False
+        return has_wildcards(instr)
 
     def getNamesGivenGlob(self, qp):
         pat = fnmatch.translate(qp)
@@ -361,110 +426,112 @@ class MetricType(object):
     def find_mnames(self, qp):
         ''' given string, return array of un-aliased strings'''
         if (not qp)   : return []
-        cacheData = self.getQpFromCache(qp)
-        if cacheData:
-            return cacheData
-        first, star, last = self.splitOnStars(qp)
-        #self.log.info("find_mnames(): qp: %s, fsl: f=%s, s=%s, l=%s" % (qp, first, star, last))
-        if not first:   # starts with a wildcard, get root docs.
-            rdocs = self.getRootDocs()
-            rdocNames = [x.get('metricname', None) for x in rdocs if x is not None]
-            tlist = []
-            for name in rdocNames:
-                pat = fnmatch.translate(star)  # get regex pattern
-                gotMatch = bool(re.match(pat, name))
-                #self.log.info("find_mnames(): First: %s, Star: '%s', last: '%s', regex: '%s', gotMatch: %s" % (first, star, last, pat, gotMatch))
-                if not gotMatch:
+        return [name for (name, realName, doc) in self.expandPattern(qp, lazy=False)]
+
+    def iter_mnames(self, qp):
+        ''' find_mnames() as a generator: names come lazily, in sorted order.'''
+        for (name, realName, doc) in self.expandPattern(qp):
+            yield name
+
+    def expandPattern(self, qp, lazy=True):
+        '''
+        (name, realName, doc) of every metrictype matching qp, in sorted order.
+        name is un-aliased, realName / doc are the link destination's.
+        Candidate names are looked up in batches (getDocsByNames()):
+        lazy:  depth first, inQueryChunkSize candidates at a time, so a capped
+               find only looks up the subtrees of the results it returns.
+        else:  breadth first, a whole tree level per batch, the fewest round
+               trips for a complete find.
+        '''
+        if (not qp)   : return iter(())
+        parts = split_pattern(qp)
+        segments = [compile_segment(part) for part in parts]
+        literalDepth = 0
+        while literalDepth < len(segments) and len(segments[literalDepth].literals or ()) == 1:
+            literalDepth += 1
+        if literalDepth > 1:
+            # the literal head levels a.b.c are walked from the cache after one query for them all.
+            self.getDocsByNames(['.'.join(parts[:n]) for n in range(1, literalDepth + 1)])
+        if segments[0].literals is not None:
+            candidates = [(n, n) for n in segments[0].literals]
+        else:   # starts with a wildcard, get root docs.
+            rdocNames = [x.get('metricname', None) for x in self.getRootDocs() if x is not None]
+            candidates = [(n, n) for n in segments[0].filter([n for n in rdocNames if n])]
+        return self._expandLevel(segments, 0, candidates, lazy)
+
+    def _expandLevel(self, segments, depth, candidates, lazy):
+        ''' expandPattern() of the (name, realName) candidates of level depth. '''
+        candidates.sort(key=lambda x: x[0].split('.'))
+        batchSize = (lazy and self.inQueryChunkSize) or max(1, len(candidates))
+        last = (depth == len(segments) - 1)
+        for batch in chunked(candidates, batchSize):
+            found = self._resolveCandidates(batch)
+            if last:
+                for x in found:
+                    yield x
+                continue
+            segment = segments[depth + 1]
+            children = []       # (name, realName)
+            for (name, realName, doc) in found:
+                if not doc.get('children'):
                     continue
-                fname = '%s.%s' % (name, last)
-                if not last:
-                    fname = name
-                if gotMatch:
-                    tlist.extend(self.find_mnames(fname))
-            return tlist
-        realName, linkpart, realpart = self.translateLinkedPath(first)
-        #self.log.info("find_mnames(): tlp returned rn: %s, lp: %s, rp: %s." % (realName, linkpart, realpart))
-        realMt = self.getByName(realName, saveNew=False)
-        #self.log.info("find_mnames(): realname returned: %s" % (realMt))
-        if not realMt:
-            #self.log.info("find_mnames(): non, returning empty.")
-            return []
-        if not star:
-            # all of it is literal, just return self.
-            #self.log.info("find_mnames(): no star, all literal, returning first.")
-            return [first]
-        # have star.  
-        tlist = []
-        children = realMt['children']
-        linkedKids = []
-        pat = fnmatch.translate(star)  # get regex pattern
-        pat = r'%s.%s' % (first, pat)
-        for childName in children:
-            realName = realMt.get('metricname', "")
-            if (not linkpart):
-                cname = childName
-            else:
-                cname = childName.replace(linkpart, realpart)
-            gotMatch = bool(re.match(pat, cname))
-            #self.log.info("find_mnames(): CHILD: %s, rn: %s, cname: %s, gotMatch: %s" % (childName, realName, cname, gotMatch))
-            if gotMatch:
-                linkedKids.append(cname)
-        # self.log.info("find_mnames(): created linkedKids list: %s" % (linkedKids))
+                if segment.literals is not None:
+                    children.extend(('%s.%s' % (name, n), '%s.%s' % (realName, n)) for n in segment.literals)
+                    continue
+                prefix = realName + '.'
+                for childName in doc['children']:
+                    if childName.startswith(prefix) and segment.match(childName[len(prefix):]):
+                        children.append((name + childName[len(realName):], childName))
+            # children of sorted parents, sorted: the order holds across batches.
+            for x in self._expandLevel(segments, depth + 1, children, lazy):
+                yield x
+
+    def _resolveCandidates(self, candidates):
+        ''' [(name, realName, doc)] of the (name, realName) candidates that exist, links followed.'''
+        docs = self.getDocsByNames([realName for (name, realName) in candidates])
+        links = set(d.get('linktometricname') for d in docs.values() if d.get('linktometricname'))
+        linkDocs = links and self.getDocsByNames(list(links)) or {}
         ret = []
-        for n in linkedKids:
-            if last:
-                ret.extend(self.find_mnames("%s.%s" % (n, last)))
-            else:
-                ret.extend(self.find_mnames(n))
-        #self.log.info("find_mnames(): returning: %s" % (ret))
+        for (name, realName) in candidates:
+            doc = docs.get(realName)
+            if doc and doc.get('linktometricname'):
+                realName = doc['linktometricname']
+                doc = linkDocs.get(realName)
+            if (not doc) or ('children' not in doc):  # protect against missing/malformed mtobjects.
+                continue
+            ret.append((name, realName, doc))
         return ret
 
     def find_nodes(self, queryPattern): 
         # return array of [ (mtrec1, 'B'), (mtrec2, 'B'), ...]   for branches or 'L' for leaves.
         if not queryPattern:
             return []
-        cached = self.getQpFromCache(queryPattern)
-        if cached:
-            return cached
         # 4 basic cases: 1: top level, 2: a.b.* navigating tree, 3: a.b.c exact, 4: everything else.
-        mnames = self.find_mnames(queryPattern)
-        #self.log.info("find_nodes(): have mnames: %s" % (mnames))
-        ret = []
-        for mn in mnames:
-            realName, linkpart, realpart = self.translateLinkedPath(mn)
-            mtobj = self.getByName(realName, saveNew=False)
-            #self.log.info("find_nodes(): getByName of mn: '%s', real is '%s' obj : %s" % (mn, realName, self.strMtDoc(mtobj)))
-            if (not mtobj) or (not mtobj.has_key('children')):  # protect against missing/malformed mtobjects.
-                continue
+        # Computed by one thread at a time, empty results are cached too.
+        return self._qpCache.get_or_compute(queryPattern, lambda: list(self.iter_nodes(queryPattern, lazy=False)))
+
+    def iter_nodes(self, queryPattern, lazy=True):
+        ''' find_nodes() as a generator, in sorted order and not cached, for capped finds.'''
+        for (mn, realName, mtobj) in self.expandPattern(queryPattern, lazy):
             if mtobj.get('children', []):
-                node = (mn, 'B')
+                yield (mn, 'B')
             else:
-                node = (mn, 'L')
-            ret.append(node)
-        self.addQpToCache(queryPattern, ret)
-        return ret
+                yield (mn, 'L')
 
     def nowTime(self):
         return time.time()
 
     def getQpFromCache(self, qp):
-        rdict = self._qpCache.get(qp, None)
-        if not rdict:
-            return None
-        expiry = rdict.get('expiry', None)
-        now = self.nowTime()
-        if (not expiry) or (expiry < now):
-            del self._qpCache[qp]
-            return None
-        val = rdict.get('val', None)
-        return val
+        ''' cached find_nodes() result of qp, None when not cached ([] is a result). '''
+        return self._qpCache.get(qp)
 
     def addQpToCache(self, qp, result):
-        now = self.nowTime() 
-        expiry = now + self._qpCacheExpirySeconds
-        # print "Nowtime: %s + %s seconds = %s expiry." % (now, self._qpCacheExpirySeconds, expiry)
-        adict = { 'expiry' : expiry, 'val' : result }
-        self._qpCache[qp] = adict
+        self._qpCache.put(qp, result)
+
+    def getQpCacheStats(self, top=20):
+        ret = self._qpCache.get_stats()
+        ret['topPatterns'] = self._qpCache.get_pattern_stats(top)
+        return ret
 
     def translateLinkedPath(self, inPath):
         #OPTIMIZATION:  
@@ -514,15 +581,15 @@ class MetricType(object):
 
     def getSubNodesSimple(self, queryPattern):
         assert not '*' in queryPattern, "getSubNodesSimple() cannot handle glob/regex patterns."
-        self.log.debug("metricType.getSubNodesSimple(): qp = %s" % (qp))
+        self.log.debug("metricType.getSubNodesSimple(): qp = %s" % (queryPattern))
         rec = self.getByName(queryPattern)
         if not rec:
-            self.log.debug("metricType.getSubNodesSimple(): RETURNED NONE, qp = %s" % (qp))
+            self.log.debug("metricType.getSubNodesSimple(): RETURNED NONE, qp = %s" % (queryPattern))
             return []
         namelist = rec['children'] 
         self.log.debug("metricType.getSubNodesSimple(): child id list: %s" % (namelist))
         doclist = self.getByNames(namelist)
-        self.log.debug("metricType.getSubNodesSimple(): Returning, result of query '%s', docs: %s" % (qp, [x.get('mname', "NOName!") for x in doclist]))
+        self.log.debug("metricType.getSubNodesSimple(): Returning, result of query '%s', docs: %s" % (queryPattern, [x.get('metricname', "NOName!") for x in doclist]))
         return doclist
 
     def splitOnStars(self, queryPattern):
@@ -694,6 +761,8 @@ class MetricType(object):
         self.log.info("deleteMetricTypeDocuments(): query: %s, list: %s" % (query, mnames))
         retval = self.session.execute(query, parameters=[ValueSequence(mnames)])
         self.log.info("deleteMetricTypeDocuments(): retval: %s" % (retval))
+        for mname in mnames:
+            self.invalidateCache(mname)
         return
         
         
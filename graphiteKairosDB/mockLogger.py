@@ -20,31 +20,31 @@ class MockLogger(object):
         # same as crit, but with traceback.
         if (self.level >= 5): return
         tb = traceback.format_exc()
-        print "MockLogger.EXCEPTION:%s %s" % (instring, tb)
+        print("MockLogger.EXCEPTION:%s %s" % (instring, tb))
         
     def critical(self, instring):
         if (self.level >= 5): return
-        print "MockLogger.CRITICAL: %s" % (instring )
+        print("MockLogger.CRITICAL: %s" % (instring ))
         
     def error(self, instring):   
         if (self.level >= 4): return
-        print "MockLogger.ERROR   : %s" % (instring )
+        print("MockLogger.ERROR   : %s" % (instring ))
         
     def warn(self, instring):
         if (self.level >= 3): return
-        print "MockLogger.WARNING : %s" % (instring )
+        print("MockLogger.WARNING : %s" % (instring ))
         
     def warning(self, instring):
         if (self.level >= 3): return
-        print "MockLogger.WARNING : %s" % (instring )
+        print("MockLogger.WARNING : %s" % (instring ))
         
     def info(self, instring):
         if (self.level >= 2): return
-        print "MockLogger.INFO    : %s" % (instring )
+        print("MockLogger.INFO    : %s" % (instring ))
         
     def debug(self, instring):
         if (self.level >= 1): return
-        print "MockLogger.DEBUG   : %s" % (instring )
+        print("MockLogger.DEBUG   : %s" % (instring ))
         
         
 
@@ -8,7 +8,7 @@ setup(
     author=u'Dmitry Gryzunov',
     description=('A plugin for using graphite-web with the cassandra-based '
                  'Kairosdb storage backend'),
-    py_modules=('kairosdb',),
+    py_modules=('kairosdb', 'kairosdbBatch', 'kairosdbResampler', 'kairosdbDownsample', 'kairosdbHttp', 'kairosdbEndpoints', 'kairosdbMetrics', 'kairosdbNameTree', 'kairosdbNameIndex', 'kairosdbGlob', 'kairosdbFind', 'kairosdbNameService', 'kairosdbDocCache', 'kairosdbPatternCache', 'kairosdbAsync', 'kairosdbJson', 'kairosdbCache', 'kairosdbSeries', 'kairosdbExtents', 'counterStats', 'mockLogger'),
     zip_safe=False,
     include_package_data=True,
     platforms='any',
@@ -0,0 +1,134 @@
+# KairosdbReader fetches through the finder module, with graphite, django
+# and cassandra stood in for by minimal modules.
+
+import json
+import os
+import sys
+import threading
+import time
+import types
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from mockLogger import MockLogger
+
+
+def install_module(name, **attrs):
+    module = sys.modules.get(name)
+    if module is None:
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+    for (key, value) in attrs.items():
+        setattr(module, key, value)
+    return module
+
+
+class Settings(object):
+    KAIROSDB_URL = 'http://127.0.0.1:1/api/v1'
+
+
+class FetchInProgress(object):
+    def __init__(self, wait_callback):
+        self.wait_callback = wait_callback
+
+    def waitForResults(self):
+        return self.wait_callback()
+
+
+class Interval(object):
+    def __init__(self, start, end):
+        (self.start, self.end) = (start, end)
+
+
+def install_stand_ins():
+    settings = Settings()
+    install_module('django')
+    install_module('django.conf', settings=settings)
+    # deployed as graphite/finders/kairosDBFinder.py next to its siblings.
+    install_module('graphite', settings=settings)
+    install_module('graphite.finders', __path__=[os.path.dirname(os.path.abspath(__file__))])
+    install_module('graphite.logger', log=MockLogger())
+    install_module('graphite.node', BranchNode=object, LeafNode=object)
+    install_module('graphite.util', find_escaped_pattern_fields=lambda pattern, path: path)
+    install_module('graphite.intervals', Interval=Interval, IntervalSet=list)
+    install_module('graphite.readers', FetchInProgress=FetchInProgress)
+    for name in ('cassandra', 'cassandra.cluster', 'cassandra.policies', 'cassandra.query'):
+        install_module(name)
+    install_module('cassandra.cluster', Cluster=object)
+    install_module('cassandra.policies', DCAwareRoundRobinPolicy=object)
+    install_module('cassandra.query', BatchStatement=object, ValueSequence=list, dict_factory=None)
+
+
+install_stand_ins()
+import kairosdbAsync
+import kairosDBFinder
+from kairosDBFinder import KairosdbReader, KairosdbUtils
+
+
+def start_node(values):
+    ''' answers every datapoints/query metric with values. '''
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            queries = [{'results': [{'name': m['name'], 'values': values}]} for m in request['metrics']]
+            body = json.dumps({'queries': queries}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/api/v1' % server.server_address[1]
+
+
+def test_fetch_wait_for_results():
+    (server, url) = start_node([[1000000, 1.0], [1060000, 2.0], [1120000, 4.0]])
+    try:
+        assert kairosDBFinder.KAIROSDB_RESPONSE_DECODER is not None
+        job = KairosdbReader(url, 'a.b').fetch(1000, 1240)
+        (time_info, datapoints) = job.waitForResults()
+        assert time_info == (1000, 1240, 60)
+        # resample_values() never fills the last bucket.
+        assert list(datapoints) == [1.0, 2.0, 4.0, None]
+        # a sampled fetch goes through resample_fixed_step() instead.
+        job = KairosdbReader(url, 'a.c').fetch(1020, 1200, requestContext={'maxDataPoints': 3})
+        (time_info, datapoints) = job.waitForResults()
+        assert time_info == (1020, 1200, 60)
+        assert list(datapoints) == [2.0, 4.0, None]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_async_queries_are_recorded():
+    if not kairosdbAsync.is_available():
+        return
+    (server, url) = start_node([[1000000, 1.0], [1060000, 2.0]])
+    engine = kairosdbAsync.KairosdbAsyncEngine(timeout=5.0)
+    kairosDBFinder.KAIROSDB_ASYNC_ENGINE = engine
+    try:
+        kairosDBFinder.reset_kairosdb_stats()
+        metrics = [{'name': 'a.b', 'tags': {}}, {'name': 'a.c', 'tags': {}}]
+        response = KairosdbUtils().post_kairosdb_query_async((url, 0, 2000000), metrics).result(5)
+        assert len(response['queries']) == 2
+        # the done callback runs right after the future resolves.
+        tstart = time.time()
+        while not kairosDBFinder.KAIROSDB_REQUEST_METRICS.dump()['endpoints'] and time.time() - tstart < 5:
+            time.sleep(0.01)
+        node = kairosDBFinder.KAIROSDB_REQUEST_METRICS.dump()['endpoints'][url.rsplit('/api', 1)[0]]
+        assert (node['requests'], node['errors'], node['points']) == (1, 0, 4)
+        assert node['bytesIn'] > 0 and node['bytesOut'] > 0
+    finally:
+        kairosDBFinder.KAIROSDB_ASYNC_ENGINE = None
+        engine.close()
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,173 @@
+# asyncio fetch engine against a local stand-in kairosdb node.
+
+import json
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+import kairosdbAsync
+from kairosdbAsync import FetchTimeoutError, KairosdbAsyncEngine
+from kairosdbBatch import KairosdbBatchFetcher
+from kairosdbHttp import KairosdbHttpClient
+from kairosdbJson import QueryResponseDecoder
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_node(delay=0.0):
+    ''' answers a datapoints/query POST with one result per metric, after delay seconds. '''
+    node = {'delay': delay, 'active': 0, 'max_active': 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            with lock:
+                node['active'] += 1
+                node['max_active'] = max(node['max_active'], node['active'])
+            time.sleep(node['delay'])
+            with lock:
+                node['active'] -= 1
+            queries = [{'results': [{'name': m['name'], 'values': [[1000, len(m['name'])]]}]} for m in request.get('metrics', [])]
+            body = json.dumps({'queries': queries}).encode('utf-8')
+            try:
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except Exception:
+                pass    # the client gave up on it.
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    node['url'] = 'http://127.0.0.1:%d/api/v1/datapoints/query' % server.server_address[1]
+    return node
+
+
+class ChunkList(object):
+    ''' decoder keeping the body chunks as they arrive. '''
+    def __init__(self):
+        self.chunks = []
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+
+    def result(self):
+        return self.chunks
+
+
+class FailingDecoder(ChunkList):
+    def feed(self, chunk):
+        raise ValueError("bad chunk")
+
+
+def query(*names):
+    return json.dumps({'metrics': [{'name': n, 'tags': {}} for n in names]})
+
+
+def test_post_json():
+    node = start_node()
+    engine = KairosdbAsyncEngine(timeout=5.0, chunk_size=16)
+    try:
+        response = engine.post_json(node['url'], query('a.b', 'c')).result(5)
+        assert [q['results'][0]['values'] for q in response['queries']] == [[[1000, 3]], [[1000, 1]]]
+        # decoders are fed the body chunk by chunk.
+        chunks = engine.post_json(node['url'], query('a'), decoder=ChunkList).result(5)
+        assert len(chunks) > 1 and max(len(c) for c in chunks) <= 16
+        assert json.loads(b''.join(chunks).decode('utf-8'))['queries'][0]['results'][0]['name'] == 'a'
+        response = engine.post_json(node['url'], query('a.b', 'c'), decoder=QueryResponseDecoder).result(5)
+        assert [q['results'][0]['values'].pairs() for q in response['queries']] == [[[1000, 3.0]], [[1000, 1.0]]]
+        try:
+            engine.post_json(node['url'], query('a'), decoder=FailingDecoder).result(5)
+        except ValueError as e:
+            assert 'bad chunk' in str(e)
+        else:
+            assert False, "expected the decoder's error"
+        assert engine.get_stats()['inFlight'] == 0
+    finally:
+        engine.close()
+
+
+def test_limit_per_host():
+    node = start_node(delay=0.2)
+    engine = KairosdbAsyncEngine(limit_per_host=2, timeout=5.0)
+    try:
+        futures = [engine.post_json(node['url'], query('m%d' % i)) for i in range(6)]
+        assert len([f.result(5) for f in futures]) == 6
+        assert node['max_active'] == 2
+    finally:
+        engine.close()
+
+
+def test_timeout():
+    node = start_node(delay=2.0)
+    engine = KairosdbAsyncEngine(timeout=0.3)
+    try:
+        future = engine.post_json(node['url'], query('slow'))
+        tstart = time.time()
+        try:
+            future.result(5)
+        except FetchTimeoutError as e:
+            assert 'timed out' in str(e)
+        else:
+            assert False, "expected a timeout"
+        assert time.time() - tstart < 1.5
+        assert engine.get_stats()['inFlight'] == 0
+    finally:
+        engine.close()
+
+
+def test_batch_fetcher_on_engine():
+    node = start_node()
+    down = 'http://127.0.0.1:1/api/v1/datapoints/query'
+    engine = KairosdbAsyncEngine(timeout=5.0)
+
+    def post_query_async(key, metrics):
+        return engine.post_json(key, json.dumps({'metrics': metrics}))
+
+    try:
+        fetcher = KairosdbBatchFetcher(None, None, post_query_async=post_query_async)
+        metrics = [{'name': 'a.b', 'tags': {}}, {'name': 'c', 'tags': {}}]
+        assert fetcher.fetch_many(node['url'], metrics) == [[[1000, 3]], [[1000, 1]]]
+        # a failed request gives every metric of it None.
+        assert fetcher.fetch_many(down, metrics) == [None, None]
+        assert fetcher.get_stats()['inFlight'] == 0
+    finally:
+        engine.close()
+
+
+def test_unavailable_without_aiohttp():
+    saved = kairosdbAsync.aiohttp
+    kairosdbAsync.aiohttp = None
+    try:
+        assert not kairosdbAsync.is_available()
+        try:
+            KairosdbAsyncEngine()
+        except AssertionError:
+            pass
+        else:
+            assert False, "expected the engine to refuse to start"
+    finally:
+        kairosdbAsync.aiohttp = saved
+    # readers then keep the thread pool fetcher.
+    node = start_node()
+
+    def post_query(key, metrics):
+        return KairosdbHttpClient().post(key, json.dumps({'metrics': metrics})).json()
+
+    fetcher = KairosdbBatchFetcher(post_query, ThreadPool(2))
+    assert fetcher.fetch_many(node['url'], [{'name': 'a', 'tags': {}}]) == [[[1000, 1]]]
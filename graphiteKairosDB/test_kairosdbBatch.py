@@ -0,0 +1,141 @@
+# Batched, split and coalesced datapoints/query fetches against a fake kairosdb.
+
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from kairosdbBatch import KairosdbBatchFetcher, split_time_range, wait_all
+from kairosdbResampler import SeriesPoints, as_series_points
+
+HOUR_MS = 3600 * 1000
+UNITS_MS = {'seconds': 1000, 'minutes': 60000, 'hours': 3600000}
+
+
+def raw_points(start_ms, end_ms):
+    ''' a point every 10 seconds. '''
+    first = start_ms + (-start_ms % 10000)
+    return [[ts, (ts // 10000) % 7] for ts in range(first, end_ms + 1, 10000)]
+
+
+def kairosdb_values(start_ms, end_ms, metric):
+    ''' raw points, or sums over buckets starting at start_ms like a sampling aggregator. '''
+    points = raw_points(start_ms, end_ms)
+    if not metric.get('aggregators'):
+        return points
+    sampling = metric['aggregators'][0]['sampling']
+    interval = sampling['value'] * UNITS_MS[sampling['unit']]
+    buckets = {}
+    for (ts, value) in points:
+        bucket = start_ms + (ts - start_ms) // interval * interval
+        buckets[bucket] = buckets.get(bucket, 0) + value
+    return [[ts, buckets[ts]] for ts in sorted(buckets)]
+
+
+class FakeKairosdb(object):
+    def __init__(self):
+        self.queries = []
+
+    def post_query(self, key, metrics):
+        (uri, start_ms, end_ms) = key
+        self.queries.append((key, [m['name'] for m in metrics]))
+        return {'queries': [{'results': [{'name': m['name'], 'values': kairosdb_values(start_ms, end_ms, m)}]}
+                            for m in metrics]}
+
+
+def fetch_split(fetcher, metric, start_ms, end_ms, chunk_ms, align_ms=1):
+    queries = [fetcher.submit(('kdb', s, e), metric) for (s, e) in split_time_range(start_ms, end_ms, chunk_ms, align_ms)]
+    chunks = wait_all(queries)
+    return SeriesPoints.join([as_series_points(values) for values in chunks])
+
+
+def pairs(series):
+    return list(zip(series.timestamps, series.values))
+
+
+def test_split_time_range():
+    assert split_time_range(0, 3 * HOUR_MS - 1, HOUR_MS) == [(0, HOUR_MS - 1), (HOUR_MS, 2 * HOUR_MS - 1),
+                                                             (2 * HOUR_MS, 3 * HOUR_MS - 1)]
+    assert split_time_range(1000, 2 * HOUR_MS + 5000, HOUR_MS) == [(1000, HOUR_MS - 1), (HOUR_MS, 2 * HOUR_MS - 1),
+                                                                   (2 * HOUR_MS, 2 * HOUR_MS + 5000)]
+    # short windows stay whole even when they cross a chunk boundary.
+    assert split_time_range(HOUR_MS - 60000, HOUR_MS + 60000, HOUR_MS) == [(HOUR_MS - 60000, HOUR_MS + 60000)]
+    assert split_time_range(0, HOUR_MS - 1, HOUR_MS) == [(0, HOUR_MS - 1)]
+    assert split_time_range(0, 5 * HOUR_MS, 0) == [(0, 5 * HOUR_MS)]
+    # boundaries on the sampling grid.
+    assert split_time_range(0, 2 * HOUR_MS, HOUR_MS + 1000, 600000) == [(0, HOUR_MS - 1), (HOUR_MS, 2 * HOUR_MS - 1),
+                                                                        (2 * HOUR_MS, 2 * HOUR_MS)]
+
+
+def test_split_raw_fetch_joins_to_unsplit():
+    kairosdb = FakeKairosdb()
+    fetcher = KairosdbBatchFetcher(kairosdb.post_query, ThreadPool(4))
+    metric = {'name': 'a.b', 'tags': {}}
+    (start_ms, end_ms) = (12345, 10 * HOUR_MS + 6789)
+    whole = fetcher.fetch_many(('kdb', start_ms, end_ms), [metric])[0]
+    split = fetch_split(fetcher, metric, start_ms, end_ms, 3 * HOUR_MS)
+    assert pairs(split) == pairs(as_series_points(whole))
+    assert len(kairosdb.queries) == 1 + 4
+
+
+def test_split_sampled_fetch_joins_to_unsplit():
+    kairosdb = FakeKairosdb()
+    fetcher = KairosdbBatchFetcher(kairosdb.post_query, ThreadPool(4))
+    metric = {'name': 'a.b', 'tags': {},
+              'aggregators': [{'name': 'sum', 'sampling': {'value': 10, 'unit': 'minutes'}}]}
+    (start_ms, end_ms) = (1200000, 10 * HOUR_MS)
+    whole = fetcher.fetch_many(('kdb', start_ms, end_ms), [metric])[0]
+    split = fetch_split(fetcher, metric, start_ms, end_ms, 3 * HOUR_MS + 1000, align_ms=600000)
+    assert pairs(split) == pairs(as_series_points(whole))
+
+
+def test_failed_chunk_fails_the_fetch():
+    def post_query(key, metrics):
+        if key[1] >= HOUR_MS:
+            raise IOError("kairosdb down")
+        return FakeKairosdb().post_query(key, metrics)
+
+    fetcher = KairosdbBatchFetcher(post_query, ThreadPool(2))
+    queries = [fetcher.submit(('kdb', s, e), {'name': 'a.b'}) for (s, e) in split_time_range(0, 2 * HOUR_MS, HOUR_MS)]
+    chunks = wait_all(queries)
+    assert chunks[0] is not None
+    assert chunks[1] is None and chunks[2] is None
+
+
+def test_concurrent_identical_fetches_share_one_query():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def post_query(key, metrics):
+        calls.append(key)
+        started.set()
+        release.wait(5)
+        if len(calls) == 1:
+            raise IOError("kairosdb down")
+        return FakeKairosdb().post_query(key, metrics)
+
+    fetcher = KairosdbBatchFetcher(post_query, ThreadPool(4))
+    key = ('kdb', 0, HOUR_MS)
+    results = []
+
+    def reader():
+        results.append(fetcher.submit(key, {'tags': {}, 'name': 'a.b'}).wait())
+
+    threads = [threading.Thread(target=reader)]
+    threads[0].start()
+    assert started.wait(5)
+    threads += [threading.Thread(target=reader) for i in range(4)]
+    [t.start() for t in threads[1:]]
+    time.sleep(0.1)
+    assert fetcher.get_stats()['inFlight'] == 1
+    release.set()
+    [t.join(5) for t in threads]
+    # the one failed query fails every waiter.
+    assert results == [None] * 5
+    assert len(calls) == 1
+    stats = fetcher.get_stats()
+    assert (stats['submitted'], stats['coalesced'], stats['queries'], stats['inFlight']) == (5, 4, 1, 0)
+    # landed: the next fetch is a query of its own.
+    assert fetcher.submit(key, {'name': 'a.b', 'tags': {}}).wait() == raw_points(0, HOUR_MS)
+    assert len(calls) == 2
+    assert fetcher.get_stats()['coalesced'] == 4
@@ -0,0 +1,97 @@
+# Block planning, merging and eviction of the datapoint cache.
+
+from kairosdbCache import KairosdbDatapointCache
+from kairosdbResampler import SeriesPoints
+
+
+class Cache(KairosdbDatapointCache):
+    ''' 10 second blocks, points may arrive 5 seconds late, clock set by the test. '''
+    def __init__(self, now, **kwargs):
+        KairosdbDatapointCache.__init__(self, block_seconds=10, late_write_seconds=5, **kwargs)
+        self.now = now
+
+    def nowMs(self):
+        return self.now
+
+
+def points(start_ms, end_ms, step_ms=1000):
+    return SeriesPoints.from_pairs([[ts, ts / 1000.0] for ts in range(start_ms, end_ms + 1, step_ms)])
+
+
+def pairs(series):
+    return list(zip(series.timestamps, series.values))
+
+
+def fetch(cache, plan):
+    ''' what kairosdb would return for plan. '''
+    fetched = points(plan.fetch_start, plan.end_ms)
+    cache.store(plan, fetched)
+    return plan.assemble(fetched)
+
+
+def test_miss_then_settled_hit():
+    cache = Cache(now=100000)
+    plan = cache.plan_fetch('s', 0, 29999, align_ms=1000)
+    assert plan.fetch_start == 0
+    assert pairs(fetch(cache, plan)) == pairs(points(0, 29999))
+    plan = cache.plan_fetch('s', 3000, 24999, align_ms=1000)
+    assert plan.fetch_start is None
+    assert pairs(plan.assemble()) == pairs(points(3000, 24999))
+    stats = cache.get_stats()
+    assert (stats['misses'], stats['hits'], stats['partialHits']) == (1, 1, 0)
+    assert (stats['blocks'], stats['points']) == (3, 30)
+
+
+def test_recent_tail_is_fetched_again():
+    cache = Cache(now=30000)
+    fetch(cache, cache.plan_fetch('s', 0, 29999, align_ms=1000))
+    # blocks 0 and 1 were older than late_write_seconds when fetched, the
+    # last 5 seconds of block 2 were not.
+    plan = cache.plan_fetch('s', 0, 29999, align_ms=1000)
+    assert plan.fetch_start == 25000
+    assert [b.filled_from for b in plan.blocks] == [0, 10000, 20000]
+    assert pairs(fetch(cache, plan)) == pairs(points(0, 29999))
+    assert cache.get_stats()['partialHits'] == 1
+
+
+def test_recent_ttl_serves_unsettled_blocks():
+    cache = Cache(now=30000, recent_ttl=60)
+    fetch(cache, cache.plan_fetch('s', 0, 29999, align_ms=1000))
+    cache.now = 59000
+    assert cache.plan_fetch('s', 0, 29999).fetch_start is None
+    cache.now = 91000
+    assert cache.plan_fetch('s', 0, 29999, align_ms=1000).fetch_start == 25000
+
+
+def test_extending_request_fetches_only_new_part():
+    cache = Cache(now=100000)
+    fetch(cache, cache.plan_fetch('s', 0, 14999, align_ms=1000))
+    plan = cache.plan_fetch('s', 0, 29999, align_ms=1000)
+    assert plan.fetch_start == 15000
+    assert pairs(fetch(cache, plan)) == pairs(points(0, 29999))
+    assert cache.get_stats()['points'] == 30
+
+
+def test_shorter_request_keeps_cached_tail():
+    cache = Cache(now=10000)
+    fetch(cache, cache.plan_fetch('s', 0, 9999, align_ms=1000))
+    plan = cache.plan_fetch('s', 0, 7999, align_ms=1000)
+    assert plan.fetch_start == 5000
+    assert pairs(fetch(cache, plan)) == pairs(points(0, 7999))
+    assert cache.get_stats()['points'] == 10
+    cache.recent_ms = 60000
+    plan = cache.plan_fetch('s', 0, 9999)
+    assert plan.fetch_start is None
+    assert pairs(plan.assemble()) == pairs(points(0, 9999))
+
+
+def test_least_recently_used_blocks_are_evicted():
+    cache = Cache(now=100000, max_points=25)
+    fetch(cache, cache.plan_fetch('a', 0, 9999))
+    fetch(cache, cache.plan_fetch('b', 0, 9999))
+    cache.plan_fetch('a', 0, 9999)      # touch a
+    fetch(cache, cache.plan_fetch('c', 0, 9999))
+    stats = cache.get_stats()
+    assert (stats['evictions'], stats['blocks'], stats['points']) == (1, 2, 20)
+    assert cache.plan_fetch('a', 0, 9999).fetch_start is None
+    assert cache.plan_fetch('b', 0, 9999).fetch_start == 0
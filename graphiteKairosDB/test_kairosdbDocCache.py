@@ -0,0 +1,45 @@
+# Metrictype document cache: LRU order, bounds and negative entries.
+
+import time
+
+from kairosdbDocCache import DocCache, MISSING, doc_nbytes
+
+
+def doc(name, children=()):
+    return {'metricname': name, 'parentname': 'root', 'children': list(children)}
+
+
+def test_evicts_least_recently_used():
+    cache = DocCache(max_entries=2, max_bytes=0)
+    cache.put('a', doc('a'))
+    cache.put('b', doc('b'))
+    assert cache.get('a')['metricname'] == 'a'
+    cache.put('c', doc('c'))
+    assert cache.get('b') is None
+    assert cache.get('a') and cache.get('c')
+    stats = cache.get_stats()
+    assert (stats['evictions'], stats['entries'], stats['misses']) == (1, 2, 1)
+
+
+def test_bounded_by_bytes():
+    big = doc('big', ['big.child%d' % i for i in range(1000)])
+    cache = DocCache(max_entries=0, max_bytes=doc_nbytes(big) * 3)
+    for i in range(10):
+        cache.put('big%d' % i, big)
+    assert len(cache) <= 3
+    assert cache.get_stats()['bytes'] <= doc_nbytes(big) * 3
+    assert cache.get('big9') is big
+
+
+def test_negative_entries_expire():
+    cache = DocCache(negative_ttl=0.05)
+    cache.put_missing('nope')
+    assert cache.get('nope') is MISSING
+    assert not cache.get('nope')
+    time.sleep(0.1)
+    assert cache.get('nope') is None
+    cache.put_missing('gone')
+    cache.put('gone', doc('gone'))
+    assert cache.get('gone')['metricname'] == 'gone'
+    stats = cache.get_stats()
+    assert (stats['negativeHits'], stats['expired']) == (2, 1)
@@ -0,0 +1,64 @@
+# Downsample planning and rollup routing.
+
+from kairosdbDownsample import DownsamplePlan, KairosdbDownsampler, KairosdbRollupRouter
+
+ROLLUPS = [
+    (60, 3600, '%(metric)s.1m.%(aggregator)s'),
+    (3600, 2 * 86400, '%(metric)s.1h.%(aggregator)s', {'rollup': ['1h']}),
+]
+NOW = 1400000000
+
+
+def test_plan_aggregator_and_interval():
+    downsampler = KairosdbDownsampler(target_points=100, rules=[('*.count', 'sum')], default_aggregator='max')
+    plan = downsampler.plan('a.count', NOW - 86400, NOW)
+    assert (plan.aggregator, plan.interval, plan.startTime % plan.interval) == ('sum', 900, 0)
+    assert downsampler.plan('a.b', NOW - 86400, NOW, maxDataPoints=50).aggregator == 'max'
+    assert downsampler.plan('a.b', NOW - 300, NOW) is None
+    assert KairosdbDownsampler().plan('a.b', NOW - 86400, NOW) is None
+
+
+def test_aggregator_query():
+    plan = DownsamplePlan('avg', 900, NOW - NOW % 900, NOW)
+    assert plan.get_aggregator_query() == {'name': 'avg', 'sampling': {'value': 15, 'unit': 'minutes'}}
+    assert DownsamplePlan('avg', 7200, 0, NOW).get_aggregator_query()['sampling'] == {'value': 2, 'unit': 'hours'}
+
+
+def test_no_matching_interval():
+    router = KairosdbRollupRouter(ROLLUPS)
+    plan = DownsamplePlan('avg', 30, NOW - 7 * 86400, NOW)
+    assert router.route('a.b', plan, now=NOW) is None
+    assert router.route('a.b', None, now=NOW) is None
+    assert KairosdbRollupRouter().route('a.b', DownsamplePlan('avg', 3600, 0, NOW), now=NOW) is None
+
+
+def test_coarsest_rollup_wins():
+    router = KairosdbRollupRouter(ROLLUPS)
+    start = NOW - 30 * 86400
+    plan = DownsamplePlan('avg', 3600, start - start % 3600, NOW)
+    route = router.route('a.b', plan, now=NOW)
+    assert (route.metric_name, route.interval, route.tags) == ('a.b.1h.avg', 3600, {'rollup': ['1h']})
+
+
+def test_lagging_coarse_rollup_falls_back_to_finer_one():
+    router = KairosdbRollupRouter(ROLLUPS)
+    # the hourly rollup lags two days behind, the window starts one day ago.
+    start = NOW - 86400
+    plan = DownsamplePlan('max', 3600, start - start % 3600, NOW)
+    route = router.route('a.b', plan, now=NOW)
+    assert (route.metric_name, route.interval, route.tags) == ('a.b.1m.max', 60, {})
+    # too recent for any rollup.
+    start = NOW - 1800
+    assert router.route('a.b', DownsamplePlan('max', 3600, start - start % 3600, NOW), now=NOW) is None
+
+
+def test_boundary_on_plan_grid():
+    router = KairosdbRollupRouter(ROLLUPS)
+    start = NOW - 86400
+    plan = DownsamplePlan('sum', 600, start - start % 600, NOW)
+    route = router.route('a.b', plan, now=NOW)
+    assert route.boundary % 600 == 0
+    assert NOW - 3600 - 600 < route.boundary <= NOW - 3600
+    query = route.get_metric_query(plan)
+    assert query['name'] == 'a.b.1m.sum'
+    assert query['aggregators'][0]['sampling'] == {'value': 10, 'unit': 'minutes'}
@@ -0,0 +1,115 @@
+# Endpoint pool against local stand-in kairosdb nodes.
+
+import random
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import kairosdbEndpoints
+from kairosdbEndpoints import KairosdbEndpointPool, parse_urls
+from kairosdbHttp import KairosdbHttpClient
+
+
+def start_node(name, status=200, delay=0.0):
+    ''' a server answering every POST with its name, after delay seconds. '''
+    node = {'hits': 0, 'status': status, 'delay': delay}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            node['hits'] += 1
+            time.sleep(node['delay'])
+            body = ('{"node": "%s"}' % name).encode('utf-8')
+            self.send_response(node['status'])
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    node['url'] = 'http://127.0.0.1:%d' % server.server_address[1]
+    return node
+
+
+class FirstChoice(object):
+    ''' stands in for the random module in kairosdbEndpoints, ties go to the first node. '''
+    def choice(self, seq):
+        return seq[0]
+
+
+def make_pool(nodes, **options):
+    client = KairosdbHttpClient(pool_size=10, connect_timeout=1.0, read_timeout=5.0)
+    return KairosdbEndpointPool([n['url'] for n in nodes], client=client, **options)
+
+
+def test_parse_urls():
+    assert parse_urls('http://a:8080/, http://b:8080') == ['http://a:8080', 'http://b:8080']
+    assert parse_urls(['http://a/']) == ['http://a']
+
+
+def test_spreads_over_nodes():
+    nodes = [start_node('a'), start_node('b'), start_node('c')]
+    pool = make_pool(nodes)
+    results = []
+
+    def work():
+        for i in range(10):
+            results.append(pool.post('datapoints/query', '{}').json()['node'])
+
+    threads = [threading.Thread(target=work) for i in range(6)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert len(results) == 60
+    assert all(n['hits'] > 0 for n in nodes)
+
+
+def test_failover_on_down_and_failing_nodes():
+    nodes = [start_node('good'), start_node('bad', status=503)]
+    down = {'url': 'http://127.0.0.1:1'}
+    pool = make_pool([down] + nodes)
+    for i in range(10):
+        assert pool.post('datapoints/query', '{}').json()['node'] == 'good'
+    stats = pool.get_stats()
+    assert stats['failovers'] > 0
+    assert stats['endpoints'][down['url']]['errors'] >= 1
+    # failed nodes are left out for a while, not asked on every request.
+    assert nodes[1]['hits'] <= 2
+
+
+def test_all_nodes_failing_raises():
+    pool = make_pool([start_node('bad', status=500)])
+    try:
+        pool.post('datapoints/query', '{}')
+    except Exception as e:
+        assert '500' in str(e)
+    else:
+        assert False, "expected an error"
+
+
+def test_hedged_request_beats_slow_node():
+    slow = start_node('slow')
+    fast = start_node('fast')
+    pool = make_pool([slow, fast], hedge_percentile=90)
+    # the slow node wins ties, the first request after it slows down is hedged.
+    kairosdbEndpoints.random = FirstChoice()
+    try:
+        for i in range(60):
+            pool.post('datapoints/query', '{}')
+        assert pool.hedge_delay() is not None
+        slow['delay'] = 2.0
+        tstart = time.time()
+        answers = [pool.post('datapoints/query', '{}').json()['node'] for i in range(4)]
+    finally:
+        kairosdbEndpoints.random = random
+    assert time.time() - tstart < 4.0
+    assert answers == ['fast'] * 4
+    assert pool.get_stats()['hedges'] >= 1
@@ -0,0 +1,122 @@
+# Metric extents looked up through a fake datapoints/query callback.
+
+import time
+
+from kairosdbExtents import KairosdbExtentIndex
+
+NOW = 1400000000
+URI = 'http://kairosdb:8080/api/v1'
+POINTS = {
+    'live': [(NOW - 86400) * 1000, (NOW - 60) * 1000],
+    'dead': [(NOW - 10 * 86400) * 1000, (NOW - 5 * 86400) * 1000],
+    }
+
+
+class FakeKairosdb(object):
+    ''' post_query callback answering order/limit queries from timestamps per metric name. '''
+    def __init__(self, points):
+        self.points = points
+        self.calls = []
+
+    def __call__(self, key, metrics):
+        self.calls.append((key, metrics))
+        (kairosdb_uri, start_absolute, end_absolute) = key
+        queries = []
+        for metric in metrics:
+            timestamps = [t for t in self.points.get(metric['name'], []) if start_absolute <= t <= end_absolute]
+            if metric['order'] == 'desc':
+                timestamps.reverse()
+            values = [[t, 1] for t in timestamps[:metric['limit']]]
+            queries.append({'results': [{'name': metric['name'], 'values': values}]})
+        return {'queries': queries}
+
+
+class ManualIndex(KairosdbExtentIndex):
+    ''' refreshed by the test instead of the refresher thread. '''
+    def _start_refresher(self):
+        pass
+
+
+def key(name):
+    return (URI, name)
+
+
+def test_refresher_thread_fills_extents():
+    index = KairosdbExtentIndex(FakeKairosdb(POINTS), live_seconds=3600)
+    assert index.get_intervals(key('dead')) is None
+    tstart = time.time()
+    while index.get_stats()['refreshed'] < 1 and time.time() - tstart < 5:
+        time.sleep(0.01)
+    assert index.get_intervals(key('dead')) == [(NOW - 10 * 86400, NOW - 5 * 86400 + 1)]
+    stats = index.get_stats()
+    assert (stats['misses'], stats['hits'], stats['queries'], stats['queued']) == (1, 1, 1, 0)
+
+
+def test_live_window():
+    index = ManualIndex(FakeKairosdb(POINTS), live_seconds=3600)
+    index.refresh([key('live'), key('dead'), key('empty')], now=NOW)
+    assert index.get_intervals(key('live'), now=NOW + 10) == [(NOW - 86400, NOW + 10)]
+    assert index.get_intervals(key('dead'), now=NOW + 10) == [(NOW - 10 * 86400, NOW - 5 * 86400 + 1)]
+    assert index.get_intervals(key('empty'), now=NOW + 10) == []
+    # live metrics may have data up to now, dead ones only up to their last point.
+    assert index.has_data(key('live'), NOW - 600, NOW, now=NOW)
+    assert not index.has_data(key('dead'), NOW - 600, NOW, now=NOW)
+    assert index.has_data(key('dead'), NOW - 6 * 86400, NOW, now=NOW)
+    assert not index.has_data(key('empty'), 0, NOW, now=NOW)
+    assert index.get_stats()['skippedFetches'] == 2
+
+
+def test_ttl():
+    index = ManualIndex(FakeKairosdb(POINTS), ttl=600)
+    index.refresh([key('dead')], now=NOW)
+    assert index.get(key('dead'), now=NOW + 599) is not None
+    assert not index._wanted
+    assert index.get(key('dead'), now=NOW + 600) is not None
+    assert list(index._wanted) == [key('dead')]
+
+
+def test_observe():
+    index = ManualIndex(FakeKairosdb(POINTS))
+    # only known extents are moved.
+    index.observe(key('dead'), [[NOW * 1000, 1]])
+    assert index.get(key('dead'), now=NOW) is None
+    index.refresh([key('dead'), key('empty')], now=NOW)
+    index.observe(key('dead'), [[(NOW - 20 * 86400) * 1000, 1], [NOW * 1000, 2]])
+    extent = index.get(key('dead'), now=NOW)
+    assert (extent.first, extent.last) == (NOW - 20 * 86400, NOW)
+    index.observe(key('empty'), [[NOW * 1000, 1]])
+    extent = index.get(key('empty'), now=NOW)
+    assert (extent.first, extent.last) == (NOW, NOW)
+    index.observe(key('empty'), [])
+    assert index.get(key('empty'), now=NOW).last == NOW
+
+
+def test_refresh_windows():
+    kairosdb = FakeKairosdb(dict(POINTS))
+    index = ManualIndex(kairosdb, live_seconds=3600, max_age=30 * 86400)
+    index.refresh([key('live'), key('empty')], now=NOW)
+    ((query_key, metrics),) = kairosdb.calls
+    assert query_key == (URI, (NOW - 30 * 86400) * 1000, NOW * 1000)
+    assert [(m['name'], m['order']) for m in metrics] == [('live', 'asc'), ('live', 'desc'), ('empty', 'asc'), ('empty', 'desc')]
+    # known extents only ask for the newest point since the previous lookup.
+    kairosdb.points['live'] = POINTS['live'] + [(NOW + 3000) * 1000]
+    kairosdb.points['empty'] = [(NOW + 1000) * 1000]
+    del kairosdb.calls[:]
+    index.refresh([key('live'), key('empty')], now=NOW + 3600)
+    assert [(k, [(m['name'], m['order']) for m in ms]) for (k, ms) in kairosdb.calls] == [
+        ((URI, (NOW + 3600 - 30 * 86400) * 1000, (NOW + 3600) * 1000), [('empty', 'asc'), ('empty', 'desc')]),
+        ((URI, (NOW - 3600) * 1000, (NOW + 3600) * 1000), [('live', 'desc')]),
+        ]
+    extent = index.get(key('live'), now=NOW + 3600)
+    assert (extent.first, extent.last, extent.checked_at) == (NOW - 86400, NOW + 3000, NOW + 3600)
+    assert index.get_intervals(key('empty'), now=NOW + 3600) == [(NOW + 1000, NOW + 3600)]
+
+
+def test_refresh_errors_keep_extents():
+    index = ManualIndex(FakeKairosdb(POINTS))
+    index.refresh([key('dead')], now=NOW)
+    index.post_query = lambda key, metrics: {'errors': ['boom']}
+    index.refresh([key('dead')], now=NOW + 7200)
+    extent = index.get(key('dead'), now=NOW)
+    assert (extent.last, extent.checked_at) == (NOW - 5 * 86400, NOW)
+    assert index.get_stats()['errors'] == 1
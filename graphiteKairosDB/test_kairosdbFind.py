@@ -0,0 +1,41 @@
+# Paging of lazily produced find matches.
+
+from kairosdbFind import FindWindow
+
+
+class Query(object):
+    pattern = '*'
+
+
+def counting(n, pulled):
+    for i in range(n):
+        pulled.append(i)
+        yield i
+
+
+def test_window_stops_pulling_when_full():
+    pulled = []
+    window = FindWindow(offset=0, max_results=3)
+    assert list(window.apply(counting(1000, pulled))) == [0, 1, 2]
+    assert window.truncated
+    assert len(pulled) == 4
+
+
+def test_pages():
+    query = Query()
+    query.offset = 0
+    pages = []
+    while query.offset is not None:
+        window = FindWindow.for_query(query, max_results=4)
+        pages.append(list(window.apply(range(10))))
+        window.report(query)
+        query.offset = query.next_offset
+    assert pages == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert query.truncated is False
+
+
+def test_unlimited():
+    window = FindWindow.for_query(Query())
+    assert not window.is_limited()
+    assert list(window.apply(range(5))) == [0, 1, 2, 3, 4]
+    assert not window.truncated
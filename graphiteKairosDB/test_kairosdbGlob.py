@@ -0,0 +1,78 @@
+# Compiled glob patterns against fnmatch and the regex the finder used before.
+
+import fnmatch
+import random
+import re
+
+from kairosdbGlob import GlobCache, GlobSegment, compile_glob, expand_braces, split_pattern
+
+
+NAMES = ['cpu', 'cpu0', 'cpu1', 'cpu12', 'mem', 'memfree', 'load', 'load1', 'x.count',
+         'a-b', 'a_b', 'A1', 'diskio', 'disk', 'io', '', 'c?u', 'cp[u]']
+
+PATTERNS = ['cpu', 'cpu*', '*', '*1', 'cpu?', 'c?u*', 'cpu[0-9]', 'cpu[!0]', '[cm]*', '*o*',
+            'load?', 'disk*io', 'a[-_]b', '*[0-9]', '??', '']
+
+
+def old_finder_regex(part):
+    part = part.replace('*', '.*').replace('?', '.')
+    return re.sub(r'{([^{]*)}', lambda x: "(%s)" % x.groups()[0].replace(',', '|'), part)
+
+
+def test_kinds():
+    kinds = dict((p, GlobSegment(p).kind) for p in ['cpu', '{cpu,mem}', 'cpu*', '*', '*.count', 'c?u', 'c{p,q}u*'])
+    assert kinds == {'cpu': 'literal', '{cpu,mem}': 'set', 'cpu*': 'prefix', '*': 'prefix',
+                     '*.count': 'suffix', 'c?u': 'general', 'c{p,q}u*': 'general'}
+
+
+def test_segments_match_like_fnmatch():
+    for pattern in PATTERNS:
+        segment = GlobSegment(pattern)
+        for name in NAMES:
+            assert segment.match(name) == fnmatch.fnmatchcase(name, pattern), (pattern, name)
+
+
+def test_braces():
+    assert expand_braces('a{b,c{d,e}}f') == ['abf', 'acdf', 'acef']
+    assert split_pattern('a.{b.c,d}.e[.]') == ['a', '{b.c,d}', 'e[.]']
+    segment = GlobSegment('{cpu,mem}*')
+    assert [n for n in NAMES if segment.match(n)] == ['cpu', 'cpu0', 'cpu1', 'cpu12', 'mem', 'memfree']
+    assert GlobSegment('{load,cpu}').select({'cpu': 1, 'mem': 2, 'load': 3}) == [('load', 3), ('cpu', 1)]
+    assert GlobSegment('{c{p,x}u,mem}*').filter(['cpu0', 'cxu', 'cu', 'memfree']) == ['cpu0', 'cxu', 'memfree']
+
+
+def test_unbalanced_braces_are_literal():
+    assert GlobSegment('{{a}*').filter(['{a', '{ab', 'a', '{{a}']) == ['{a', '{ab']
+    assert GlobSegment('a{b*').filter(['a{b', 'a{bc', 'ab']) == ['a{b', 'a{bc']
+    assert GlobSegment('a}*').filter(['a}', 'a}b', 'a']) == ['a}', 'a}b']
+
+
+def test_select_walks_tree_like_regex():
+    rnd = random.Random(7)
+    names = ['.'.join(rnd.choice(['srv%d' % i for i in range(12)] + ['web', 'db']) for d in range(3)) for i in range(300)]
+    tree = {}
+    for name in names:
+        node = tree
+        for part in name.split('.'):
+            node = node.setdefault(part, {})
+    for pattern in ['srv1.*.web', 'srv1*.{web,db}.*', '*.srv?.db', 'web.*.srv[0-3]', 'db.db.db']:
+        glob = compile_glob(pattern)
+        level = [('', tree)]
+        for segment in glob.segments:
+            level = [(path + '.' + name if path else name, child)
+                     for (path, node) in level
+                     for (name, child) in segment.select(node)]
+        found = set(path for (path, node) in level)
+        regex = re.compile(r'\.'.join(old_finder_regex(p) for p in split_pattern(pattern)) + r'\Z')
+        assert found == set(n for n in names if glob.match(n)) == set(n for n in names if regex.match(n))
+
+
+def test_cache_is_lru():
+    cache = GlobCache(max_size=2)
+    cache.get(('pattern', 'a'), GlobSegment)
+    cache.get(('pattern', 'b'), GlobSegment)
+    cache.get(('pattern', 'a'), GlobSegment)
+    cache.get(('pattern', 'c'), GlobSegment)
+    assert set(k[1] for k in cache._entries) == set(['a', 'c'])
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (1, 3, 2)
@@ -0,0 +1,106 @@
+# Pooled HTTP client against a local keep-alive stand-in kairosdb node.
+
+import gzip
+import io
+import json
+import threading
+import time
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+from kairosdbHttp import KairosdbHttpClient, gzip_bytes
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+
+
+def start_node():
+    ''' answers with the request body and its encoding, gzipped when asked to. '''
+    node = {'requests': []}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            encoding = self.headers.get('Content-Encoding')
+            if encoding == 'gzip':
+                body = gunzip(body)
+            node['requests'].append((encoding, body))
+            answer = json.dumps({'body': body.decode('utf-8')}).encode('utf-8')
+            self.send_response(200)
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                answer = gzip_bytes(answer)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(answer)))
+            self.end_headers()
+            self.wfile.write(answer)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    node['url'] = 'http://127.0.0.1:%d/api/v1/datapoints/query' % server.server_address[1]
+    return node
+
+
+def test_connections_are_reused():
+    node = start_node()
+    client = KairosdbHttpClient(pool_size=2)
+    for i in range(5):
+        assert client.post(node['url'], '{"i": %d}' % i).json() == {'body': '{"i": %d}' % i}
+    stats = client.get_stats()
+    assert (stats['requests'], stats['connections'], stats['pooledRequests']) == (5, 1, 5)
+    assert stats['reuseRatio'] == 0.8
+    client.reset_stats()
+    assert client.get_stats()['requests'] == 0
+
+
+def test_gzip_request_bodies():
+    node = start_node()
+    client = KairosdbHttpClient(gzip_requests=True, gzip_min_bytes=100)
+    big = json.dumps({'metrics': [{'name': 'metric.%d' % i} for i in range(50)]})
+    assert client.post(node['url'], big).json() == {'body': big}
+    assert client.post(node['url'], '{}').json() == {'body': '{}'}
+    assert [encoding for (encoding, body) in node['requests']] == ['gzip', None]
+    stats = client.get_stats()
+    assert stats['gzippedRequests'] == 1
+    assert stats['bytesSent'] == len(gzip_bytes(big)) + 2
+    assert len(gzip_bytes(big)) < len(big)
+
+
+def test_streamed_response_holds_slot_until_closed():
+    node = start_node()
+    client = KairosdbHttpClient(pool_size=1)
+    response = client.post(node['url'], '{}', stream=True)
+    done = threading.Event()
+
+    def second():
+        client.post(node['url'], '{}')
+        done.set()
+
+    thread = threading.Thread(target=second)
+    thread.daemon = True
+    thread.start()
+    assert not done.wait(0.3)
+    assert b''.join(response.iter_content(16)) == b'{"body": "{}"}'
+    response.close()
+    assert done.wait(5)
+    # closing again does not give back a second slot.
+    response.close()
+    stats = client.get_stats()
+    assert (stats['requests'], stats['waits']) == (2, 1)
+    assert stats['waitSeconds'] >= 0.3
@@ -0,0 +1,46 @@
+
+# Streaming decoder against json.loads() on generated datapoints/query responses.
+
+import json
+import random
+
+from kairosdbJson import decode_query_response
+
+
+def make_response(seed):
+    rnd = random.Random(seed)
+    queries = []
+    for q in range(rnd.randint(1, 6)):
+        results = []
+        for r in range(rnd.randint(1, 2)):
+            values = [[1400000000000 + i * 1000, rnd.choice([i, i * 0.5, -3e-5, 10 ** 12])] for i in range(rnd.randint(0, 500))]
+            results.append({
+                'name': 'values',
+                'group_by': [{'name': 'type', 'type': 'number'}],
+                'tags': {'values': ['x]]"}{', 'y\\"}'], 'results': ['a']},
+                'values': values,
+            })
+        queries.append({'sample_size': 10, 'results': results})
+    return {'queries': queries}
+
+
+def decode_in_chunks(text, chunk_size):
+    return decode_query_response([text[i:i + chunk_size] for i in range(0, len(text), chunk_size)])
+
+
+def test_matches_json_in_any_chunking():
+    for seed in range(5):
+        response = make_response(seed)
+        text = json.dumps(response).encode('utf-8')
+        for chunk_size in (1, 13, 4096, len(text)):
+            decoded = decode_in_chunks(text, chunk_size)
+            assert len(decoded['queries']) == len(response['queries'])
+            for (expected, got) in zip(response['queries'], decoded['queries']):
+                assert len(got['results']) == 1
+                assert got['results'][0]['values'].pairs() == expected['results'][0]['values']
+
+
+def test_null_values_and_errors():
+    decoded = decode_query_response([b'{"queries":[{"results":[{"name":"a","tags":{},"values":[[1000,null],[2000,1.5]]}]}]}'])
+    assert decoded['queries'][0]['results'][0]['values'].pairs() == [[1000, None], [2000, 1.5]]
+    assert decode_query_response([b'{"errors":["metric[0] must have a name"]}']) == {'errors': ['metric[0] must have a name']}
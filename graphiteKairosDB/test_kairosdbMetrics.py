@@ -0,0 +1,95 @@
+# Request instrumentation: latency histograms, the slow query log and counters.
+
+import json
+
+from kairosdbJson import JsonBodyDecoder
+from kairosdbMetrics import LatencyHistogram, KairosdbRequestMetrics, ByteCounter, CountingDecoder, count_points, describe_query, endpoint_of
+
+
+class ListLogger(object):
+    def __init__(self):
+        self.lines = []
+
+    def info(self, line):
+        self.lines.append(line)
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram()
+    assert histogram.percentile(50) is None
+    for seconds in [0.0005] * 90 + [0.015] * 9 + [60.0]:
+        histogram.observe(seconds)
+    assert histogram.count == 100
+    assert histogram.percentile(50) == 0.001
+    assert histogram.percentile(95) == 0.02
+    # beyond the last bucket the maximum is the bound.
+    assert histogram.percentile(100) == 60.0
+    ret = histogram.to_dict()
+    assert ret['buckets'] == {'le1': 90, 'le20': 9, 'leinf': 1}
+    assert (ret['max'], ret['p99']) == (60.0, 0.02)
+    assert abs(ret['avg'] - (0.045 + 0.135 + 60.0) / 100) < 1e-9
+
+
+def test_record_per_endpoint():
+    metrics = KairosdbRequestMetrics(slow_seconds=5.0)
+    metrics.record('http://a:8080', 'datapoints/query', 0.01, bytes_out=10, bytes_in=100, points=3, decode_seconds=0.5)
+    metrics.record('http://a:8080', 'datapoints/query', 0.02, error=ValueError('boom'))
+    metrics.record('http://b:8080', 'metricnames', 0.03)
+    endpoints = metrics.dump()['endpoints']
+    a = endpoints['http://a:8080']
+    assert (a['requests'], a['errors'], a['bytesOut'], a['bytesIn'], a['points'], a['decodeSeconds']) == (2, 1, 10, 100, 3, 0.5)
+    assert a['latency']['count'] == 2
+    assert endpoints['http://b:8080']['requests'] == 1
+    metrics.reset()
+    assert metrics.dump() == {'endpoints': {}, 'slowQueries': []}
+
+
+def test_slow_query_log():
+    logger = ListLogger()
+    metrics = KairosdbRequestMetrics(slow_seconds=1.0, slow_keep=2, logger=logger)
+    data = json.dumps({'start_absolute': 1, 'end_absolute': 2, 'metrics': [{'name': 'm%d' % i} for i in range(12)]})
+    metrics.record('http://a:8080', 'datapoints/query', 0.5, data=data)
+    assert metrics.dump()['slowQueries'] == []
+    for i in range(3):
+        metrics.record('http://a:8080', 'datapoints/query', 2.0 + i, data=data, error=IOError('down'))
+    slow = metrics.dump()['slowQueries']
+    assert [entry['seconds'] for entry in slow] == [3.0, 4.0]
+    assert slow[0]['query'] == {'start_absolute': 1, 'end_absolute': 2, 'metrics': 12, 'names': ['m%d' % i for i in range(10)]}
+    assert slow[0]['error'] == 'down'
+    assert len(logger.lines) == 3
+    # sampled out entirely.
+    metrics = KairosdbRequestMetrics(slow_seconds=1.0, slow_sample=0.0)
+    metrics.record('http://a:8080', 'datapoints/query', 2.0)
+    assert metrics.dump()['slowQueries'] == []
+
+
+def test_describe_query_of_bad_body():
+    assert describe_query('not json') == {'body': 'not json'}
+    assert describe_query(None) == {'body': ''}
+
+
+def test_byte_counter():
+    counter = ByteCounter(iter([b'ab', b'', b'cde']))
+    assert counter.count == 0
+    assert b''.join(counter) == b'abcde'
+    assert counter.count == 5
+
+
+def test_counting_decoder():
+    decoder = CountingDecoder(JsonBodyDecoder())
+    decoder.feed(b'{"queries": ')
+    decoder.feed(b'[]}')
+    assert decoder.result() == {'queries': []}
+    assert decoder.count == 15
+    assert decoder.seconds >= 0.0
+
+
+def test_count_points():
+    response = {'queries': [{'results': [{'values': [[1, 1], [2, 2]]}, {'values': None}]}, {'results': [{'values': [[1, 1]]}]}]}
+    assert count_points(response) == 3
+    assert count_points({}) == 0
+    assert count_points(None) == 0
+
+
+def test_endpoint_of():
+    assert endpoint_of('http://kairosdb:8080/api/v1/datapoints/query') == 'http://kairosdb:8080'
@@ -0,0 +1,55 @@
+# Name index file against the in-memory name tree.
+
+import os
+import random
+import shutil
+import tempfile
+
+from kairosdbGlob import compile_glob
+from kairosdbNameIndex import KairosdbNameIndex, NameIndex, write_index
+from kairosdbNameTree import build_tree
+
+
+def find(root, pattern):
+    level = [('', root)]
+    for segment in compile_glob(pattern).segments:
+        level = [(path + '.' + name if path else name, child)
+                 for (path, node) in level if node.children is not None
+                 for (name, child) in segment.select(node.children)]
+    return sorted((path, node.isLeaf()) for (path, node) in level)
+
+
+def test_index_finds_like_tree():
+    rnd = random.Random(3)
+    names = set('.'.join(rnd.choice(['s%d' % i for i in range(30)]) for k in range(rnd.randint(1, 4)))
+                for i in range(5000))
+    names.add(u'caf\xe9.x')
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'names.idx')
+        write_index(path, names)
+        index = NameIndex(path)
+        tree = build_tree(names)
+        for pattern in ['s1.*', '*.s2*.*', 's[0-3].s1?', '*.*.*.*', '{s1,s22}.s3', u'caf\xe9.*', 'nope.*']:
+            assert find(index.root, pattern) == find(tree, pattern), pattern
+        assert index.get_stats()['nodes'] == index.node_count
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_rebuild_replaces_mapped_file():
+    names = ['a.b', 'a.c']
+    tmp = tempfile.mkdtemp()
+    try:
+        index = KairosdbNameIndex(os.path.join(tmp, 'names.idx'), lambda: list(names), check_seconds=0)
+        root = index.get_root()
+        assert find(root, 'a.*') == [('a.b', True), ('a.c', True)]
+        names.append('a.d')
+        assert index.rebuild(max_age=3600) is False
+        assert index.rebuild() is True
+        assert find(index.get_root(), 'a.*') == [('a.b', True), ('a.c', True), ('a.d', True)]
+        # the old mapping is still readable.
+        assert find(root, 'a.*') == [('a.b', True), ('a.c', True)]
+        assert index.get_stats()['opens'] == 2
+    finally:
+        shutil.rmtree(tmp)
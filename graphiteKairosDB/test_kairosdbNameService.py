@@ -0,0 +1,70 @@
+# Name service and client over a unix socket.
+
+import os
+import tempfile
+
+from kairosdbGlob import compile_glob
+from kairosdbNameService import KairosdbNameClient, KairosdbNameService, NameServiceError
+from kairosdbNameTree import build_tree
+
+
+class TreeFinder(object):
+    ''' find_nodes() / iter_nodes() over an in-memory name tree. '''
+    def __init__(self, metric_names):
+        self.tree = build_tree(metric_names)
+
+    def iter_nodes(self, pattern):
+        level = [('', self.tree)]
+        for segment in compile_glob(pattern).segments:
+            level = [(path + '.' + name if path else name, child)
+                     for (path, node) in sorted(level, key=lambda x: x[0]) if node.children is not None
+                     for (name, child) in sorted(segment.select(node.children), key=lambda x: x[0])]
+        for (path, node) in level:
+            yield (path, node.isLeaf() and 'L' or 'B')
+
+    def find_nodes(self, pattern):
+        return list(self.iter_nodes(pattern))
+
+
+class FailingFinder(object):
+    def find_nodes(self, pattern):
+        raise ValueError("no such keyspace")
+
+
+def start(finder):
+    socket_path = os.path.join(tempfile.mkdtemp(), 'names.sock')
+    return (KairosdbNameService(finder, socket_path).start(), KairosdbNameClient(socket_path, timeout=5.0))
+
+
+def test_find_over_socket():
+    finder = TreeFinder([u'a.b.c', u'a.b.d', u'a.e', u'caf\xe9.x'])
+    (service, client) = start(finder)
+    try:
+        assert client.find_nodes('a.*') == ([('a.b', 'B'), ('a.e', 'L')], False)
+        assert client.find_nodes(u'caf\xe9.*') == ([(u'caf\xe9.x', 'L')], False)
+        assert client.find_nodes('a.b.*', offset=1, max_results=1) == ([('a.b.d', 'L')], False)
+        assert client.find_nodes('*.*', max_results=1) == ([('a.b', 'B')], True)
+        assert client.find_nodes('nope') == ([], False)
+        assert client.get_stats()['connects'] == 1
+        assert service.get_stats()['finds'] == 5
+    finally:
+        service.stop()
+
+
+def test_errors_and_reconnect():
+    (service, client) = start(FailingFinder())
+    try:
+        try:
+            client.find_nodes('a.*')
+        except NameServiceError as e:
+            assert 'no such keyspace' in str(e)
+        else:
+            assert False, "expected an error"
+        # the connection survives an error answer, and a restart of the service.
+        service.stop()
+        service.metric_type = TreeFinder(['a.b'])
+        service.start()
+        assert client.find_nodes('a.*') == ([('a.b', 'L')], False)
+        assert client.get_stats()['connects'] == 2
+    finally:
+        service.stop()
@@ -0,0 +1,165 @@
+# Name tree refreshes and prefix fetches into the partial name tree.
+
+from kairosdbNameTree import KairosdbNameTree, build_tree, has_path, tree_names
+
+NAMES = ['a.b.c', 'a.b.d', 'a.e', 'x.y.z', 'x.w']
+MANY = ['h%d.%s' % (i, m) for i in range(20) for m in ('cpu', 'mem')]
+
+
+class FetchPrefix(object):
+    ''' fake metricnames?prefix= endpoint counting its calls. '''
+    def __init__(self, names):
+        self.names = list(names)
+        self.calls = []
+
+    def __call__(self, prefix):
+        self.calls.append(prefix)
+        return [n for n in self.names if n.startswith(prefix)]
+
+
+def leaves(node, path=''):
+    if node.isLeaf():
+        return set([path])
+    ret = set()
+    for child in node.getChildren():
+        ret |= leaves(child, path + '.' + child.name if path else child.name)
+    return ret
+
+
+def make_tree(**options):
+    return KairosdbNameTree(lambda: NAMES, **options)
+
+
+def test_build_tree():
+    tree = build_tree(NAMES)
+    assert leaves(tree) == set(NAMES)
+    assert sorted(c.getName() for c in tree.getChild('a').getChildren()) == ['b', 'e']
+    assert tree.getChild('nope') is None
+
+
+def test_tree_names_and_paths():
+    tree = build_tree(NAMES + ['a.b'])
+    # a name that is also a branch is only a path.
+    assert sorted(tree_names(tree)) == sorted(NAMES)
+    assert has_path(tree, 'a.b') and has_path(tree, 'x.y.z')
+    assert not has_path(tree, 'a.x') and not has_path(tree, 'a.b.c.d')
+
+
+def test_refresh_copies_changed_paths_only():
+    names = list(MANY)
+    tree = KairosdbNameTree(lambda: names)
+    tree.refresh()
+    old = tree.tree
+    names.remove('h3.mem')
+    names.append('h3.disk')
+    names.append('h21.cpu')
+    tree.refresh()
+    new = tree.tree
+    assert leaves(old) == set(MANY)
+    assert leaves(new) == set(names)
+    # untouched subtrees are shared, changed paths are copies.
+    assert new.getChild('h4') is old.getChild('h4')
+    assert new.getChild('h3') is not old.getChild('h3')
+    stats = tree.get_stats()
+    assert (stats['refreshes'], stats['rebuilds'], stats['added'], stats['removed']) == (2, 1, len(MANY) + 2, 1)
+    assert stats['names'] == len(names)
+
+
+def test_emptied_branches_are_pruned():
+    names = list(MANY) + ['h3.sub.x', 'h3.sub']
+    tree = KairosdbNameTree(lambda: names)
+    tree.refresh()
+    names.remove('h3.sub.x')
+    tree.refresh()
+    # h3.sub is a name itself and stays.
+    assert leaves(tree.tree.getChild('h3')) == set(['cpu', 'mem', 'sub'])
+    names.remove('h3.sub')
+    names.remove('h3.cpu')
+    names.remove('h3.mem')
+    tree.refresh()
+    assert tree.tree.getChild('h3') is None
+    assert tree.get_stats()['rebuilds'] == 1
+
+
+def test_big_change_rebuilds():
+    names = list(NAMES)
+    tree = KairosdbNameTree(lambda: names)
+    tree.refresh()
+    names[:] = MANY
+    tree.refresh()
+    assert leaves(tree.tree) == set(MANY)
+    assert tree.get_stats()['rebuilds'] == 2
+
+
+def test_stale_tree_served_when_refresh_fails():
+    names = list(NAMES)
+
+    def fetch_names():
+        if names is None:
+            raise IOError("kairosdb down")
+        return names
+
+    tree = KairosdbNameTree(fetch_names, max_stale_seconds=60)
+    first = tree.get_tree()
+    assert tree.get_tree() is first
+    assert tree.get_stats()['blockingRefreshes'] == 1
+    names = None
+    tree.built_at -= 120
+    assert tree.get_tree() is first
+    stats = tree.get_stats()
+    assert (stats['blockingRefreshes'], stats['refreshErrors']) == (2, 1)
+
+
+def test_covering_prefix_is_reused():
+    tree = make_tree()
+    fetch = FetchPrefix(NAMES)
+    assert leaves(tree.get_prefix_tree('a.', fetch)) == set(['a.b.c', 'a.b.d', 'a.e'])
+    tree.get_prefix_tree('a.b.', fetch)
+    tree.get_prefix_tree('a.', fetch)
+    assert fetch.calls == ['a.']
+    assert leaves(tree.get_prefix_tree('x.', fetch)) == set(NAMES)
+    assert fetch.calls == ['a.', 'x.']
+    stats = tree.get_stats()
+    assert (stats['prefixFetches'], stats['prefixHits'], stats['prefixes']) == (2, 2, 2)
+
+
+def test_expired_prefix_is_fetched_again():
+    tree = make_tree(prefix_ttl=60)
+    fetch = FetchPrefix(NAMES)
+    tree.get_prefix_tree('a.', fetch)
+    tree.prefixes['a.'] -= 61
+    tree.get_prefix_tree('a.b.', fetch)
+    assert fetch.calls == ['a.', 'a.b.']
+
+
+def test_vanished_names_are_removed():
+    tree = make_tree()
+    fetch = FetchPrefix(NAMES)
+    tree.get_prefix_tree('a.', fetch)
+    tree.get_prefix_tree('x.', fetch)
+    fetch.names.remove('a.b.d')
+    fetch.names.remove('a.e')
+    tree.prefixes['a.'] -= 3600
+    assert leaves(tree.get_prefix_tree('a.', fetch)) == set(['a.b.c', 'x.y.z', 'x.w'])
+    assert tree.partial_names == set(['a.b.c', 'x.y.z', 'x.w'])
+
+
+def test_partial_tree_reset_above_max_names():
+    tree = make_tree(max_prefix_names=4)
+    fetch = FetchPrefix(NAMES)
+    tree.get_prefix_tree('a.', fetch)
+    assert leaves(tree.get_prefix_tree('x.', fetch)) == set(['x.y.z', 'x.w'])
+    assert tree.get_stats()['partialResets'] == 1
+    assert list(tree.prefixes) == ['x.']
+    tree.get_prefix_tree('a.b.', fetch)
+    assert fetch.calls == ['a.', 'x.', 'a.b.']
+
+
+def test_full_tree_serves_prefixes():
+    tree = make_tree()
+    fetch = FetchPrefix(NAMES)
+    tree.get_prefix_tree('a.', fetch)
+    full = tree.get_tree()
+    assert tree.get_prefix_tree('x.', fetch) is full
+    assert fetch.calls == ['a.']
+    assert (tree.partial_names, tree.prefixes) == (set(), {})
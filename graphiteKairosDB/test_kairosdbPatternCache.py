@@ -0,0 +1,76 @@
+# Find result cache by pattern: bounds, expiry, empty results, single compute.
+
+import threading
+import time
+
+from kairosdbPatternCache import PatternCache
+
+
+def test_caches_empty_results_and_bounds():
+    cache = PatternCache(max_patterns=2, sweep_seconds=0)
+    calls = []
+
+    def compute(pattern):
+        calls.append(pattern)
+        return []
+
+    for pattern in ['a.*', 'a.*', 'b.*', 'c.*', 'a.*']:
+        assert cache.get_or_compute(pattern, lambda: compute(pattern)) == []
+    assert calls == ['a.*', 'b.*', 'c.*', 'a.*']
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['patterns']) == (1, 4, 2, 2)
+    assert dict(cache.get_pattern_stats())['a.*']['hits'] == 1
+
+
+def test_sweep_drops_expired():
+    cache = PatternCache(ttl=0.01, stale_seconds=0.01, sweep_seconds=0)
+    cache.put('a.*', ['a.b'])
+    assert cache.get('a.*') == ['a.b']
+    time.sleep(0.05)
+    assert cache.sweep() == 1
+    assert cache.get('a.*') is None
+
+
+def test_one_thread_computes_others_get_stale():
+    cache = PatternCache(ttl=0.01, stale_seconds=60, sweep_seconds=0)
+    cache.put('a.*', ['old'])
+    time.sleep(0.02)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return ['new']
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(cache.get_or_compute('a.*', slow)))
+    first.start()
+    started.wait()
+    others = [cache.get_or_compute('a.*', slow) for i in range(5)]
+    release.set()
+    first.join()
+    assert others == [['old']] * 5
+    assert results == [['new']]
+    assert calls == [1]
+    assert cache.get_or_compute('a.*', slow) == ['new']
+
+
+def test_cold_misses_wait_for_one_compute():
+    cache = PatternCache(sweep_seconds=0)
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.1)
+        return ['x']
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('x.*', slow))) for i in range(8)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert results == [['x']] * 8
+    assert calls == [1]
+    assert cache.get_stats()['waits'] >= 1
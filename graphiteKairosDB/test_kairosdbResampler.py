@@ -0,0 +1,104 @@
+
+# Equivalence of the numpy resampler with the original per-point loop.
+
+import pickle
+import random
+
+import numpy as np
+
+from kairosdbResampler import resample_python, resample_array, resample_values, resample_fixed_step, values_to_arrays, to_datapoints, SeriesPoints
+from kairosdbSeries import CompactSeries, SeriesMemoryAccount
+
+
+def make_values(count, start_ms, min_gap_ms, max_gap_ms, seed):
+    rnd = random.Random(seed)
+    values = []
+    ts = start_ms
+    for i in range(count):
+        ts += rnd.randint(min_gap_ms, max_gap_ms)
+        values.append([ts, rnd.choice([rnd.randint(-100, 100), rnd.random() * 1000])])
+    return values
+
+
+def assert_same(values, startTime, endTime):
+    expected = resample_python(values, startTime, endTime)
+    got = resample_values(values, startTime, endTime)
+    assert got[0] == expected[0], (got[0], expected[0])
+    assert got[1] == expected[1]
+
+
+def test_regular_series():
+    values = [[(1000 + i * 10) * 1000, float(i)] for i in range(100)]
+    assert_same(values, 1000, 2000)
+    assert_same(values, 995, 2010)
+    assert_same(values, 1100, 1500)
+
+
+def test_random_jitter():
+    for seed in range(50):
+        values = make_values(random.Random(seed).randint(2, 300), 1400000000000, 1, 30000, seed)
+        first = values[0][0] // 1000
+        last = values[-1][0] // 1000
+        assert_same(values, first, last)
+        assert_same(values, first - 100, last + 100)
+        assert_same(values, first + 50, last - 50)
+
+
+def test_sub_second_and_duplicate_timestamps():
+    values = [[1000000, 1], [1000200, 2], [1000900, 3], [1001000, 4], [1001000, 5], [1003000, 6], [1009999, 7]]
+    assert_same(values, 995, 1012)
+    assert_same(values, 1000, 1010)
+
+
+def test_two_values_and_empty_window():
+    assert_same([[1000000, 1], [1005000, 2]], 1000, 1010)
+    assert_same([[1000000, 1], [1005000, 2]], 1010, 1000)
+    assert_same([[1000000, 1], [1005000, 2], [1009000, 3]], 1000, 1001)
+
+
+def test_small_series():
+    assert resample_values([], 10, 20) == ((10, 20, 1), [])
+    assert resample_values([[10000, 3]], 10, 20) == ((10, 20, 1), [3])
+
+
+def test_unsorted_input_falls_back_to_loop():
+    values = [[1000000, 1], [1030000, 2], [1010000, 3], [1040000, 4], [1050000, 5]]
+    assert_same(values, 1000, 1060)
+
+
+def test_array_output_uses_nan_gaps():
+    values = [[1000000, 1], [1010000, None], [1020000, 3], [1040000, 4]]
+    (timestamps, vals) = values_to_arrays(values)
+    (time_info, datapoints) = resample_array(timestamps, vals, 1000, 1050)
+    assert time_info == (1000, 1050, 10)
+    assert np.isnan(datapoints[1]) and np.isnan(datapoints[3]) and np.isnan(datapoints[4])
+    assert to_datapoints(datapoints) == [1.0, None, 3.0, None, None]
+
+
+def test_fixed_step_grid():
+    values = [[1200000, 1], [1260000, 2], [1380000, 4], [1500000, 9]]
+    assert resample_fixed_step(values, 1200, 1440, 60) == ((1200, 1440, 60), [1, 2, None, 4])
+    assert resample_fixed_step(values[:1], 1200, 1250, 60) == ((1200, 1250, 60), [1])
+
+
+def test_series_points_input():
+    for seed in range(10):
+        values = make_values(200, 1400000000000, 500, 20000, seed)
+        first = values[0][0] // 1000
+        points = SeriesPoints.from_pairs(values)
+        assert resample_values(points, first, first + 2000) == resample_python(values, first, first + 2000)
+        assert resample_fixed_step(points, first, first + 2000, 60) == resample_fixed_step(values, first, first + 2000, 60)
+
+
+def test_compact_series():
+    (time_info, datapoints) = resample_fixed_step([[1200000, 1], [1260000, 2], [1380000, 4]], 1200, 1440, 60)
+    assert isinstance(datapoints, CompactSeries)
+    assert len(datapoints) == 4
+    assert datapoints[2] is None and datapoints[3] == 4
+    assert list(datapoints) == [1, 2, None, 4]
+    assert datapoints.nbytes == 4 * 8
+    assert pickle.loads(pickle.dumps(datapoints, 2)) == [1, 2, None, 4]
+    account = SeriesMemoryAccount()
+    account.start_request()
+    account.add(datapoints)
+    assert account.request_usage() == {'series': 1, 'points': 4, 'bytes': 32}
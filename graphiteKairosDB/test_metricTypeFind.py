@@ -0,0 +1,115 @@
+# MetricType finds over a fake cassandra session.
+
+from metricType import MetricType
+
+NAMES = ['a.b.c', 'a.b.d', 'a.e', 'x.y.z', 'x.y.w', 'sites.s1.cpu.v', 'sites.s1.mem.v', 'root2.q']
+
+
+def make_docs():
+    docs = {}
+    for name in NAMES:
+        parts = name.split('.')
+        for n in range(1, len(parts) + 1):
+            mname = '.'.join(parts[:n])
+            parent = '.'.join(parts[:n - 1]) or 'root'
+            doc = docs.setdefault(mname, {'metricname': mname, 'parentname': parent, 'children': [], 'linktometricname': None})
+            if n < len(parts):
+                child = '.'.join(parts[:n + 1])
+                if child not in doc['children']:
+                    doc['children'].append(child)
+    # sites.link is a link to sites.s1.
+    docs['sites.link'] = {'metricname': 'sites.link', 'parentname': 'sites', 'children': [], 'linktometricname': 'sites.s1'}
+    docs['sites']['children'].append('sites.link')
+    return docs
+
+
+class Future(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self):
+        return self.rows
+
+
+class FakeSession(object):
+    ''' answers MetricType's metrictype queries from a dict, dict rows like dict_factory. '''
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+
+    def execute(self, query, params=None, parameters=None):
+        args = params or parameters or []
+        self.queries.append((query, list(args[0]) if ' IN ' in query else args[0]))
+        if ' IN ' in query:
+            return [dict(self.docs[name]) for name in args[0] if name in self.docs]
+        if 'parentname' in query:
+            return [dict(d) for d in self.docs.values() if d['parentname'] == args[0]]
+        if 'metricname' in query:
+            return [dict(self.docs[args[0]])] if args[0] in self.docs else []
+        raise ValueError(query)
+
+    def execute_async(self, query, parameters=None):
+        return Future(self.execute(query, parameters=parameters))
+
+    def shutdown(self):
+        pass
+
+
+def make_metric_type(chunk_size=100):
+    session = FakeSession(make_docs())
+    mt = MetricType(in_query_chunk_size=chunk_size)
+    mt.openConnection(session)
+    return (mt, session)
+
+
+def test_wildcard_first_level():
+    (mt, session) = make_metric_type()
+    assert mt.find_nodes('*') == [('a', 'B'), ('root2', 'B'), ('sites', 'B'), ('x', 'B')]
+    assert mt.find_mnames('*.*') == ['a.b', 'a.e', 'root2.q', 'sites.link', 'sites.s1', 'x.y']
+
+
+def test_literal_head_is_one_query():
+    (mt, session) = make_metric_type()
+    assert mt.find_nodes('a.b.c') == [('a.b.c', 'L')]
+    assert session.queries == [('SELECT * FROM metrictype WHERE metricname IN %s', ['a', 'a.b', 'a.b.c'])]
+    assert mt.find_nodes('x.y.*') == [('x.y.w', 'L'), ('x.y.z', 'L')]
+    assert mt.find_nodes('nope.*') == []
+
+
+def test_braces_and_sets():
+    (mt, session) = make_metric_type()
+    assert mt.find_mnames('a.b.{d,c,nope}') == ['a.b.c', 'a.b.d']
+    assert mt.find_mnames('{x,a}.[by]') == ['a.b', 'x.y']
+
+
+def test_links_followed_mid_path():
+    (mt, session) = make_metric_type()
+    assert mt.find_nodes('sites.link.*') == [('sites.link.cpu', 'B'), ('sites.link.mem', 'B')]
+    assert mt.find_nodes('sites.*.cpu.v') == [('sites.link.cpu.v', 'L'), ('sites.s1.cpu.v', 'L')]
+
+
+def test_sorted_by_level_and_node_type():
+    (mt, session) = make_metric_type(chunk_size=2)
+    nodes = mt.find_nodes('*.*.*')
+    assert nodes == [('a.b.c', 'L'), ('a.b.d', 'L'), ('sites.link.cpu', 'B'), ('sites.link.mem', 'B'),
+                     ('sites.s1.cpu', 'B'), ('sites.s1.mem', 'B'), ('x.y.w', 'L'), ('x.y.z', 'L')]
+    assert list(mt.iter_nodes('*.*.*')) == nodes
+
+
+def test_capped_find_stops_early():
+    (mt, session) = make_metric_type(chunk_size=1)
+    nodes = mt.iter_nodes('*.*.*')
+    assert next(nodes) == ('a.b.c', 'L')
+    # root docs come with the root query, then only the path down to the first result.
+    looked_up = [names for (query, names) in session.queries if ' IN ' in query]
+    assert looked_up == [['a.b'], ['a.b.c']]
+
+
+
+def test_name_service_benchmark_session():
+    from kairosdbNameService import MemorySession
+    (mt, session) = make_metric_type()
+    bench = MetricType()
+    bench.openConnection(MemorySession(NAMES))
+    for pattern in ['*', 'a.*', '*.y.{z,w}', 'sites.s1.*.v', 'nope.*']:
+        assert bench.find_nodes(pattern) == mt.find_nodes(pattern)